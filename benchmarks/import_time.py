@@ -0,0 +1,55 @@
+"""
+Start-up time of the fibermorph command line and of the joblib workers.
+
+Each case runs in a fresh interpreter REPEATS times, and the median wall time is reported:
+
+    help     fibermorph --help
+    section  fibermorph --section on an empty input directory (start-up and an empty run)
+    worker   importing image.py, which every loky worker does before it can unpickle curvature_seq/section_seq
+
+Usage: python benchmarks/import_time.py [--repeats N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fibermorph")
+
+REPEATS = 5
+
+
+def wall_time(cmd, repeats):
+    """Median wall time in seconds of running a command in a fresh process."""
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Runs per case. Default is 5.")
+    args = parser.parse_args()
+
+    entry = os.path.join(PACKAGE_DIR, "fibermorph.py")
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "input")
+        os.mkdir(input_dir)
+        cases = [
+            ("help", [sys.executable, entry, "--help"]),
+            ("section", [sys.executable, entry, "--section", "-i", input_dir, "-o", os.path.join(tmp, "output")]),
+            ("worker", [sys.executable, "-c", "import sys; sys.path.insert(0, {!r}); import image".format(PACKAGE_DIR)]),
+        ]
+        for name, cmd in cases:
+            print("{:<8} {:6.2f} s".format(name, wall_time(cmd, args.repeats)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Benchmarks of the curvature and section pipelines on synthetic images.
+
+Each case generates its images with a fixed seed: dummy_data.dummy_data_gen draws arcs or lines for curvature, with
+the image size and the number of fibers set by the case (fiber lengths follow from both, as each fiber is drawn in
+its own region of the image), and analysis.sim_ellipse draws one section per image, which is then blurred and made
+noisy like a micrograph. The stage functions are timed on the first image of the case (median of --repeats runs, each
+stage fed the output of the previous one):
+
+    curvature  filter_curv, binarize_curv, remove_particles, skeletonize, prune, analyze_all_curv
+    section    imread, crop_section, segment_section
+
+and the end-to-end driver (curvature() or section()) once on all the images of the case, with --jobs cores.
+
+Every run appends one JSON line to benchmarks/history.jsonl with the fibermorph version, the git commit, the machine
+and the timings. Each timing is compared with the latest earlier run of the same case on the same machine (host name
+and core count), and reported as a regression when it is slower by more than --threshold.
+
+The summary rows the drivers produce are checked against benchmarks/reference.json, which holds the output of the
+reference implementation for each case, the commit it came from and the tolerances it must stay within (rtol, and atol
+for values near 0). --update_reference rewrites the entries of the cases that were run, with this tree's outputs, or
+with --reference_tree those of the drivers of another checkout (run in a subprocess on the same images).
+
+The curvature entries come from the original implementation, the baseline commit 77d6e70 (a `git worktree add` of it
+passed as --reference_tree), so they show how far the optimized pipeline has moved from it. Path-ordered fiber tracing
+and the lookup-table pruning changed the curvatures by up to 0.5% and the lengths by up to 2.3%, and the curvatures of
+straight lines, which are noise around 0, by up to 0.01 1/mm: these cases are checked with rtol 0.03 and atol 0.02.
+The baseline can't run the section cases (its sim_ellipse fails), so their entries come from this tree at the commit
+they record, with rtol 0.001, and only catch changes made since.
+
+The exit status is 1 when an output is out of tolerance or, with --fail_on_regression, when a timing regressed.
+
+Usage: python benchmarks/pipelines.py [--cases NAME ...] [--repeats N] [--jobs N]
+                                     [--update_reference [--reference_tree DIR] [--rtol RTOL] [--atol ATOL]]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import skimage.filters
+from PIL import Image
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+PACKAGE_DIR = BENCHMARK_DIR.parent.joinpath("fibermorph")
+sys.path.insert(0, str(PACKAGE_DIR))
+
+import analysis  # noqa: E402
+import image  # noqa: E402
+from _version import __version__  # noqa: E402
+from dummy_data import dummy_data_gen  # noqa: E402
+
+HISTORY_PATH = BENCHMARK_DIR.joinpath("history.jsonl")
+REFERENCE_PATH = BENCHMARK_DIR.joinpath("reference.json")
+
+# relative tolerance of new reference entries
+RTOL = 1e-3
+
+REPEATS = 3
+THRESHOLD = 0.2
+SEED = 2020
+
+# analysis parameters (the command line defaults, with a window in mm for curvature)
+CURV_RESOLUTION = 132
+CURV_WINDOW = 0.5
+CURV_WINDOW_UNIT = "mm"
+SECTION_RESOLUTION = 4.25
+SECTION_MINSIZE = 20
+SECTION_MAXSIZE = 150
+
+CASES = {
+    # module, image size, number of images, and fibers per image (curvature) or diameter range in um (section)
+    "curv_arcs_small": dict(module="curvature", shape="arc", width=1300, height=975, images=2, fibers=5),
+    "curv_lines_small": dict(module="curvature", shape="line", width=1300, height=975, images=2, fibers=8),
+    "curv_arcs_full": dict(module="curvature", shape="arc", width=5200, height=3900, images=2, fibers=15),
+    "section_small": dict(module="section", width=1300, height=975, images=3, diameters=(30, 120)),
+    "section_full": dict(module="section", width=5200, height=3900, images=3, diameters=(30, 120)),
+}
+
+DEFAULT_CASES = ["curv_arcs_small", "curv_lines_small", "section_small"]
+
+
+@contextlib.contextmanager
+def quiet():
+    """Sends stdout and stderr to /dev/null at the file descriptor level, so that worker processes and progress
+    bars are silenced too."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip([1, 2], saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+
+def generate(name, case, directory):
+    """Writes the images of a case to a directory, named <case>_<i>.tiff, with a fixed seed (and for sections the
+    ground truth from sim_ellipse next to them, as <case>_<i>.csv)."""
+    random.seed(SEED)
+    np.random.seed(SEED)
+    directory.mkdir(parents=True)
+    for i in range(case["images"]):
+        tmp = directory.joinpath("tmp")
+        tmp.mkdir()
+        if case["module"] == "curvature":
+            dummy_data_gen(tmp, shape=case["shape"], min_elem=case["fibers"], max_elem=case["fibers"],
+                           im_width=case["width"], im_height=case["height"])
+        else:
+            min_diam = random.uniform(*case["diameters"])
+            max_diam = random.uniform(min_diam, case["diameters"][1])
+            analysis.sim_ellipse(tmp, case["width"], case["height"], min_diam, max_diam, SECTION_RESOLUTION,
+                                 random.randint(0, 360))
+        # generated names carry a timestamp; stable names keep the summary rows comparable between runs
+        generated = next(tmp.glob("*.tiff"))
+        im_path = directory.joinpath("{}_{}.tiff".format(name, i))
+        generated.rename(im_path)
+        if case["module"] == "section":
+            # ground truth of the section (true area, diameters and eccentricity)
+            generated.with_suffix(".csv").rename(im_path.with_suffix(".csv"))
+        shutil.rmtree(tmp)
+        if case["module"] == "section":
+            photograph(im_path)
+    return sorted(directory.glob("*.tiff"))
+
+
+def photograph(im_path):
+    """Blurs a binary section image and adds noise, so that it goes through the grayscale path of section_seq
+    (crop_section and segment_section) like a micrograph does."""
+    img = np.asarray(Image.open(im_path).convert("L"), dtype=float) / 255
+    img = skimage.filters.gaussian(img, sigma=3) + np.random.normal(0, 0.03, img.shape)
+    Image.fromarray((np.clip(img, 0, 1) * 255).astype(np.uint8)).save(im_path)
+
+
+def timed(timings, stage, repeats, func, *args, **kwargs):
+    """Runs func repeats times, stores the median wall time under timings[stage] and returns the last result."""
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    timings[stage] = statistics.median(times)
+    return result
+
+
+def curvature_stages(input_file, output_path, repeats):
+    timings = {}
+    filter_img, im_name = timed(timings, "filter_curv", repeats, image.filter_curv, input_file, output_path, False)
+    binary_img = timed(timings, "binarize_curv", repeats, image.binarize_curv, filter_img, im_name, output_path,
+                       False)
+    clean_img = timed(timings, "remove_particles", repeats, image.remove_particles, binary_img, output_path, im_name,
+                      minpixel=int(CURV_RESOLUTION / 2), prune=False, save_img=False)
+    skeleton_img = timed(timings, "skeletonize", repeats, image.skeletonize, clean_img, im_name, output_path, False)
+    pruned_img = timed(timings, "prune", repeats, image.prune, skeleton_img, im_name, output_path, False)
+    timed(timings, "analyze_all_curv", repeats, image.analyze_all_curv, pruned_img, im_name, output_path,
+          CURV_RESOLUTION, CURV_WINDOW, CURV_WINDOW_UNIT, False, False)
+    return timings
+
+
+def section_stages(input_file, output_path, repeats):
+    timings = {}
+    img, im_name = timed(timings, "imread", repeats, image.imread, input_file, use_skimage=True)
+    im_center = list(np.divide(img.shape, 2))
+    minpixel = SECTION_MINSIZE * SECTION_RESOLUTION
+    maxpixel = SECTION_MAXSIZE * SECTION_RESOLUTION
+    crop_im = timed(timings, "crop_section", repeats, image.crop_section, img, im_name, SECTION_RESOLUTION, minpixel,
+                    maxpixel, im_center)
+    timed(timings, "segment_section", repeats, image.segment_section, crop_im, im_name, SECTION_RESOLUTION, minpixel,
+          maxpixel, im_center)
+    return timings
+
+
+# runs a driver of the fibermorph package in another tree: python -c REFERENCE_DRIVER <package dir> <module> <args>
+REFERENCE_DRIVER = """
+import json, sys, warnings
+warnings.simplefilter("ignore")
+sys.path.insert(0, sys.argv[1])
+import image
+getattr(image, sys.argv[2])(*json.loads(sys.argv[3]))
+"""
+
+
+def run_driver(case, input_dir, output_dir, jobs, reference_tree=None):
+    """Runs the end-to-end driver of a case (of the fibermorph package in reference_tree if given) and returns its
+    wall time and summary rows."""
+    if case["module"] == "curvature":
+        driver_args = [jobs, CURV_RESOLUTION, CURV_WINDOW, CURV_WINDOW_UNIT, False, False]
+        pattern = "*/curvature_summary_data*.csv"
+    else:
+        driver_args = [jobs, SECTION_RESOLUTION, SECTION_MINSIZE, SECTION_MAXSIZE, False]
+        pattern = "*/summary_section_data.csv"
+    start = time.perf_counter()
+    if reference_tree is None:
+        getattr(image, case["module"])(input_dir, output_dir, *driver_args)
+    else:
+        driver_args = [str(input_dir), str(output_dir)] + driver_args
+        subprocess.run([sys.executable, "-c", REFERENCE_DRIVER, str(pathlib.Path(reference_tree, "fibermorph")),
+                        case["module"], json.dumps(driver_args)], check=True)
+    seconds = time.perf_counter() - start
+    summary = pd.read_csv(next(output_dir.glob(pattern)))
+    summary = summary.drop(columns=[c for c in summary.columns if c.startswith("Unnamed")]).set_index("ID")
+    return seconds, summary.sort_index()
+
+
+def summary_values(summary):
+    """Numeric summary columns as {image ID: {column: value}} (NaN as None)."""
+    numeric = summary.select_dtypes("number")
+    return {str(row_id): {col: (None if pd.isna(value) else float(value)) for col, value in row.items()}
+            for row_id, row in numeric.iterrows()}
+
+
+def compare(values, reference):
+    """Differences between the summary values of a run and a reference entry, as a list of messages."""
+    problems = []
+    rtol = reference["rtol"]
+    atol = reference.get("atol", rtol * 1e-3)
+    expected = reference["values"]
+    for row_id in sorted(set(expected) | set(values)):
+        if row_id not in values or row_id not in expected:
+            problems.append("{}: row only in {}".format(row_id, "reference" if row_id in expected else "this run"))
+            continue
+        for col, want in expected[row_id].items():
+            got = values[row_id].get(col)
+            if want is None or got is None:
+                if want is not got:
+                    problems.append("{} {}: {} (reference {})".format(row_id, col, got, want))
+            elif not np.isclose(got, want, rtol=rtol, atol=atol):
+                problems.append("{} {}: {:.6g} (reference {:.6g}, rtol {}, atol {})".format(row_id, col, got, want,
+                                                                                          rtol, atol))
+    return problems
+
+
+def git_commit(tree=BENCHMARK_DIR):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=tree, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine():
+    return {"host": platform.node(), "cores": os.cpu_count(), "processor": platform.processor(),
+            "python": platform.python_version(), "numpy": np.__version__}
+
+
+def read_history():
+    if not HISTORY_PATH.exists():
+        return []
+    with open(HISTORY_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_timings(history, this_machine, name):
+    """Timings of a case in the latest earlier run on the same machine, or None."""
+    for run in reversed(history):
+        same = all(run["machine"].get(k) == this_machine[k] for k in ["host", "cores"])
+        if same and name in run["cases"]:
+            return run["cases"][name]["timings"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="+", default=DEFAULT_CASES, choices=sorted(CASES),
+                        help="Cases to run. Default is {}.".format(" ".join(DEFAULT_CASES)))
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Runs per stage. Default is 3.")
+    parser.add_argument("--jobs", type=int, default=1, help="Cores for the end-to-end drivers. Default is 1.")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="Slowdown relative to the previous run reported as a regression. Default is 0.2.")
+    parser.add_argument("--fail_on_regression", action="store_true", help="Exit with 1 when a timing regressed.")
+    parser.add_argument("--update_reference", action="store_true",
+                        help="Store this run's outputs as the reference for the cases run.")
+    parser.add_argument("--reference_tree", type=pathlib.Path,
+                        help="With --update_reference, a checkout of fibermorph (e.g. a git worktree of the baseline "
+                             "commit) whose drivers produce the reference outputs instead of this tree's.")
+    parser.add_argument("--rtol", type=float, default=RTOL,
+                        help="With --update_reference, relative tolerance of the new entries. Default is 0.001.")
+    parser.add_argument("--atol", type=float,
+                        help="With --update_reference, absolute tolerance of the new entries. Default is rtol/1000.")
+    parser.add_argument("--no_history", action="store_true", help="Don't append this run to the history.")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    history = read_history()
+    this_machine = machine()
+    reference = json.loads(REFERENCE_PATH.read_text()) if REFERENCE_PATH.exists() else {}
+    run = {"date": datetime.datetime.now().isoformat(timespec="seconds"), "version": __version__,
+           "commit": git_commit(), "machine": this_machine, "jobs": args.jobs, "repeats": args.repeats, "cases": {}}
+    failed = regressed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        for name in args.cases:
+            case = CASES[name]
+            files = generate(name, case, tmp.joinpath(name, "input"))
+            stage_dir = tmp.joinpath(name, "stages")
+            stage_dir.mkdir()
+            # the stage functions and drivers print progress; only the benchmark's own lines are kept
+            with quiet():
+                stages = curvature_stages if case["module"] == "curvature" else section_stages
+                timings = stages(files[0], stage_dir, args.repeats)
+                output_dir = tmp.joinpath(name, "output")
+                output_dir.mkdir()
+                timings["driver"], summary = run_driver(case, tmp.joinpath(name, "input"), output_dir, args.jobs)
+            values = summary_values(summary)
+            run["cases"][name] = {"params": case, "timings": timings}
+
+            previous = previous_timings(history, this_machine, name)
+            print("\n{} ({} image(s) of {}x{})".format(name, case["images"], case["width"], case["height"]))
+            for stage, seconds in timings.items():
+                line = "  {:<18} {:8.3f} s".format(stage, seconds)
+                if previous is not None and previous.get(stage):
+                    change = seconds / previous[stage] - 1
+                    line += "  {:+6.1%}".format(change)
+                    if change > args.threshold:
+                        line += "  REGRESSION"
+                        regressed = True
+                print(line)
+
+            if args.update_reference:
+                if args.reference_tree is not None:
+                    output_dir = tmp.joinpath(name, "reference")
+                    output_dir.mkdir()
+                    with quiet():
+                        seconds, summary = run_driver(case, tmp.joinpath(name, "input"), output_dir, args.jobs,
+                                                      args.reference_tree)
+                    values = summary_values(summary)
+                    commit = git_commit(args.reference_tree)
+                else:
+                    commit = run["commit"]
+                reference[name] = {"version": __version__, "commit": commit, "rtol": args.rtol, "values": values}
+                if args.atol is not None:
+                    reference[name]["atol"] = args.atol
+                print("  outputs of {} stored as the reference".format(commit))
+            elif name in reference:
+                problems = compare(values, reference[name])
+                run["cases"][name]["outputs_ok"] = not problems
+                for problem in problems:
+                    print("  OUT OF TOLERANCE " + problem)
+                if problems:
+                    failed = True
+                else:
+                    print("  outputs within rtol {} of the reference ({})".format(reference[name]["rtol"],
+                                                                                 reference[name]["commit"]))
+            else:
+                print("  no reference outputs for this case (see --update_reference)")
+
+    if args.update_reference:
+        REFERENCE_PATH.write_text(json.dumps(reference, indent=1, sort_keys=True) + "\n")
+    if not args.no_history:
+        with open(HISTORY_PATH, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
+    sys.exit(1 if failed or (regressed and args.fail_on_regression) else 0)
+
+
+if __name__ == "__main__":
+    main()
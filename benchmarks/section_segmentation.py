@@ -0,0 +1,91 @@
+"""
+Speed and accuracy of the section segmentation engines on simulated sections.
+
+Images are generated like the section cases of pipelines.py (analysis.sim_ellipse draws one elliptical section of
+known size per image, which is then blurred and made noisy), with a fixed seed. Each image is cropped once with
+crop_section, and segment_section runs on the crop with each engine (median wall time of --repeats runs). Its area,
+minimum and maximum diameters and eccentricity are compared with the true values of the ellipse; the table reports
+the median time per section and the mean and largest absolute relative errors over the images.
+
+Usage: python benchmarks/section_segmentation.py [--images N] [--size small|full] [--repeats N]
+"""
+
+import argparse
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR))
+
+from pipelines import CASES, SECTION_MAXSIZE, SECTION_MINSIZE, SECTION_RESOLUTION, generate, quiet  # noqa: E402
+import image  # noqa: E402
+from section_segmentation import SEGMENTERS  # noqa: E402
+
+REPEATS = 3
+IMAGES = 10
+
+# measured columns and the ground truth columns of sim_ellipse they are compared with
+MEASURES = {"area": "area", "min": "ref_min_diam", "max": "ref_max_diam", "eccentricity": "eccentricity"}
+
+
+def measure(files, repeats):
+    """Times and measurements of every engine on every image, one row per image and engine."""
+    rows = []
+    minpixel = SECTION_MINSIZE * SECTION_RESOLUTION
+    maxpixel = SECTION_MAXSIZE * SECTION_RESOLUTION
+    for input_file in files:
+        truth = pd.read_csv(input_file.with_suffix(".csv")).iloc[0]
+        img, im_name = image.imread(input_file, use_skimage=True)
+        im_center = list(np.divide(img.shape, 2))
+        crop_im = image.crop_section(img, im_name, SECTION_RESOLUTION, minpixel, maxpixel, im_center)
+        for segmenter in SEGMENTERS:
+            times = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                section_data, bin_im = image.segment_section(crop_im, im_name, SECTION_RESOLUTION, minpixel,
+                                                             maxpixel, im_center, segmenter)
+                times.append(time.perf_counter() - start)
+            row = {"image": input_file.stem, "segmenter": segmenter, "seconds": statistics.median(times)}
+            for column, true_column in MEASURES.items():
+                true_value = float(truth[true_column])
+                row[column + "_error"] = (float(section_data[column].iloc[0]) - true_value) / true_value
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=IMAGES, help="Number of sections. Default is 10.")
+    parser.add_argument("--size", choices=["small", "full"], default="small",
+                        help="Image size of the pipelines.py case section_<size>. Default is small.")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Runs per engine and image. Default is 3.")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    name = "section_" + args.size
+    case = dict(CASES[name], images=args.images)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = generate(name, case, pathlib.Path(tmp).joinpath("input"))
+        with quiet():
+            df = measure(files, args.repeats)
+
+    print("{} section(s) of {}x{}".format(case["images"], case["width"], case["height"]))
+    print("  {:<10} {:>10}  {}".format("segmenter", "s/section",
+                                       "  ".join("{:>20}".format(column + " error") for column in MEASURES)))
+    for segmenter, group in df.groupby("segmenter", sort=False):
+        errors = []
+        for column in MEASURES:
+            error = group[column + "_error"].abs()
+            errors.append("{:>7.3%} (max {:>6.2%})".format(error.mean(), error.max()))
+        print("  {:<10} {:>10.3f}  {}".format(segmenter, group["seconds"].median(), "  ".join(errors)))
+
+
+if __name__ == "__main__":
+    main()
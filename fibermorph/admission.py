@@ -0,0 +1,235 @@
+"""
+Memory-aware admission of images to the parallel workers.
+
+--jobs fixes how many images run at once, but their memory use depends on their size: a 5200x3900 image peaks at
+about 2.7 GB in the skimage Frangi filter, while a section image needs a few hundred MB. With --memory_limit, each
+image's peak is estimated before the run from its dimensions, which are read from the file header without decoding
+the pixels, and the per-pixel peaks of the stages it goes through (STAGE_BYTES_PER_PIXEL, measured with tracemalloc
+on the stages as they are implemented in image.py, plus WORKER_BYTES for the worker's interpreter and libraries).
+
+A worker asks a MemoryGate (served by a multiprocessing manager, so all workers share it) for its image's estimate
+before starting it, and gives it back when the image is done. The gate admits an image when the estimates of the
+images running plus its own fit in the limit and the system reports that much memory available, so under pressure
+fewer images run at once instead of the run being killed. An image larger than the limit on its own waits until it can
+run alone. Images are handed out largest first, so the small ones fill in around the big ones, and the number of
+worker processes is capped at the number of the smallest images that fit together. An image that still raises
+MemoryError is retried once alone.
+"""
+
+import multiprocessing.managers
+import os
+import threading
+
+from PIL import Image
+
+# peak bytes per pixel of each stage, including the arrays of earlier stages still alive at that point
+STAGE_BYTES_PER_PIXEL = {
+    "filter_frangi": 132,
+    "filter_frangi32": 30,
+    "binarize": 27,
+    "remove_particles": 14,
+    "skeletonize": 13,
+    "prune": 16,
+    "analyze_curv": 7,
+    "section": 22,
+}
+
+# memory of a worker process before it loads an image
+WORKER_BYTES = 256 * 2 ** 20
+
+# seconds between checks of the available memory while a worker waits for admission
+POLL_INTERVAL = 1.0
+
+
+def image_pixels(input_file):
+    """Number of pixels of an image, read from its header without decoding it.
+
+    Falls back to the file size (one byte per pixel) for files PIL can't identify.
+    """
+    try:
+        with Image.open(input_file) as im:
+            width, height = im.size
+            return width * height * len(im.getbands())
+    except (OSError, ValueError):
+        return os.path.getsize(input_file)
+
+
+def stages(module, ridge_filter="frangi"):
+    """Names of the stages an image goes through in a module (keys of STAGE_BYTES_PER_PIXEL)."""
+    if module == "curvature":
+        return ["filter_" + ridge_filter, "binarize", "remove_particles", "skeletonize", "prune", "analyze_curv"]
+    if module == "section":
+        return ["section"]
+    raise ValueError("Unknown module: {!r}".format(module))
+
+
+def estimate_peak(input_file, module, ridge_filter="frangi"):
+    """Estimated peak memory in bytes of analyzing one image: the largest stage peak plus the worker itself."""
+    bytes_per_pixel = max(STAGE_BYTES_PER_PIXEL[stage] for stage in stages(module, ridge_filter))
+    return image_pixels(input_file) * bytes_per_pixel + WORKER_BYTES
+
+
+def available_memory():
+    """Memory available to new allocations in bytes (MemAvailable in /proc/meminfo), or None where unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryGate(object):
+    """Shared account of the memory reserved by running images.
+
+    Parameters
+    ----------
+    limit : int
+        Number of bytes that may be reserved at once.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        if self.reserved == 0:
+            # nothing else running: an image larger than the limit runs alone
+            return True
+        available = available_memory()
+        return self.reserved + nbytes <= self.limit and (available is None or nbytes <= available)
+
+    def acquire(self, nbytes, alone=False):
+        """Blocks until nbytes can be reserved and reserves them (at most the whole limit, all of it when alone)."""
+        nbytes = self.limit if alone else min(nbytes, self.limit)
+        with self.condition:
+            while not self._fits(nbytes):
+                # the available memory is polled, as it also changes outside the run
+                self.condition.wait(POLL_INTERVAL)
+            self.reserved += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        """Returns nbytes reserved by acquire."""
+        with self.condition:
+            self.reserved -= nbytes
+            self.condition.notify_all()
+
+
+class _GateManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+_GateManager.register("MemoryGate", MemoryGate)
+
+
+def admitted(gate, nbytes, func, *args, **kwargs):
+    """Runs func(*args, **kwargs) once the gate admits nbytes, retrying it alone after a MemoryError.
+
+    Parameters
+    ----------
+    gate : MemoryGate (or proxy) or None
+        Gate shared by the workers; None runs func right away.
+    nbytes : int
+        Estimated peak memory of the task.
+    func : callable
+        The task.
+
+    """
+    if gate is None:
+        return func(*args, **kwargs)
+    for retry in (False, True):
+        # the retry reserves the whole limit, so nothing else is admitted alongside it
+        granted = gate.acquire(nbytes, alone=retry)
+        try:
+            return func(*args, **kwargs)
+        except MemoryError:
+            if retry:
+                raise
+        finally:
+            gate.release(granted)
+
+
+class MemoryBudget(object):
+    """Estimated peak memory of each image and admission of the images within a memory limit.
+
+    Used as a context manager around the joblib call: it serves the gate the workers share.
+
+    Parameters
+    ----------
+    file_list : list
+        Images to analyze.
+    limit : int or None
+        Memory limit in bytes; None (default) admits every image right away.
+    module : str
+        "curvature" or "section".
+    ridge_filter : str
+        Ridge filter of the curvature module.
+
+    """
+
+    def __init__(self, file_list, limit=None, module="curvature", ridge_filter="frangi"):
+        if limit is not None and limit <= 0:
+            raise ValueError("The memory limit must be positive, not {!r}".format(limit))
+        self.limit = limit
+        self.needs = {} if limit is None else {f: estimate_peak(f, module, ridge_filter) for f in file_list}
+        self.gate = None
+        self._manager = None
+
+    @property
+    def max_workers(self):
+        """Number of images that can run at once within the limit (the smallest ones), or None without a limit."""
+        if self.limit is None:
+            return None
+        total = count = 0
+        for need in sorted(self.needs.values()):
+            total += need
+            if total > self.limit:
+                break
+            count += 1
+        return max(1, count)
+
+    def order(self, file_list):
+        """The images largest first, so smaller ones are admitted around the large ones."""
+        if self.limit is None:
+            return list(file_list)
+        return sorted(file_list, key=lambda f: self.needs[f], reverse=True)
+
+    def need(self, input_file):
+        """Estimated peak memory of an image in bytes (0 without a limit)."""
+        return self.needs.get(input_file, 0)
+
+    def __enter__(self):
+        if self.limit is not None:
+            self._manager = _GateManager()
+            self._manager.start()
+            self.gate = self._manager.MemoryGate(self.limit)
+        return self
+
+    def __exit__(self, *exc):
+        self.gate = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def report(self):
+        """The limit and estimates as a dict for the run report."""
+        needs = list(self.needs.values())
+        return {"limit": self.limit, "max_workers": self.max_workers, "largest_estimate": max(needs, default=None),
+                "over_limit": sum(need > self.limit for need in needs) if self.limit is not None else 0}
+
+    def describe(self):
+        """One-line summary for the console."""
+        if self.limit is None:
+            return "no limit"
+        gb = 2 ** 30
+        text = "{:.1f} GB limit, largest image ~{:.1f} GB, up to {} at once".format(
+            self.limit / gb, max(self.needs.values(), default=0) / gb, self.max_workers)
+        over = self.report()["over_limit"]
+        if over:
+            text += ", {} image(s) over the limit run alone".format(over)
+        return text
@@ -8,23 +8,23 @@ from timeit import default_timer as timer
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.spatial import ConvexHull
-from shapely import geometry
+from sympy import geometry
 import sympy
 from skimage import draw
+from PIL import Image
 from joblib import Parallel, delayed
 
 #sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 #sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import common
-from common import make_subdirectory
+from common import get_logger, make_subdirectory
 from utils import create_results_cache, get_data
 from dummy_data import dummy_data_gen
-print("Before importing from image.py")
 from image import curvature, curvature_seq, section
-print("After importing from image.py")
+
+logger = get_logger(__name__)
 
 
 def validation_curv(output_location, repeats, window_size_px, resolution=1):
@@ -53,7 +53,7 @@ def validation_curv(output_location, repeats, window_size_px, resolution=1):
             width=10)
 
         valid_df = pd.DataFrame(df).sort_values(by=['ref_length'], ignore_index=True).reset_index(drop=True)
-        print("Running curvature_seq function")
+        logger.info("Running curvature_seq function")
         test_df = curvature_seq(im_path, output_path, resolution, window_size_px, window_unit="px", save_img=False, test=True, within_element=False)
 
         test_df2 = pd.DataFrame(test_df).sort_values(by=['length'], ignore_index=True).reset_index(drop=True)
@@ -97,11 +97,6 @@ def sim_ellipse(output_directory, im_width_px, im_height_px, min_diam_um, max_di
     min_rad_um = min_diam_um / 2
     max_rad_um = max_diam_um / 2
     
-    # image size in inches
-    im_width_inch = (im_width_px / px_per_um) / um_per_inch
-    im_height_inch = (im_height_px / px_per_um) / um_per_inch
-    
-    imsize_inch = im_height_inch, im_width_inch
     imsize_px = im_height_px, im_width_px
     
     min_rad_px = min_rad_um * px_per_um
@@ -115,17 +110,10 @@ def sim_ellipse(output_directory, im_width_px, im_height_px, min_diam_um, max_di
                           rotation=np.deg2rad(angle_deg))
     img[rr, cc] = 0
     
-    fig = plt.figure(frameon=False)
-    fig.set_size_inches(im_width_inch, im_height_inch)
-    ax = plt.Axes(fig, [0, 0, 1, 1])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    
     p1 = geometry.Point((im_height_px / px_per_um) / 2, (im_width_px / px_per_um) / 2)
     e1 = geometry.Ellipse(p1, hradius=max_rad_um, vradius=min_rad_um)
     area = sympy.N(e1.area)
     eccentricity = e1.eccentricity
-    ax.imshow(img, cmap="gray", aspect='auto')
     
     jetzt = datetime.now()
     timestamp = jetzt.strftime("%b%d_%H%M_%S_%f")
@@ -142,10 +130,8 @@ def sim_ellipse(output_directory, im_width_px, im_height_px, min_diam_um, max_di
     
     df.to_csv(df_path)
     
-    plt.ioff()
-    fig.savefig(fname=im_path, dpi=dpi)
-    plt.cla()
-    plt.close()
+    # written as it is: rendering through a matplotlib figure at this dpi runs out of memory
+    Image.fromarray(img * 255).save(im_path, dpi=(dpi, dpi))
     
     return df
 
@@ -217,7 +203,7 @@ def real_curv(path):
     
     curvature(input_directory, output_dir, jobs=1, resolution=132, window_size=0.5, window_unit="mm", save_img=True, within_element=False)
     
-    tqdm.write("\n\nDemo data for fibermorph curvature are in {}\n\nDemo results are in {}\n\n".format(input_directory, output_dir))
+    logger.info("Demo data for fibermorph curvature are in %s\nDemo results are in %s", input_directory, output_dir)
 
     return True
 
@@ -244,7 +230,7 @@ def real_section(path):
 
     section(input_directory, output_dir, jobs=4, resolution=1.06, minsize=20, maxsize=150, save_img=True)
     
-    tqdm.write("\n\nDemo data for fibermorph section are in {}\n\nDemo results are in {}\n\n".format(input_directory, output_dir))
+    logger.info("Demo data for fibermorph section are in %s\nDemo results are in %s", input_directory, output_dir)
 
     return True
 
@@ -261,7 +247,7 @@ def dummy_curv(path, repeats=1, window_size_px=10):
     
     output_dir = validation_curv(create_results_cache(path), repeats, window_size_px)
     
-    tqdm.write("\n\nValidation data and error analyses for fibermorph curvature are saved in:\n{}\n\n".format(output_dir))
+    logger.info("Validation data and error analyses for fibermorph curvature are saved in: %s", output_dir)
 
     return True
 
@@ -278,6 +264,6 @@ def dummy_section(path, repeats=1):
     
     output_dir = validation_section(create_results_cache(path), repeats)
     
-    tqdm.write("\n\nValidation data and error analyses for fibermorph section are saved in:\n{}\n\n".format(output_dir))
+    logger.info("Validation data and error analyses for fibermorph section are saved in: %s", output_dir)
 
     return True
\ No newline at end of file
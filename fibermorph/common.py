@@ -1,12 +1,95 @@
 import pathlib
 import contextlib
 import joblib
+import logging
 from tqdm import tqdm
 from functools import wraps
 import os
 import sys
 import timeit
 
+# parent of the loggers of all fibermorph modules (see get_logger)
+LOGGER_NAME = "fibermorph"
+
+# name of the console handler setup_logging adds to it
+HANDLER_NAME = "fibermorph-console"
+
+# console verbosity (-q, default, -v) and the level of the messages it shows
+VERBOSITY_LEVELS = {-1: logging.WARNING, 0: logging.INFO, 1: logging.DEBUG}
+
+
+class TqdmHandler(logging.StreamHandler):
+    """Logging handler that writes through tqdm, so messages don't break the progress bars (on stderr, which keeps
+    stdout free for --ndjson)."""
+
+    def __init__(self):
+        super().__init__(sys.stderr)
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record), file=sys.stderr)
+        except Exception:
+            self.handleError(record)
+
+
+def get_logger(name):
+    """Logger of a fibermorph module, e.g. get_logger(__name__) in image.py gives "fibermorph.image".
+
+    The modules are imported both flat (from the scripts) and from the package, so only the last part of the module
+    name is used.
+    """
+    return logging.getLogger("{}.{}".format(LOGGER_NAME, name.rsplit(".", 1)[-1]))
+
+
+def setup_logging(verbosity=0):
+    """Sends the messages of the fibermorph loggers at the level of a verbosity to the console.
+
+    Parameters
+    ----------
+    verbosity : int
+        -1 (or less) for warnings only, 0 (default) for progress messages, 1 (or more) for debugging messages.
+
+    Returns
+    -------
+    int
+        The logging level.
+
+    """
+    level = VERBOSITY_LEVELS[max(-1, min(1, verbosity))]
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    # found by name, as the modules may be imported twice (flat and from the package)
+    if not any(handler.get_name() == HANDLER_NAME for handler in logger.handlers):
+        handler = TqdmHandler()
+        handler.set_name(HANDLER_NAME)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        # the messages aren't repeated by handlers an application may have on the root logger
+        logger.propagate = False
+    return level
+
+
+def log_level():
+    """Level of the fibermorph loggers in this process, to hand to logged() in worker processes."""
+    return logging.getLogger(LOGGER_NAME).getEffectiveLevel()
+
+
+def logged(level, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) with the fibermorph loggers of this (worker) process at a level.
+
+    Worker processes don't inherit the logging setup of the main process, so the parallel drivers wrap their tasks in
+    this with the level from log_level().
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if logger.level != level or not any(handler.get_name() == HANDLER_NAME for handler in logger.handlers):
+        setup_logging()
+        logger.setLevel(level)
+    return func(*args, **kwargs)
+
+
+logger = get_logger(__name__)
+
+
 def convert(seconds):
     """Converts seconds into readable format (hours, mins, seconds).
 
@@ -28,33 +111,18 @@ def convert(seconds):
 def timing(f): # is this code used elsewhere
     @wraps(f)
     def wrap(*args, **kw):
-        print("\n\nThe {} function is currently running...\n\n".format(f.__name__))
+        logger.debug("The %s function is currently running...", f.__name__)
         ts = timeit.default_timer()
         result = f(*args, **kw)
         te = timeit.default_timer()
         total_time = convert(te - ts)
-        print(
-            '\n\nThe function: {} \n\n with args:[{},\n{}] \n\n and result: {} \n\nTotal time: {}\n\n'.format(
-                f.__name__, args, kw, result, total_time))
+        logger.debug("The function: %s with args:[%s, %s] and result: %s. Total time: %s", f.__name__, args, kw,
+                     result, total_time)
         return result
     
     return wrap
 
-def blockPrint(f):
-    @wraps(f)
-    def wrap(*args, **kw):
-        # block all printing to the console
-        sys.stdout = open(os.devnull, 'w')
-        # call the method in question
-        value = f(*args, **kw)
-        # enable all printing to the console
-        sys.stdout = sys.__stdout__
-        # pass the return value of the method back
-        return value
-    return wrap
-
 
-@blockPrint
 def make_subdirectory(directory, append_name=""):
     """Makes subdirectories.
 
@@ -82,24 +150,21 @@ def make_subdirectory(directory, append_name=""):
     # Use pathlib to see if the output path exists, if it is there it returns True
     if pathlib.Path(output_path).exists() == False:
         
-        # Prints a status method to the console using the format option, which fills in the {} with whatever
-        # is in the ().
-        print(
-            "This output path doesn't exist:\n            {} \n Creating...".format(
-                output_path))
+        # Logs a status message (shown with --verbose), filling in the %s with the path.
+        logger.debug("This output path doesn't exist: %s. Creating...", output_path)
         
         # Use pathlib to create the folder.
         pathlib.Path.mkdir(output_path, parents=True, exist_ok=True)
         
-        # Prints a status to let you know that the folder has been created
-        print("Output path has been created")
+        # Logs a status to let you know that the folder has been created
+        logger.debug("Output path has been created")
     
-    # Since it's a boolean return, and True is the only other option we will simply print the output.
+    # Since it's a boolean return, and True is the only other option we will simply log the output.
     else:
-        # This will print exactly what you tell it, including the space. The backslash n means new line.
-        print("Output path already exists:\n               {}".format(
-                output_path))
+        logger.debug("Output path already exists: %s", output_path)
     return output_path
+
+
 @contextlib.contextmanager
 def tqdm_joblib(tqdm_object):
     """Context manager to patch joblib to report into tqdm progress bar given as argument"""
@@ -0,0 +1,156 @@
+"""
+Splitting the --jobs cores between image workers and the threads inside each worker.
+
+--jobs is the total number of cores a run may use. Images are analyzed by up to that many worker processes, one image
+each; when there are fewer images than cores, the cores left over go to threads within each worker. The same number
+caps both the tile threads (see tiling) and the native thread pools of BLAS/OpenMP libraries in the worker (through
+joblib's inner_max_num_threads, and threadpoolctl when the images run in the main process), so workers x threads never
+exceeds the budget.
+
+Workers can also be pinned: with pin="core" each worker process is bound to its own block of cores, with
+pin="numa" to the cores of one NUMA node (round-robin over the nodes). Cores are ordered by NUMA node, so core blocks
+don't straddle nodes when the block size divides the node size. Pinning needs os.sched_setaffinity (Linux).
+"""
+
+import contextlib
+import glob
+import multiprocessing
+import os
+import queue
+import re
+
+from joblib import delayed, effective_n_jobs, parallel_config
+from threadpoolctl import threadpool_limits
+
+from tiling import choose_tile_workers
+
+PIN_MODES = ["core", "numa"]
+
+# pid of the process once it has pinned itself (see run_task)
+_pinned_pid = None
+
+
+def parse_cpulist(cpulist):
+    """Core ids of a Linux cpulist string such as "0-3,8-11"."""
+    cores = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        bounds = [int(i) for i in part.split("-")]
+        cores.extend(range(bounds[0], bounds[-1] + 1))
+    return cores
+
+
+def numa_nodes():
+    """Lists the cores of each NUMA node available to this process (a single node where that is unknown)."""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            node = [core for core in parse_cpulist(f.read()) if core in available]
+        if node:
+            nodes.append(node)
+    if not nodes or sum(len(node) for node in nodes) != len(available):
+        nodes = [available]
+    return nodes
+
+
+def run_task(slots, func, *args, **kwargs):
+    """Runs a task in a worker, pinning the worker process first if core sets are being handed out.
+
+    Parameters
+    ----------
+    slots : queue-like or None
+        Shared queue of core sets; the first task in each worker process takes one and pins the process to it.
+    func : callable
+        The task.
+
+    """
+    global _pinned_pid
+    if slots is not None and _pinned_pid != os.getpid():
+        try:
+            cores = slots.get_nowait()
+        except queue.Empty:
+            # a replacement worker after the sets have been handed out stays unpinned
+            cores = None
+        if cores:
+            os.sched_setaffinity(0, cores)
+        _pinned_pid = os.getpid()
+    return func(*args, **kwargs)
+
+
+class CoreBudget(object):
+    """Split of the --jobs cores between worker processes and threads per worker.
+
+    Used as a context manager around the joblib call: it applies the thread limits and, when pinning, serves the core
+    sets to the workers.
+
+    Parameters
+    ----------
+    num_tasks : int
+        Number of images to analyze.
+    jobs : int
+        Number of cores (joblib convention, -1 for all cores).
+    pin : str or None
+        "core" or "numa" to pin each worker process; None (default) leaves scheduling to the OS.
+    max_workers : int or None
+        Cap on the number of worker processes (e.g. from the memory limit, see admission); the cores they leave go to
+        threads within each worker. None (default) for no cap.
+
+    """
+
+    def __init__(self, num_tasks, jobs, pin=None, max_workers=None):
+        if pin is not None and pin not in PIN_MODES:
+            raise ValueError("pin must be one of {} or None, not {!r}".format(PIN_MODES, pin))
+        self.cores = effective_n_jobs(jobs)
+        self.workers = max(1, min(self.cores, num_tasks, max_workers or num_tasks))
+        self.threads = choose_tile_workers(self.workers, jobs)
+        # with a single worker the images run in this process, which isn't pinned
+        self.pin = pin if self.workers > 1 and hasattr(os, "sched_setaffinity") else None
+        self.core_sets = self._core_sets() if self.pin else None
+        self.slots = None
+        self._stack = None
+
+    def _core_sets(self):
+        nodes = numa_nodes()
+        if self.pin == "numa":
+            return [nodes[i % len(nodes)] for i in range(self.workers)]
+        ordered = [core for node in nodes for core in node]
+        # budgets larger than the machine wrap around its cores
+        return [sorted({ordered[(i * self.threads + j) % len(ordered)] for j in range(self.threads)})
+                for i in range(self.workers)]
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        # native thread pools of this process, for images analyzed in it (single worker)
+        self._stack.enter_context(threadpool_limits(limits=self.threads))
+        if self.workers > 1:
+            # and of the worker processes
+            self._stack.enter_context(parallel_config(backend="loky", inner_max_num_threads=self.threads))
+        if self.pin:
+            manager = self._stack.enter_context(multiprocessing.Manager())
+            self.slots = manager.Queue()
+            for cores in self.core_sets:
+                self.slots.put(cores)
+        return self
+
+    def __exit__(self, *exc):
+        self.slots = None
+        self._stack.close()
+
+    def task(self, func, *args, **kwargs):
+        """joblib delayed call of func(*args, **kwargs) that pins its worker when pinning is on."""
+        return delayed(run_task)(self.slots, func, *args, **kwargs)
+
+    def report(self):
+        """The split as a dict for the run report."""
+        return {"cores": self.cores, "workers": self.workers, "threads_per_worker": self.threads, "pin": self.pin,
+                "core_sets": self.core_sets}
+
+    def describe(self):
+        """One-line summary of the split for the console."""
+        text = "{} cores: {} worker(s) x {} thread(s)".format(self.cores, self.workers, self.threads)
+        if self.pin:
+            text += ", pinned per {}".format(self.pin)
+        return text
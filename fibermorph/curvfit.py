@@ -0,0 +1,244 @@
+"""
+Batched curvature fitting for the sliding windows of a single element.
+
+The Taubin fit in image.taubin_curv takes the right singular vector belonging to the smallest singular value of the
+n x 3 matrix [z0, x, y]. That vector is also the eigenvector belonging to the smallest eigenvalue of the 3 x 3 normal
+matrix Z^T Z, so every window of an element can be fitted at once by stacking the normal matrices and handing them to
+a single batched np.linalg.eigh call. The normal matrices only depend on the moments of the window's coordinates up to
+fourth order, which a MomentTable of running sums gives for any window in constant time.
+
+The curvatures returned here agree with taubin_curv to within a relative tolerance of 1e-8 (CURV_RTOL); windows that
+taubin_curv reports as 0 (infinite radius or curvature below 0.00001) are also reported as 0.
+"""
+
+from math import comb
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Relative tolerance between taubin_curv_windows and a per-window image.taubin_curv loop
+CURV_RTOL = 1e-8
+
+# (p, q) exponents of the raw moments sum(x**p * y**q) kept in a MomentTable
+MOMENT_POWERS = [(p, q) for p in range(5) for q in range(5 - p)]
+MOMENT_INDEX = {pq: col for col, pq in enumerate(MOMENT_POWERS)}
+
+
+def window_bounds(pixel_length, window_size_px):
+    """Gives the number of pixels per window and the number of windows for an element, following image.subset_gen.
+
+    Parameters
+    ----------
+    pixel_length : int
+        Number of pixels in input curve/line.
+    window_size_px : int
+        The size of window of measurement. Windows under 10 pixels fall back to the whole element.
+
+    Returns
+    -------
+    tuple
+        The window length in pixels and the number of windows (0 if the element is shorter than the window).
+
+    """
+    if window_size_px >= 10:
+        window = int(window_size_px)
+    else:
+        window = int(pixel_length)
+    num_windows = max(int(pixel_length) - window + 1, 0) if window > 0 else 0
+    return window, num_windows
+
+
+def _shift_moments(sums, a, b):
+    """Re-expresses raw moment sums about a new origin (a, b) with the binomial theorem.
+
+    Parameters
+    ----------
+    sums : np.ndarray
+        Array of shape (k, len(MOMENT_POWERS)) with sum(x**p * y**q) for each window.
+    a, b : np.ndarray
+        Arrays of shape (k,) with the new origin for each window.
+
+    Returns
+    -------
+    np.ndarray
+        Array like `sums` with sum((x - a)**p * (y - b)**q) for each window.
+
+    """
+    shifted = np.zeros_like(sums)
+    for (p, q), col in MOMENT_INDEX.items():
+        for i in range(p + 1):
+            for j in range(q + 1):
+                coef = comb(p, i) * comb(q, j)
+                shifted[:, col] += coef * (-a) ** (p - i) * (-b) ** (q - j) * sums[:, MOMENT_INDEX[(i, j)]]
+    return shifted
+
+
+class MomentTable(object):
+    """Cumulative moment sums along the ordered coordinates of one element.
+
+    Built once per element in O(length); the raw moments sum(x**p * y**q), p + q <= 4, of any window are then the
+    difference of two rows, which is all the Taubin normal matrix needs. Pixel coordinates are summed as int64 so
+    that window moments are exact (wrap-around in the running sums cancels in the difference) and re-centred on a
+    pixel of the window before they are converted to float; this avoids the cancellation a float running sum would
+    suffer on a 5200 x 3900 image. Windows too large for int64 fall back to float64 running sums, and non-integer
+    coordinates are summed window by window.
+
+    Parameters
+    ----------
+    coords : np.ndarray or list
+        Ordered [[x_1, y_1], [x_2, y_2], ...] coordinates of the element.
+
+    """
+    
+    def __init__(self, coords):
+        xy = np.asarray(coords).reshape(-1, 2)
+        self.length = len(xy)
+        self.integral = bool(np.issubdtype(xy.dtype, np.integer) or np.all(np.mod(xy, 1) == 0))
+        self.extent = int(np.ptp(xy, axis=0).max()) + 1 if self.length else 0
+        
+        self.origin = xy.min(axis=0) if self.length else np.zeros(2)
+        dtype = np.int64 if self.integral else float
+        self.coords = (xy - self.origin).astype(dtype)
+        
+        self.prefix = self._running_sums(self.coords)
+    
+    @staticmethod
+    def _running_sums(coords):
+        x = coords[:, 0]
+        y = coords[:, 1]
+        terms = np.stack([x ** p * y ** q for p, q in MOMENT_POWERS], axis=1)
+        prefix = np.zeros((len(coords) + 1, len(MOMENT_POWERS)), dtype=coords.dtype)
+        np.cumsum(terms, axis=0, out=prefix[1:])
+        return prefix
+    
+    def exact(self, window):
+        """True if window moments about a window pixel are guaranteed to fit in int64."""
+        return self.integral and window * float(self.extent) ** 4 < 2. ** 62
+    
+    def window_central_moments(self, window):
+        """Central moments of every window of length `window`, in MOMENT_POWERS column order."""
+        num_windows = self.length - window + 1
+        if not self.integral:
+            # float running sums cancel badly over small windows, so sum each window directly
+            xs = sliding_window_view(self.coords[:, 0], window)
+            ys = sliding_window_view(self.coords[:, 1], window)
+            x = xs - xs.mean(axis=1, keepdims=True)
+            y = ys - ys.mean(axis=1, keepdims=True)
+            return np.stack([(x ** p * y ** q).sum(axis=1) for p, q in MOMENT_POWERS], axis=1)
+        
+        anchor = self.coords[np.arange(num_windows) + window // 2]
+        if self.exact(window):
+            prefix = self.prefix
+        else:
+            # the int64 running sums may have wrapped by more than the window can absorb; windows this large spread
+            # wide enough for float64 sums
+            anchor = anchor.astype(float)
+            prefix = self._running_sums(self.coords.astype(float))
+        sums = prefix[window:] - prefix[:num_windows]
+        
+        # move each window's origin onto one of its own pixels, exactly when the sums are integers
+        sums = _shift_moments(sums, anchor[:, 0], anchor[:, 1]).astype(float)
+        
+        # then onto the window centroid
+        x_mean = sums[:, MOMENT_INDEX[(1, 0)]] / window
+        y_mean = sums[:, MOMENT_INDEX[(0, 1)]] / window
+        return _shift_moments(sums, x_mean, y_mean)
+    
+    def window_normal_matrices(self, window):
+        """Builds the Taubin normal matrix for every window of length `window` along the element.
+
+        Returns
+        -------
+        normal : np.ndarray
+            Array of shape (length - window + 1, 3, 3) with Z^T Z for each window, Z being the [z0, x, y] design
+            matrix of taubin_curv.
+        zmean : np.ndarray
+            Array of shape (length - window + 1,) with the mean squared distance to the window centroid.
+
+        """
+        mu = self.window_central_moments(window)
+        m = lambda p, q: mu[:, MOMENT_INDEX[(p, q)]]
+        
+        zmean = (m(2, 0) + m(0, 2)) / window
+        normal = np.empty((len(zmean), 3, 3))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # z = x^2 + y^2 and z0 = (z - zmean) / (2 * sqrt(zmean)) on centred coordinates
+            z_sq = m(4, 0) + 2 * m(2, 2) + m(0, 4)
+            normal[:, 0, 0] = (z_sq - window * zmean * zmean) / (4. * zmean)
+            normal[:, 0, 1] = (m(3, 0) + m(1, 2)) / (2. * np.sqrt(zmean))
+            normal[:, 0, 2] = (m(2, 1) + m(0, 3)) / (2. * np.sqrt(zmean))
+        normal[:, 1, 0] = normal[:, 0, 1]
+        normal[:, 2, 0] = normal[:, 0, 2]
+        normal[:, 1, 1] = m(2, 0)
+        normal[:, 1, 2] = normal[:, 2, 1] = m(1, 1)
+        normal[:, 2, 2] = m(0, 2)
+        return normal, zmean
+    
+    def curvatures(self, window_size_px, resolution):
+        """Curvature of every sliding window of the element (see taubin_curv_windows)."""
+        window, num_windows = window_bounds(self.length, window_size_px)
+        if num_windows == 0:
+            return np.zeros(0)
+        
+        normal, zmean = self.window_normal_matrices(window)
+        return taubin_curv_batch(normal, zmean, resolution)
+
+
+def taubin_curv_batch(normal, zmean, resolution):
+    """Solves a stack of Taubin normal matrices and converts the fitted circles into curvatures.
+
+    Parameters
+    ----------
+    normal : np.ndarray
+        Array of shape (k, 3, 3) with the normal matrix of each window.
+    zmean : np.ndarray
+        Array of shape (k,) with the mean squared distance to the centroid of each window.
+    resolution : float or int
+        Number of pixels per mm in original image.
+
+    Returns
+    -------
+    np.ndarray
+        Curvature (1/radius) for each window, with 0 where taubin_curv would return 0.
+
+    """
+    if len(zmean) == 0:
+        return np.zeros(0)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        # degenerate windows (all points identical) give NaN matrices, which eigh refuses
+        finite = np.isfinite(normal).all(axis=(1, 2))
+        safe = np.where(finite[:, None, None], normal, np.eye(3))
+        eigvals, eigvecs = np.linalg.eigh(safe)
+        a = eigvecs[:, :, 0]  # eigenvector of the smallest eigenvalue
+        a0 = a[:, 0] / (2. * np.sqrt(zmean))
+        a3 = -1. * zmean * a0
+        r = np.sqrt(a[:, 1] * a[:, 1] + a[:, 2] * a[:, 2] - 4 * a0 * a3) / np.abs(a0) / 2
+        curv = 1 / (r / resolution)
+
+    keep = finite & np.isfinite(r) & (curv >= 0.00001)
+    return np.where(keep, curv, 0.)
+
+
+def taubin_curv_windows(coords, window_size_px, resolution):
+    """Curvature of every sliding window along an element, fitted in a single batched call.
+
+    Equivalent to running image.taubin_curv on each window produced by image.subset_gen. The windows are read off a
+    MomentTable, so the cost is linear in the element length whatever the window size.
+
+    Parameters
+    ----------
+    coords : np.ndarray or list
+        Ordered [[x_1, y_1], [x_2, y_2], ...] coordinates of the element.
+    window_size_px : int
+        The size of window of measurement.
+    resolution : float or int
+        Number of pixels per mm in original image.
+
+    Returns
+    -------
+    np.ndarray
+        Curvature for each window, in the order subset_gen yields them.
+
+    """
+    return MomentTable(coords).curvatures(window_size_px, resolution)
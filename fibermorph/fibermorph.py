@@ -1,58 +1,31 @@
 # %% Import libraries
-import argparse
-import datetime
 import os
-import pathlib
-import shutil
 import sys
-import timeit
-import warnings
-from datetime import datetime
-from functools import wraps
-
-# import cv2
-import numpy as np
-import pandas as pd
-import rawpy
-import scipy
-import skimage
-import contextlib
-import joblib
-import skimage.exposure
-import skimage.measure
-import skimage.morphology
-from PIL import Image
-from joblib import Parallel, delayed
-from matplotlib import pyplot as plt
-from scipy import ndimage
-from scipy.spatial import distance as dist
-from skimage import filters, io
-from skimage.filters import threshold_minimum
-from skimage.segmentation import clear_border
-from skimage.util import invert
-from tqdm import tqdm
 
 #%%
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-import demo
-from common import make_subdirectory
+from _version import __version__
+from common import make_subdirectory, setup_logging
 from utils import parse_args
-from image import raw2gray, curvature, section
 
-# Grab version from _version.py in the fibermorph directory
-dir = os.path.dirname(__file__)
-version_py = os.path.join(dir, "_version.py")
-exec(open(version_py).read())
+# The analysis modules (and the demos, with their simulation dependencies) are imported in main() once the module to
+# run is known, so that --help and the modules that don't need them start quickly.
+
 
 def main():
     args = parse_args()
     
+    # console messages of all modules: warnings only with --quiet, debugging messages with --verbose
+    setup_logging(-1 if args.quiet else int(args.verbose))
+    
     # Run fibermorph
     
     if args.demo_real_curv is True:
+        import demo
         demo.real_curv(args.output_directory)
         sys.exit(0)
     elif args.demo_real_section is True:
+        import demo
         demo.real_section(args.output_directory)
         sys.exit(0)
     # elif args.demo_dummy_curv is True:
@@ -62,20 +35,34 @@ def main():
     #     demo.dummy_section(args.output_directory, args.repeats)
     #     sys.exit(0)
     
-    # Check for output directory and create it if it doesn't exist
-    output_dir = make_subdirectory(args.output_directory)
+    # Check for output directory and create it if it doesn't exist (a resumed run writes into the run it continues,
+    # a queue run into the queue directory)
+    if args.raw2gray or (args.resume is None and args.queue_dir is None):
+        output_dir = make_subdirectory(args.output_directory)
+    else:
+        output_dir = None
+    
+    memory_limit = None if args.memory_limit is None else int(args.memory_limit * 2 ** 30)
     
     if args.raw2gray is True:
+        from image import raw2gray
         raw2gray(
-            args.input_directory, output_dir, args.file_extension, args.jobs)
+            args.input_directory, output_dir, args.file_extension, args.jobs, args.profile)
     elif args.curvature is True:
+        from image import curvature
         curvature(
             args.input_directory, output_dir, args.jobs,
-            args.resolution_mm, args.window_size, args.window_unit, args.save_image, args.within_element)
+            args.resolution_mm, args.window_sweep or args.window_size_px, args.window_unit, args.save_image, args.within_element,
+            args.ridge_filter, args.roi_factor, args.parquet, args.ndjson, args.resume, args.cache_dir,
+            int(args.cache_size * 2 ** 30), args.pin, memory_limit, args.queue_dir, args.lease_timeout,
+            args.profile)
     elif args.section is True:
+        from image import section
         section(
             args.input_directory, output_dir, args.jobs,
-            args.resolution_mu, args.minsize, args.maxsize, args.save_image)
+            args.resolution_mu, args.minsize, args.maxsize, args.save_image, args.parquet, args.ndjson,
+            args.resume, args.pin, memory_limit, args.queue_dir, args.lease_timeout,
+            args.profile, args.segmenter, args.all_sections)
     else:
         sys.exit("Error. Tim didn't exhaust all module options")
     
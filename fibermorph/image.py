@@ -1,7 +1,7 @@
-print("Executing image.py")
 # %% Import libraries
 import argparse
 import datetime
+import logging
 import os
 import pathlib
 import shutil
@@ -15,7 +15,6 @@ from timeit import default_timer as timer
 # import cv2
 import numpy as np
 import pandas as pd
-import rawpy
 import scipy
 import skimage
 import contextlib
@@ -25,7 +24,6 @@ import skimage.measure
 import skimage.morphology
 from PIL import Image
 from joblib import Parallel, delayed
-from matplotlib import pyplot as plt
 from scipy import ndimage
 from scipy.spatial import distance as dist
 from skimage import filters, io
@@ -36,15 +34,29 @@ from tqdm import tqdm
 
 #%%
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from common import blockPrint, make_subdirectory, tqdm_joblib
+from common import get_logger, log_level, logged, make_subdirectory, tqdm_joblib
+from admission import MemoryBudget, admitted
+from core_budget import CoreBudget
+from ridge_filter import frangi32
+from manifest import RunManifest, file_hash, keyed
+from morphology import clear_binary_border, span_dilation
+from report import update_report
+from results import ResultWriter
+from roi import fiber_rois, thin_objects
+from run_layout import curvature_layout, section_layout
+from section_segmentation import SEGMENT_FUNCTIONS, moment_measures, subpixel_section_data
+from skeleton_graph import trace_fibers
+from stage_cache import CACHE_SIZE, StageCache
+from stage_timing import TIMINGS_NAME, TimingReport, recorded, stage
+from tiling import tiled_dilation, tiled_frangi, tiled_thin
+from topology import BRANCH_TABLE, hit_groups, hit_points, lookup_table, pixel_codes
 from utils import convert
+from work_queue import LEASE_TIMEOUT, WorkQueue
+from writer_pool import drain_writes, drains_writes, save_array, save_colormapped, save_in_background, wait_for_writes
+
+logger = get_logger(__name__)
 
-# Grab version from _version.py in the fibermorph directory
-dir = os.path.dirname(__file__)
-version_py = os.path.join(dir, "_version.py")
-exec(open(version_py).read())
 
-@blockPrint
 def list_images(directory):
     """Generates a list of all .tif and/or .tiff files in a directory.
 
@@ -94,9 +106,13 @@ def raw_to_gray(imgfile, output_directory):
     # print("\n\n")
     # print(name)
     
+    # rawpy is only needed by raw2gray, so it isn't imported with the module
+    import rawpy
+    
     try:
-        with rawpy.imread(imgfile) as raw:
+        with stage("raw_decode"), rawpy.imread(imgfile) as raw:
             rgb = raw.postprocess(use_auto_wb=True)
+        with stage("raw_save"):
             im = Image.fromarray(rgb).convert('LA')
             im.save(str(output_name))
     except:
@@ -108,53 +124,180 @@ def raw_to_gray(imgfile, output_directory):
     return output_name
 
 
-def section_props(props, im_name, resolution, minpixel, maxpixel, im_center):
-    props_df = [
-        [region.label, region.centroid, scipy.spatial.distance.euclidean(im_center, region.centroid), region.filled_area, region.minor_axis_length, region.major_axis_length, region.eccentricity, region.filled_image, region.bbox]
-        for region
-        in props if region.minor_axis_length >= minpixel and region.major_axis_length <= maxpixel]
-    props_df = pd.DataFrame(props_df, columns=['label', 'centroid', 'distance', 'area', 'min', 'max', 'eccentricity', 'image', 'bbox'])
-    
-    section_id = props_df['distance'].astype(float).idxmin()
-    # print(section_id)
-    
-    section = props_df.iloc[section_id]
-    
-    area_mu = section['area'] / np.square(resolution)
-    min_diam = section['min'] / resolution
-    max_diam = section['max'] / resolution
-    eccentricity = section['eccentricity']
+def label_boxes(label_im, minpixel):
+    """Slices and bounding boxes (min_row, min_col, max_row, max_col) of every label of a label image (one
+    find_objects pass), and the indices of the labels whose bounding box can hold a minor axis of minpixel."""
+    objects = ndimage.find_objects(label_im)
+    boxes = np.array([[sl[0].start, sl[1].start, sl[0].stop, sl[1].stop] if sl is not None else [0, 0, 0, 0]
+                      for sl in objects]).reshape(-1, 4)
+    extents = boxes[:, 2:] - boxes[:, :2]
+    # a region's minor axis (4 standard deviations) is at most twice the span of its bounding box on either side
+    return objects, boxes, np.flatnonzero(2 * (extents.min(axis=1) - 1) >= minpixel)
+
+
+def region_centroid(region, box):
+    """Centroid (row, column) in the image of a region mask cut out at the bounding box box."""
+    rr, cc = np.nonzero(region)
+    return rr.mean() + box[0], cc.mean() + box[1]
+
+
+@stage("props")
+def section_props(label_im, im_name, resolution, minpixel, maxpixel, im_center):
+    """Measures the section nearest the image center: the labelled region with the closest centroid among those whose
+    minor axis is at least minpixel and whose major axis is at most maxpixel.
+
+    The bounding boxes of all labels come from one pass over the image (find_objects). Regions whose bounding box is
+    too small to hold the minor axis are left out, and the others are visited in order of the distance from the center
+    to their bounding box, which no centroid in it can be closer than. The centroid and moments of a region are
+    computed within its bounding box only when it can still be the nearest, so the search stops after a few regions
+    however many debris blobs there are. Only the selected region is filled.
+
+    Parameters
+    ----------
+    label_im : np.ndarray
+        Label image (as from skimage.measure.label).
+    im_name : str
+        Image name.
+    resolution : float
+        Number of pixels per micron.
+    minpixel, maxpixel : float
+        Smallest minor axis and largest major axis of a section in pixels.
+    im_center : list
+        Row and column of the image center.
+
+    Returns
+    -------
+    tuple
+        The section's measurements (pd.DataFrame with one row), its filled mask within its bounding box and the
+        bounding box (min_row, min_col, max_row, max_col).
+
+    """
+    objects, boxes, candidates = label_boxes(label_im, minpixel)
+    
+    # distance from the center to each bounding box (0 when the center is inside it)
+    gaps = np.maximum(np.maximum(boxes[:, :2] - im_center, np.subtract(im_center, boxes[:, 2:] - 1)), 0)
+    bounds = np.hypot(gaps[:, 0], gaps[:, 1])
+    
+    best = None
+    for i in candidates[np.argsort(bounds[candidates], kind="stable")]:
+        if best is not None and bounds[i] > best[0]:
+            break
+        region = label_im[objects[i]] == i + 1
+        centroid = region_centroid(region, boxes[i])
+        distance = np.hypot(*np.subtract(centroid, im_center))
+        # ties go to the lower label
+        if best is not None and (distance, i) > best[:2]:
+            continue
+        area, minor, major, eccentricity = moment_measures(region)
+        if minor >= minpixel and major <= maxpixel:
+            best = (distance, i, region, minor, major, eccentricity)
+    if best is None:
+        raise ValueError("No section between {} and {} pixels across in {}".format(minpixel, maxpixel, im_name))
+    
+    distance, i, region, minor, major, eccentricity = best
+    bin_im = ndimage.binary_fill_holes(region, structure=np.ones((3, 3)))
+    bbox = tuple(int(b) for b in boxes[i])
     
     section_data = pd.DataFrame(
-        {'ID': [im_name], 'area': [area_mu], 'eccentricity': [eccentricity], 'min': [min_diam],
-         'max': [max_diam]})
-    
-    bin_im = section['image']
-    bbox = section['bbox']
+        {'ID': [im_name], 'area': [bin_im.sum() / np.square(resolution)], 'eccentricity': [eccentricity],
+         'min': [minor / resolution], 'max': [major / resolution]})
     
     return section_data, bin_im, bbox
 
 
-def crop_section(img, im_name, resolution, minpixel, maxpixel, im_center):
+@stage("props")
+def all_section_props(label_im, im_name, resolution, minpixel, maxpixel):
+    """Measures every section of a label image: each region whose minor axis is at least minpixel and whose major
+    axis is at most maxpixel, like section_props (whose bounding box bound leaves out the debris here too).
+
+    Parameters
+    ----------
+    label_im : np.ndarray
+        Label image (as from skimage.measure.label).
+    im_name : str
+        Image name.
+    resolution : float
+        Number of pixels per micron.
+    minpixel, maxpixel : float
+        Smallest minor axis and largest major axis of a section in pixels.
+
+    Returns
+    -------
+    list
+        For each section in label order, its measurements (pd.DataFrame with one row), its filled mask within its
+        bounding box, the bounding box (min_row, min_col, max_row, max_col) and the centroid (row, column).
+
+    """
+    objects, boxes, candidates = label_boxes(label_im, minpixel)
+    
+    sections = []
+    for i in candidates:
+        region = label_im[objects[i]] == i + 1
+        area, minor, major, eccentricity = moment_measures(region)
+        if minor < minpixel or major > maxpixel:
+            continue
+        bin_im = ndimage.binary_fill_holes(region, structure=np.ones((3, 3)))
+        section_data = pd.DataFrame(
+            {'ID': [im_name], 'area': [bin_im.sum() / np.square(resolution)], 'eccentricity': [eccentricity],
+             'min': [minor / resolution], 'max': [major / resolution]})
+        sections.append((section_data, bin_im, tuple(int(b) for b in boxes[i]), region_centroid(region, boxes[i])))
     
+    return sections
+
+
+# the coarse pass of crop_section downsamples the image so that the smallest section spans this many pixels
+COARSE_MIN_PIXELS = 8
+
+
+def block_mean(img, factor):
+    """Downsamples an image by the mean of factor x factor blocks (the last partial blocks are left out)."""
+    rows, cols = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+    # summing whole rows of blocks first is several times faster than reducing both block axes at once
+    return blocks.sum(axis=1, dtype=np.float32).sum(axis=2) / factor ** 2
+
+
+def locate_section(img, im_name, resolution, minpixel, maxpixel, im_center):
+    """Bounding box of the section nearest the center of an image (threshold_minimum, clear_border and section_props
+    over its labels)."""
+    thresh = skimage.filters.threshold_minimum(img)
+    bin_img = skimage.segmentation.clear_border(img < thresh)
+    label_im = skimage.measure.label(bin_img, connectivity=2)
+    section_data, bin_im, bbox = section_props(label_im, im_name, resolution, minpixel, maxpixel, im_center)
+    return bbox
+
+
+def padded_window(bbox, pad, shape):
+    """Slices of a bounding box padded on every side, clipped to the image."""
+    return (slice(max(bbox[0] - pad, 0), min(bbox[2] + pad, shape[0])),
+            slice(max(bbox[1] - pad, 0), min(bbox[3] + pad, shape[1])))
+
+
+@stage("crop")
+def crop_section(img, im_name, resolution, minpixel, maxpixel, im_center):
+    """Crops an image around the section nearest its center, with 100 pixels of padding.
+
+    The section is first located on a block-mean downsampled image, and the full-resolution threshold, labelling and
+    selection then run only within a window around the candidate (over the whole image if the coarse pass finds
+    none). The crop is a view of the image. If no section is found, the center 25% of the image is returned.
+    """
+    img = np.asarray(img)
+    pad = 100
     try:
-        # binarize
-        thresh = skimage.filters.threshold_minimum(img)
-        bin_img = skimage.segmentation.clear_border(img < thresh)
-        # label the image
-        label_im, num_elem = skimage.measure.label(bin_img, connectivity=2, return_num=True)
-        
-        props = skimage.measure.regionprops(label_image=label_im, intensity_image=img)
-        
-        section_data, bin_im, bbox = section_props(props, im_name, resolution, minpixel, maxpixel, im_center)
+        window = (slice(0, img.shape[0]), slice(0, img.shape[1]))
+        factor = max(1, int(minpixel // COARSE_MIN_PIXELS))
+        if factor > 1:
+            try:
+                coarse_bbox = locate_section(block_mean(img, factor), im_name, resolution / factor, minpixel / factor,
+                                             maxpixel / factor, np.divide(im_center, factor))
+                # a coarse pixel of slack on each side for the rounding of the coarse bounding box
+                window = padded_window(np.multiply(coarse_bbox, factor), pad + factor, img.shape)
+            except:
+                logger.debug("No section found in the downsampled %s, locating it at full resolution", im_name)
         
-        pad = 100
-        minr = bbox[0] - pad
-        minc = bbox[1] - pad
-        maxr = bbox[2] + pad
-        maxc = bbox[3] + pad
-        bbox_pad = [minc, minr, maxc, maxr]
-        crop_im = np.asarray(Image.fromarray(img).crop(bbox_pad))
+        offset = np.array([window[0].start, window[1].start])
+        bbox = locate_section(img[window], im_name, resolution, minpixel, maxpixel, np.subtract(im_center, offset))
+        crop_im = img[padded_window(np.add(bbox, np.tile(offset, 2)), pad, img.shape)]
     
     except:
         minr = int(im_center[0] / 2)
@@ -162,27 +305,27 @@ def crop_section(img, im_name, resolution, minpixel, maxpixel, im_center):
         maxr = int(im_center[0] * 1.5)
         maxc = int(im_center[1] * 1.5)
         
-        bbox_pad = [minc, minr, maxc, maxr]
-        # print("Error: \n Found no bbox for {} \n Used center 25% of image instead: {}".format(im_name, str(bbox_pad)))
+        logger.debug("Found no bbox for %s, used the center 25%% of the image instead: %s", im_name,
+                     [minc, minr, maxc, maxr])
         
-        crop_im = np.asarray(Image.fromarray(img).crop(bbox_pad))
+        crop_im = img[minr:maxr, minc:maxc]
         
     return crop_im
 
-def segment_section(crop_im, im_name, resolution, minpixel, maxpixel, im_center):
+@stage("segment")
+def segment_section(crop_im, im_name, resolution, minpixel, maxpixel, im_center, segmenter="chan_vese",
+                    init_mask=None):
     try:
-        thresh = skimage.filters.threshold_minimum(crop_im)
-        bin_ls_set = crop_im < thresh
-
-        seg_im = skimage.segmentation.morphological_chan_vese(np.asarray(crop_im), 40, init_level_set=bin_ls_set, smoothing=4)
-        
-        seg_im_inv = np.asarray(seg_im != 0)
+        # "chan_vese" or "threshold", see section_segmentation; init_mask is the threshold mask of the crop when it
+        # has already been computed (see segment_sections)
+        seg_im_inv = SEGMENT_FUNCTIONS[segmenter](crop_im, init_mask)
         
         crop_label_im, num_elem = skimage.measure.label(seg_im_inv, connectivity=2, return_num=True)
         
-        crop_props = skimage.measure.regionprops(label_image=crop_label_im, intensity_image=np.asarray(crop_im))
-        
-        section_data, bin_im, bbox = section_props(crop_props, im_name, resolution, minpixel, maxpixel, im_center)
+        section_data, bin_im, bbox = section_props(crop_label_im, im_name, resolution, minpixel, maxpixel, im_center)
+        if segmenter == "threshold":
+            # the threshold mask isn't refined: the section is measured from the gray values around its boundary
+            section_data = subpixel_section_data(crop_im, bin_im, bbox, im_name, resolution)
     
     except:
         section_data = pd.DataFrame(
@@ -193,37 +336,116 @@ def segment_section(crop_im, im_name, resolution, minpixel, maxpixel, im_center)
         
     return section_data, bin_im
 
+@stage("sections")
+def segment_sections(img, im_name, resolution, minpixel, maxpixel, segmenter="chan_vese", binary=False):
+    """Segments and measures every section of an image, instead of only the one nearest its center.
+
+    The image is thresholded (threshold_minimum, or taken as is if binary) and labelled once, sections cut by the
+    image border are left out, and each section found in the labels (see all_section_props) is cropped with 100 pixels
+    of padding. Binary sections are measured from the labels directly. Grayscale crops are segmented from their part of
+    the shared threshold mask (see segment_section), and the section is the region of the crop nearest the centroid
+    it had in the image.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        Grayscale or binary image.
+    im_name : str
+        Image name.
+    resolution : float
+        Number of pixels per micron.
+    minpixel, maxpixel : float
+        Smallest minor axis and largest major axis of a section in pixels.
+    segmenter : str
+        Key of section_segmentation.SEGMENT_FUNCTIONS, for grayscale images.
+    binary : bool
+        True if the image is binary, with the sections dark.
+
+    Returns
+    -------
+    section_data : pd.DataFrame
+        One row per section, with its number in the image ('section', in label order, i.e. by the first row of each
+        section) and the row and column of its centroid in pixels ('centroid_row', 'centroid_col') after the
+        measurements of section_props.
+    crops : list
+        Name (the image name and section number), crop and binary image of each section.
+
+    """
+    img = np.asarray(img)
+    pad = 100
+    with stage("label"):
+        mask = skimage.util.invert(img) != 0 if binary else img < skimage.filters.threshold_minimum(img)
+        label_im = skimage.measure.label(skimage.segmentation.clear_border(mask), connectivity=2)
+    
+    rows = []
+    crops = []
+    for number, (section_data, bin_im, bbox, centroid) in enumerate(
+            all_section_props(label_im, im_name, resolution, minpixel, maxpixel), start=1):
+        window = padded_window(bbox, pad, img.shape)
+        crop_im = img[window]
+        if not binary:
+            crop_center = np.subtract(centroid, [window[0].start, window[1].start])
+            section_data, bin_im = segment_section(crop_im, im_name, resolution, minpixel, maxpixel, crop_center,
+                                                   segmenter, mask[window])
+            if section_data['ID'].isna().all():
+                logger.debug("Could not segment section %d of %s", number, im_name)
+                continue
+        rows.append(section_data.assign(section=number, centroid_row=centroid[0], centroid_col=centroid[1]))
+        crops.append(("{}_{}".format(im_name, number), crop_im, bin_im))
+    
+    if not rows:
+        raise ValueError("No section between {} and {} pixels across in {}".format(minpixel, maxpixel, im_name))
+    logger.debug("Found %d sections in %s", len(rows), im_name)
+    
+    return pd.concat(rows, ignore_index=True), crops
+
+
+def save_crop_image(savename, im):
+    try:
+        skimage.io.imsave(str(savename), im)
+    except AttributeError:
+        im.save(savename)
+
+
 def save_sections(output_path, im_name, im, save_crop=False):
+    # written in the background, see writer_pool
     if save_crop:
-        crop_path = make_subdirectory(output_path, "crop")
-        with pathlib.Path(crop_path).joinpath(im_name + ".tiff") as savename:
-            try:
-                skimage.io.imsave(str(savename), im)
-            except AttributeError:
-                im.save(savename)
-                
+        savename = pathlib.Path(output_path).joinpath("crop", im_name + ".tiff")
+        save_in_background(save_crop_image, savename, im)
     else:
-        binary_path = make_subdirectory(output_path, "binary")
-        with pathlib.Path(binary_path).joinpath(im_name + ".tiff") as savename:
-            im = Image.fromarray(im)
-            im.save(savename)
+        savename = pathlib.Path(output_path).joinpath("binary", im_name + ".tiff")
+        save_in_background(save_array, savename, im)
             
 # # @timing
-@blockPrint
-def section_seq(input_file, output_path, resolution, minsize, maxsize, save_img):
+def section_seq(input_file, output_path, resolution, minsize, maxsize, save_img, segmenter="chan_vese",
+                all_sections=False):
     """Segments the input image to isolate the section(s).
 
     Parameters
     ----------
-    img : np.ndarray
-        Image to be segmented.
+    input_file : str or pathlib object
+        Grayscale or binary image of the section(s).
+    output_path : str, pathlib object or RunLayout
+        Run directory.
+    resolution : float
+        Number of pixels per micron.
+    minsize, maxsize : float
+        Smallest and largest diameter of a section in microns.
+    save_img : bool
+        True to save the crops and binary images of the sections.
+    segmenter : str
+        Segmentation of grayscale sections, "chan_vese" or "threshold" (see section_segmentation).
+    all_sections : bool
+        True to measure every section in the image (see segment_sections) instead of the one nearest its center.
 
     Returns
     -------
-    np.ndarray
-        An ndarray of the segmented (binary) image.
+    pd.DataFrame
+        Measurements of the section(s), empty if the image couldn't be analyzed.
 
     """
+    # a plain directory gets the subdirectories of the saved images here (the driver passes its layout instead)
+    output_path = section_layout(output_path, save_img)
     
     with tqdm(total=3, desc="section analysis sequence", unit="steps", position=1, leave=None) as pbar:
         for i in [input_file]:
@@ -246,14 +468,24 @@ def section_seq(input_file, output_path, resolution, minsize, maxsize, save_img)
                 
                 pbar.update(1)
                 
-                if len(unique) == 2:
+                if all_sections:
+                    section_data, crops = segment_sections(img, im_name, resolution, minpixel, maxpixel, segmenter,
+                                                           binary=len(unique) == 2)
+                    pbar.update(1)
+                    
+                    if save_img:
+                        for crop_name, crop_im, bin_im in crops:
+                            save_sections(output_path, crop_name, crop_im, save_crop=True)
+                            save_sections(output_path, crop_name, bin_im, save_crop=False)
+                    pbar.update(1)
+                elif len(unique) == 2:
                     seg_im = skimage.util.invert(img)
                     pbar.update(1)
-                    label_im, num_elem = skimage.measure.label(seg_im, connectivity=2, return_num=True)
+                    with stage("label"):
+                        label_im, num_elem = skimage.measure.label(seg_im, connectivity=2, return_num=True)
             
-                    props = skimage.measure.regionprops(label_image=label_im, intensity_image=img)
-            
-                    section_data, bin_im, bbox = section_props(props, im_name, resolution, minpixel, maxpixel, im_center)
+                    section_data, bin_im, bbox = section_props(label_im, im_name, resolution, minpixel, maxpixel,
+                                                               im_center)
     
                     pad = 100
                     minr = bbox[0] - pad
@@ -272,21 +504,38 @@ def section_seq(input_file, output_path, resolution, minsize, maxsize, save_img)
                     crop_im = crop_section(img, im_name, resolution, minpixel, maxpixel, im_center)
                     pbar.update(1)
             
-                    section_data, bin_im = segment_section(crop_im, im_name, resolution, minpixel, maxpixel, im_center)
+                    section_data, bin_im = segment_section(crop_im, im_name, resolution, minpixel, maxpixel, im_center,
+                                                           segmenter)
                     
                     if save_img:
                         save_sections(output_path, im_name, crop_im, save_crop=True)
                         save_sections(output_path, im_name, bin_im, save_crop=False)
                     pbar.update(1)
+                
+                # the image is only done once its saved images are on disk
+                with stage("write_wait"):
+                    wait_for_writes()
             except:
-                pass
+                # the image's pending writes mustn't be waited for (and their errors raised) with the next image's
+                drain_writes()
+                logger.warning("Could not analyze %s", input_file, exc_info=logger.isEnabledFor(logging.DEBUG))
         
             return section_data
     
 
+# ridge filters selectable for filter_curv
+def skimage_frangi(image, **kwargs):
+    # skimage.filters.frangi, looked up on the first call: importing it loads skimage.feature and scipy.stats, which
+    # section workers never need
+    return skimage.filters.frangi(image, **kwargs)
+
+
+RIDGE_FILTERS = {"frangi": skimage_frangi, "frangi32": frangi32}
+
+
 # # @timing
-@blockPrint
-def filter_curv(input_file, output_path, save_img):
+@stage("filter")
+def filter_curv(input_file, output_path, save_img, ridge_filter="frangi", tile_workers=1, roi_factor=None):
     """Uses a ridge filter to extract the curved (or straight) lines from the background noise.
 
     Parameters
@@ -297,6 +546,13 @@ def filter_curv(input_file, output_path, save_img):
         A string path to the output directory.
     save_img : bool
         True or False for saving filtered image.
+    ridge_filter : str
+        Key of RIDGE_FILTERS: "frangi" (skimage.filters.frangi) or "frangi32" (low-memory float32 version).
+    tile_workers : int
+        Number of threads filtering overlapping tiles of the image; 1 filters the whole image at once.
+    roi_factor : int or None
+        Downsampling factor for locating the fibers first (see roi.fiber_rois); only the regions found are filtered
+        and the rest of the filtered image is 0. None filters the whole image.
 
     Returns
     -------
@@ -321,35 +577,65 @@ def filter_curv(input_file, output_path, save_img):
     # # print("Image size is:", gray_img.shape)
     
     # use frangi ridge filter to find hairs, the output will be inverted
-    filter_img = skimage.filters.frangi(gray_img)
+    if roi_factor:
+        rois = fiber_rois(gray_img, roi_factor)
+        filter_img = tiled_frangi(gray_img, RIDGE_FILTERS[ridge_filter], tile_workers, boxes=rois)
+    elif tile_workers > 1:
+        filter_img = tiled_frangi(gray_img, RIDGE_FILTERS[ridge_filter], tile_workers)
+    else:
+        filter_img = RIDGE_FILTERS[ridge_filter](gray_img)
     type(filter_img)
     # print("Image size is:", filter_img.shape)
     
     if save_img:
-        output_path = make_subdirectory(output_path, append_name="filtered")
-        # inverting and saving the filtered image
+        # inverting and saving the filtered image (in the background, see writer_pool)
         img_inv = skimage.util.invert(filter_img)
-        with pathlib.Path(output_path).joinpath(im_name + ".tiff") as save_path:
-            plt.imsave(save_path, img_inv, cmap="gray")
+        save_path = pathlib.Path(output_path).joinpath("filtered", im_name + ".tiff")
+        save_in_background(save_colormapped, save_path, img_inv, cmap="gray")
     
     return filter_img, im_name
 
 
+def otsu_threshold(img, nbins=256):
+    """Same threshold as skimage.filters.threshold_otsu for a float image, without copying the image.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        Float image.
+    nbins : int
+        Number of histogram bins.
+
+    Returns
+    -------
+    float
+        Threshold value.
+
+    """
+    low, high = img.min(), img.max()
+    if low == high:
+        return low
+    counts, edges = np.histogram(img, bins=nbins, range=(low, high))
+    return filters.threshold_otsu(hist=(counts, (edges[:-1] + edges[1:]) / 2.))
+
+
 # # @timing
-@blockPrint
-def binarize_curv(filter_img, im_name, output_path, save_img):
+@stage("binarize")
+def binarize_curv(filter_img, im_name, output_path, save_img, tile_workers=1):
     """Binarizes the filtered output of the fibermorph.filter_curv function.
 
     Parameters
     ----------
     filter_img : np.ndarray
-        Image after ridge filter (float64).
+        Image after ridge filter (float64, or float32 from frangi32).
     im_name : str
         Image name.
     output_path : str or pathlib object
         Output directory path.
     save_img : bool
         True or false for saving image.
+    tile_workers : int
+        Number of threads dilating overlapping tiles of the image; the threshold and border clearing stay global.
 
     Returns
     -------
@@ -360,28 +646,32 @@ def binarize_curv(filter_img, im_name, output_path, save_img):
     
     selem = skimage.morphology.disk(5)
     
-    filter_img = skimage.exposure.adjust_log(filter_img)
+    # skimage.exposure.adjust_log for the 0-1 float output of the filter, computed in a single buffer
+    log_img = np.add(filter_img, 1)
+    np.log2(log_img, out=log_img)
     
     try:
-        thresh_im = filter_img > filters.threshold_otsu(filter_img)
+        thresh_im = log_img > otsu_threshold(log_img)
     except:
-        thresh_im = skimage.util.invert(filter_img)
+        thresh_im = skimage.util.invert(log_img)
+    del log_img
     
     # clear the border of the image (buffer is the px width to be considered as border)
-    cleared_im = skimage.segmentation.clear_border(thresh_im, buffer_size=10)
+    cleared_im = clear_binary_border(thresh_im, buffer_size=10)
     
-    # dilate the hair fibers
-    binary_im = scipy.ndimage.binary_dilation(cleared_im, structure=selem, iterations=2)
+    # dilate the hair fibers (same as scipy.ndimage.binary_dilation with 2 iterations, see morphology.span_dilation)
+    if tile_workers > 1:
+        binary_im = tiled_dilation(cleared_im, selem, 2, tile_workers)
+    else:
+        binary_im = span_dilation(cleared_im, selem, iterations=2)
     
     if save_img:
-        output_path = make_subdirectory(output_path, append_name="binarized")
         # invert image
         save_im = skimage.util.invert(binary_im)
         
-        # save image
-        with pathlib.Path(output_path).joinpath(im_name + ".tiff") as save_name:
-            im = Image.fromarray(save_im)
-            im.save(save_name)
+        # save image (in the background, see writer_pool)
+        save_name = pathlib.Path(output_path).joinpath("binarized", im_name + ".tiff")
+        save_in_background(save_array, save_name, save_im)
         return binary_im
     
     else:
@@ -389,7 +679,7 @@ def binarize_curv(filter_img, im_name, output_path, save_img):
 
 
 # # @timing
-@blockPrint
+@stage("remove_particles")
 def remove_particles(img, output_path, name, minpixel, prune, save_img):
     """Removes particles under a particular size in the images.
 
@@ -423,18 +713,14 @@ def remove_particles(img, output_path, name, minpixel, prune, save_img):
         
     if save_img:
         img_inv = skimage.util.invert(clean)
-        if prune:
-            output_path = make_subdirectory(output_path, append_name="pruned")
-        else:
-            output_path = make_subdirectory(output_path, append_name="clean")
-        with pathlib.Path(output_path).joinpath(name + ".tiff") as savename:
-            plt.imsave(savename, img_inv, cmap='gray')
+        # saved in the background, see writer_pool
+        savename = pathlib.Path(output_path).joinpath("pruned" if prune else "clean", name + ".tiff")
+        save_in_background(save_colormapped, savename, img_inv, cmap='gray')
     
     return clean
 
 
 # # @timing
-@blockPrint
 def check_bin(img):
     """Checks whether image has been properly binarized. NB: works on the assumption that there should be more
     background pixels than element pixels.
@@ -480,8 +766,8 @@ def check_bin(img):
 
 
 # # @timing
-@blockPrint
-def skeletonize(clean_img, name, output_path, save_img):
+@stage("skeletonize")
+def skeletonize(clean_img, name, output_path, save_img, tile_workers=1, by_object=False):
     """Reduces curves and lines to 1 pixel width (skeletons).
 
     Parameters
@@ -494,6 +780,10 @@ def skeletonize(clean_img, name, output_path, save_img):
         Output directory path.
     save_img : bool
         True or false for saving image.
+    tile_workers : int
+        Number of threads thinning overlapping tiles of the image; 1 thins the whole image at once.
+    by_object : bool
+        True to thin each object on its own bounding box (see roi.thin_objects), which is faster on sparse images.
 
     Returns
     -------
@@ -505,14 +795,17 @@ def skeletonize(clean_img, name, output_path, save_img):
     clean_img = check_bin(clean_img)
     
     # skeletonize the hair
-    skeleton = skimage.morphology.thin(clean_img)
+    if by_object:
+        skeleton = thin_objects(clean_img)
+    elif tile_workers > 1:
+        skeleton = tiled_thin(clean_img, tile_workers)
+    else:
+        skeleton = skimage.morphology.thin(clean_img)
     
     if save_img:
-        output_path = make_subdirectory(output_path, append_name="skeletonized")
         img_inv = skimage.util.invert(skeleton)
-        with pathlib.Path(output_path).joinpath(name + ".tiff") as output_path:
-            im = Image.fromarray(img_inv)
-            im.save(output_path)
+        # saved in the background, see writer_pool
+        save_in_background(save_array, pathlib.Path(output_path).joinpath("skeletonized", name + ".tiff"), img_inv)
         return skeleton
     
     else:
@@ -522,7 +815,7 @@ def skeletonize(clean_img, name, output_path, save_img):
 
 
 # # @timing
-@blockPrint
+@stage("prune")
 def prune(skeleton, name, pruned_dir, save_img):
     """Prunes branches from skeletonized image.
     Adapted from: "http://homepages.inf.ed.ac.uk/rbf/HIPR2/thin.htm"
@@ -547,70 +840,14 @@ def prune(skeleton, name, pruned_dir, save_img):
     
     # print("\nPruning {}...\n".format(name))
     
-    # identify 3-way branch-points
-    hit1 = np.array([[0, 1, 0],
-                     [0, 1, 0],
-                     [1, 0, 1]], dtype=np.uint8)
-    hit2 = np.array([[1, 0, 0],
-                     [0, 1, 0],
-                     [1, 0, 1]], dtype=np.uint8)
-    hit3 = np.array([[1, 0, 0],
-                     [0, 1, 1],
-                     [0, 1, 0]], dtype=np.uint8)
-    hit_list = [hit1, hit2, hit3]
-    
-    # numpy slicing to create 3 remaining rotations
-    for ii in range(9):
-        hit_list.append(np.transpose(hit_list[-3])[::-1, ...])
-    
-    # add structure elements for branch-points four 4-way branchpoints
-    hit3 = np.array([[0, 1, 0],
-                     [1, 1, 1],
-                     [0, 1, 0]], dtype=np.uint8)
-    hit4 = np.array([[1, 0, 1],
-                     [0, 1, 0],
-                     [1, 0, 1]], dtype=np.uint8)
-    hit_list.append(hit3)
-    hit_list.append(hit4)
-    # print("Creating hit and miss list")
-    
     skel_image = check_bin(skeleton)
     # print("Converting image to binary array")
     
-    branch_points = np.zeros(skel_image.shape)
-    # print("Creating empty array for branch points")
-    
-    for hit in hit_list:
-        target = hit.sum()
-        curr = ndimage.convolve(skel_image, hit, mode="constant")
-        branch_points = np.logical_or(branch_points, np.where(curr == target, 1, 0))
-    
+    # identify 3-way and 4-way branch-points with one neighbourhood-code lookup over the skeleton pixels
+    branch_points_image = hit_points(skel_image, BRANCH_TABLE)
     # print("Completed collection of branch points")
     
-    # pixels may "hit" multiple structure elements, ensure the output is a binary image
-    branch_points_image = np.where(branch_points, 1, 0)
-    # print("Ensuring binary")
-    
-    # use SciPy's ndimage module for locating and determining coordinates of each branch-point
-    labels, num_labels = ndimage.label(branch_points_image)
-    # print("Labelling branches")
-    
-    # use SciPy's ndimage module to determine the coordinates/pixel corresponding to the center of mass of each
-    # branchpoint
-    branch_points = ndimage.center_of_mass(skel_image, labels=labels, index=range(1, num_labels + 1))
-    branch_points = np.array([value for value in branch_points if not np.isnan(value[0]) or not np.isnan(value[1])],
-                             dtype=int)
-    # num_branch_points = len(branch_points)
-    
-    hit = np.array([[0, 0, 0],
-                    [0, 1, 0],
-                    [0, 0, 0]], dtype=np.uint8)
-    
-    dilated_branches = ndimage.convolve(branch_points_image, hit, mode='constant')
-    dilated_branches_image = np.where(dilated_branches, 1, 0)
-    # print("Ensuring binary dilated branches")
-    pruned_image = np.subtract(skel_image, dilated_branches_image)
-    # pruned_image = np.subtract(skel_image, branch_points_image)
+    pruned_image = np.logical_and(skel_image, np.logical_not(branch_points_image))
     
     pruned_image = remove_particles(pruned_image, pruned_dir, name, minpixel=5, prune=True, save_img=save_img)
 
@@ -739,7 +976,6 @@ def diag(skeleton):
 
 
 # @timing
-@blockPrint
 def taubin_curv(coords, resolution):
     """Curvature calculation based on algebraic circle fit by Taubin.
     Adapted from: "https://github.com/PmagPy/PmagPy/blob/2efd4a92ddc19c26b953faaa5c08e3d8ebd305c9/SPD/lib
@@ -793,7 +1029,6 @@ def taubin_curv(coords, resolution):
 
 
 # # @timing
-@blockPrint
 def subset_gen(pixel_length, window_size_px, label):
     """Generator function for start and end indices of the window of measurement.
 
@@ -827,7 +1062,6 @@ def subset_gen(pixel_length, window_size_px, label):
 
 
 # # @timing
-@blockPrint
 def within_element_func(output_path, name, element, taubin_df):
     # for within hair distribution
     label_name = str(element.label)
@@ -835,13 +1069,13 @@ def within_element_func(output_path, name, element, taubin_df):
     element_df.columns = ['curv']
     element_df['label'] = label_name
     
-    output_path = make_subdirectory(output_path, append_name="WithinElement")
-    with pathlib.Path(output_path).joinpath("WithinElement_" + name + "_Label-" + label_name + ".csv") as save_path:
-        element_df.to_csv(save_path)
+    # the WithinElement directory is created with the run layout, see analyze_all_curv
+    save_path = pathlib.Path(output_path).joinpath("WithinElement",
+                                                   "WithinElement_" + name + "_Label-" + label_name + ".csv")
+    element_df.to_csv(save_path)
     
     return True
 
-@blockPrint
 def define_structure(structure: str):
 
     if structure == "mid":
@@ -887,59 +1121,70 @@ def define_structure(structure: str):
         raise TypeError(
             "Structure input for find_structure() is invalid, choose from 'mid', or 'diag' and input as str")
 
-@blockPrint
+# lookup tables for the structures counted by pixel_length_correction
+STRUCTURE_TABLES = {structure: lookup_table(define_structure(structure)) for structure in ["mid", "diag"]}
+
+
 def find_structure(skeleton, structure: str):
     skel_image = check_bin(skeleton).astype(int)
     
     # print(skel_image.shape)
     
-    # creating empty array for hit and miss algorithm
-    hit_points = np.zeros(skel_image.shape)
-    # defining the structure used in hit-and-miss algorithm
-    hit_list = define_structure(structure)
-    
-    for hit in hit_list:
-        target = hit.sum()
-        curr = ndimage.convolve(skel_image, hit, mode="constant")
-        hit_points = np.logical_or(hit_points, np.where(curr == target, 1, 0))
-    
-    # Ensuring target image is binary
-    hit_points_image = np.where(hit_points, 1, 0)
+    # hit and miss algorithm through the lookup table of the structure
+    hit_points_image = hit_points(skel_image, STRUCTURE_TABLES[structure])
     
     # use SciPy's ndimage module for locating and determining coordinates of each branch-point
     labels, num_labels = ndimage.label(hit_points_image)
     
     return labels, num_labels
 
-@blockPrint
-def pixel_length_correction(element):
-    
-    num_total_points = element.area
+def corrected_pixel_lengths(skeleton):
+    """Corrected pixel length of every element of a skeleton, computed for all elements at once.
+
+    Counts the same diagonal and mid structures as find_structure does on each element's own image, from a single
+    neighbourhood-code pass over the skeleton pixels aggregated by label.
+
+    Parameters
+    ----------
+    skeleton : np.ndarray
+        Binary array of the skeleton.
+
+    Returns
+    -------
+    np.ndarray
+        Corrected pixel length of each element, entry i holding label i + 1 (labels as in skimage.measure.label with
+        connectivity=2).
+
+    """
+    skel_image = np.asarray(skeleton, dtype=bool)
+    label_image, num_labels = ndimage.label(skel_image, structure=np.ones((3, 3)))
     
-    skeleton = element.image
+    rows, cols, codes = pixel_codes(skel_image)
+    labels = label_image[rows, cols] - 1
     
-    diag_points, num_diag_points = find_structure(skeleton, 'diag')
-    # print(num_diag_points)
+    num_total_points = np.bincount(labels, minlength=num_labels)
+    num_diag_points = hit_groups(rows, cols, STRUCTURE_TABLES["diag"][codes], labels, num_labels)
+    num_mid_points = hit_groups(rows, cols, STRUCTURE_TABLES["mid"][codes], labels, num_labels)
+    num_adj_points = num_total_points - num_diag_points - num_mid_points
     
-    mid_points, num_mid_points = find_structure(skeleton, 'mid')
-    # print(num_mid_points)
+    corr_element_pixel_length = num_adj_points + (num_diag_points * np.sqrt(2)) + (num_mid_points * np.sqrt(1.25))
     
-    num_adj_points = num_total_points - num_diag_points - num_mid_points
-    # print(num_adj_points)
+    return corr_element_pixel_length
 
-    corr_element_pixel_length = num_adj_points + (num_diag_points * np.sqrt(2)) + (num_mid_points * np.sqrt(1.25))
+def pixel_length_correction(element):
+    
+    corr_element_pixel_length = corrected_pixel_lengths(element.image)[0]
 
     return corr_element_pixel_length
 
 # # @timing
-@blockPrint
 def analyze_each_curv(element, window_size_px, resolution, output_path, name, within_element):
     """Calculates curvature for each labeled element in an array.
 
     Parameters
     ----------
-    element : Iterable
-        A list of RegionProperties (most importantly, coordinates) from scikit-image regionprops function.
+    element : skeleton_graph.Fiber
+        A fiber traced from the pruned skeleton (most importantly, its coordinates ordered along each segment).
     window_size_px : int
         Number of pixels to be used for window of measurement.
     resolution : float
@@ -952,8 +1197,6 @@ def analyze_each_curv(element, window_size_px, resolution, output_path, name, wi
 
     """
     
-    element_label = np.array(element.coords)
-    
     # Due to the differences in distance for vertically and horizontally vs. diagonally adjacent pixels, a correction
     # is applied of a factor of 1.12. See literature below:
     # Smit AL, Sprangers JFCM, Sablik PW, Groenwold J. Automated measurement of root length with a three-dimensional
@@ -963,17 +1206,21 @@ def analyze_each_curv(element, window_size_px, resolution, output_path, name, wi
     
     element_pixel_length = int(element.area)  # length of element in pixels
 
-    corr_element_pixel_length = pixel_length_correction(element)
+    corr_element_pixel_length = element.corrected_length
+    if corr_element_pixel_length is None:
+        corr_element_pixel_length = pixel_length_correction(element)
 
     length_mm = float(corr_element_pixel_length / resolution)
     
     if not window_size_px is None:
         window_size_px = int(window_size_px)
         
-        subset_loop = (subset_gen(element_pixel_length, window_size_px, element_label))  # generates subset loop
+        # windows run along each contiguous segment of the fiber (the whole fiber is one window under 10 px); the
+        # moment tables are built once per fiber and shared by every window size analyzed
+        tables = element.moment_tables(whole=window_size_px < 10)
         
-        # Safe generator expression in case of errors
-        curv = [taubin_curv(element_coords, resolution) for element_coords in subset_loop]
+        # fits every window generated by subset_gen in one batched call per segment
+        curv = np.concatenate([table.curvatures(window_size_px, resolution) for table in tables])
     
         taubin_df = pd.Series(curv).astype('float')
         # print("\nCurv dataframe is:")
@@ -1022,7 +1269,7 @@ def analyze_each_curv(element, window_size_px, resolution, output_path, name, wi
 
 
 # # @timing
-@blockPrint
+@stage("read")
 def imread(input_file, use_skimage=False):
     """Reads in image as grayscale array.
 
@@ -1053,7 +1300,7 @@ def imread(input_file, use_skimage=False):
 
 
 # # @timing
-@blockPrint
+@stage("analyze")
 def analyze_all_curv(img, name, output_path, resolution, window_size, window_unit, test, within_element):
     """Analyzes curvature for all elements in an image.
 
@@ -1063,12 +1310,13 @@ def analyze_all_curv(img, name, output_path, resolution, window_size, window_uni
         Pruned skeleton of curves/lines as a uint8 ndarray.
     name : str
         Image name.
-    output_path : str or pathlib object
-        Output directory.
+    output_path : str, pathlib object or RunLayout
+        Output directory (see run_layout).
     resolution : int
         Number of pixels per mm in original image.
     window_size: float or int or list
-        Desired size for window of measurement in mm.
+        Desired size for window of measurement in mm or pixels. A list sweeps several windows from the same traced
+        fibers, and the rows then carry `image`, `window_size` and `window_unit` columns.
     test : bool
         True or False for whether this is being run for validation tests
     within_element
@@ -1081,19 +1329,23 @@ def analyze_all_curv(img, name, output_path, resolution, window_size, window_uni
 
     """
     if type(img) != 'np.ndarray':
-        print(type(img))
         img = np.array(img)
-    else:
-        print(type(img))
+    
+    # the summaries of each window (and the curvatures within each element) are written in the run's subdirectories
+    output_path = curvature_layout(output_path, within_element=within_element)
     
     # print("Analyzing {}".format(name))
     
     img = check_bin(img)
     
-    label_image, num_elements = skimage.measure.label(img.astype(int), connectivity=2, return_num=True)
-    # print("\n There are {} elements in the image".format(num_elements))
+    # traces every element of the skeleton as a path-ordered fiber in one pass over the image
+    props = trace_fibers(img)
+    logger.debug("There are %d elements in %s", len(props), name)
     
-    props = skimage.measure.regionprops(label_image)
+    # corrected lengths for all elements at once
+    corr_pixel_lengths = corrected_pixel_lengths(img)
+    for element in props:
+        element.corrected_length = corr_pixel_lengths[element.label - 1]
     
     if not isinstance(window_size, list):
         # print("Window size passed from args is:\n")
@@ -1110,11 +1362,17 @@ def analyze_all_curv(img, name, output_path, resolution, window_size, window_uni
     
     im_sumdf = [window_iter(props, name, i, window_unit, resolution, output_path, test, within_element) for i in window_size]
     
+    if len(window_size) > 1:
+        # window sweep: label the rows so that the results form one table keyed by image and window
+        for df, size in zip(im_sumdf, window_size):
+            df.insert(0, "window_unit", window_unit)
+            df.insert(0, "window_size", int(size) if window_unit == "px" and size is not None else size)
+            df.insert(0, "image", name)
+    
     im_sumdf = pd.concat(im_sumdf)
     
     return im_sumdf
 
-@blockPrint
 def window_iter(props, name, window_size, window_unit, resolution, output_path, test, within_element):
     
     tempdf = []
@@ -1139,9 +1397,8 @@ def window_iter(props, name, window_size, window_unit, resolution, output_path,
         
         within_im_curvdf2 = pd.DataFrame(within_im_curvdf, columns=['curv_mean', 'curv_median', 'length']).dropna()
         
-        output_path = make_subdirectory(output_path, append_name="analysis")
-        with pathlib.Path(output_path).joinpath("ImageSum_" + name + ".csv") as save_path:
-            within_im_curvdf2.to_csv(save_path)
+        save_path = pathlib.Path(output_path).joinpath("analysis", "ImageSum_" + name + ".csv")
+        within_im_curvdf2.to_csv(save_path)
         
         curv_mean_im_mean = within_im_curvdf2['curv_mean'].mean()
         curv_mean_im_median = within_im_curvdf2['curv_mean'].median()
@@ -1170,9 +1427,8 @@ def window_iter(props, name, window_size, window_unit, resolution, output_path,
 
         within_im_curvdf2 = within_im_curvdf.dropna()
 
-        output_path = make_subdirectory(output_path, append_name="analysis")
-        with pathlib.Path(output_path).joinpath("ImageSum_" + name + ".csv") as save_path:
-            within_im_curvdf2.to_csv(save_path)
+        save_path = pathlib.Path(output_path).joinpath("analysis", "ImageSum_" + name + ".csv")
+        within_im_curvdf2.to_csv(save_path)
 
         im_mean = within_im_curvdf2['curv'].mean()
         im_median = within_im_curvdf2['curv'].median()
@@ -1187,15 +1443,17 @@ def window_iter(props, name, window_size, window_unit, resolution, output_path,
         else:
             return im_sumdf
     
-def curvature_seq(input_file, output_path, resolution, window_size, window_unit, save_img, test, within_element):
+@drains_writes
+def curvature_seq(input_file, output_path, resolution, window_size, window_unit, save_img, test, within_element,
+                  ridge_filter="frangi", tile_workers=1, roi_factor=None, cache=None, digest=None):
     """Sequence of functions to be executed for calculating curvature in fibermorph.
 
     Parameters
     ----------
     input_file : str or pathlib Path object
         Path to image that needs to be analyzed.
-    output_path : str or pathlib Path object
-        Output directory
+    output_path : str, pathlib Path object or RunLayout
+        Output directory (see run_layout).
     resolution : int
         Number of pixels per mm in original image.
     window_size : float or float
@@ -1206,6 +1464,17 @@ def curvature_seq(input_file, output_path, resolution, window_size, window_unit,
         True or false for whether this is being run for validation tests.
     within_element
         True or False for whether to save spreadsheets with within element curvature values
+    ridge_filter : str
+        Ridge filter used by filter_curv, "frangi" or "frangi32".
+    tile_workers : int
+        Number of threads for the tiled filter, dilation and thinning stages within the image.
+    roi_factor : int or None
+        Downsampling factor of a coarse pass that limits filtering and thinning to the regions with fibers; None
+        processes the whole image.
+    cache : StageCache or None
+        Cache of the binarized image and the pruned skeleton (see stage_cache). None (default) runs every stage.
+    digest : str or None
+        SHA-256 of the input file, computed here if a cache is given without it.
 
     Returns
     -------
@@ -1213,40 +1482,75 @@ def curvature_seq(input_file, output_path, resolution, window_size, window_unit,
         Pandas DataFrame with curvature summary data for all images.
 
     """
+    
+    # a plain directory gets the run's subdirectories here (the driver passes its layout instead)
+    output_path = curvature_layout(output_path, save_img, within_element)
+    
+    # the stages each cached image depends on, see stage_cache
+    im_name = pathlib.Path(input_file).stem
+    binary_params = dict(ridge_filter=ridge_filter, roi_factor=roi_factor)
+    pruned_params = dict(binary_params, resolution=resolution)
+    binary_img = pruned_im = None
+    if cache is not None:
+        if digest is None:
+            digest = file_hash(input_file)
+        # cached stages are skipped, so they are only looked up when no stage images are being saved
+        if not save_img:
+            with stage("cache_get"):
+                pruned_im = cache.get("pruned", digest, pruned_params)
+                if pruned_im is None:
+                    binary_img = cache.get("binary", digest, binary_params)
         
     with tqdm(total=6, desc="curvature analysis sequence", unit="steps", position=1, leave=None) as pbar:
         for i in [input_file]:
-        
-            # filter
-            filter_img, im_name = filter_curv(input_file, output_path, save_img)
-            pbar.update(1)
-                
-            # binarize
-            binary_img = binarize_curv(filter_img, im_name, output_path, save_img)
-            pbar.update(1)
-        
-            # remove particles
-            clean_im = remove_particles(binary_img, output_path, im_name, minpixel=int(resolution/2), prune=False, save_img=save_img)
-            pbar.update(1)
-        
-            # skeletonize
-            skeleton_im = skeletonize(clean_im, im_name, output_path, save_img)
-            pbar.update(1)
-        
-            # prune
-            pruned_im = prune(skeleton_im, im_name, output_path, save_img)
-            pbar.update(1)
+            
+            if pruned_im is None:
+                if binary_img is None:
+                    # filter
+                    filter_img, im_name = filter_curv(input_file, output_path, save_img, ridge_filter, tile_workers,
+                                                      roi_factor)
+                    pbar.update(1)
+                    
+                    # binarize
+                    binary_img = binarize_curv(filter_img, im_name, output_path, save_img, tile_workers)
+                    if cache is not None:
+                        with stage("cache_put"):
+                            cache.put("binary", digest, binary_params, binary_img)
+                    pbar.update(1)
+                else:
+                    pbar.update(2)
+            
+                # remove particles
+                clean_im = remove_particles(binary_img, output_path, im_name, minpixel=int(resolution/2), prune=False, save_img=save_img)
+                pbar.update(1)
+            
+                # skeletonize
+                skeleton_im = skeletonize(clean_im, im_name, output_path, save_img, tile_workers, by_object=bool(roi_factor))
+                pbar.update(1)
+            
+                # prune
+                pruned_im = prune(skeleton_im, im_name, output_path, save_img)
+                if cache is not None:
+                    with stage("cache_put"):
+                        cache.put("pruned", digest, pruned_params, pruned_im)
+                pbar.update(1)
+            else:
+                pbar.update(5)
         
             # analyze
             im_df = analyze_all_curv(pruned_im, im_name, output_path, resolution, window_size, window_unit, test, within_element)
             pbar.update(1)
+    
+    # the image is only done once its saved stages are on disk
+    with stage("write_wait"):
+        wait_for_writes()
         
     return im_df
 
 
 # Main modules (organized in order of operations: raw2gray, curvature, section)
 
-def raw2gray(input_directory, output_location, file_type, jobs):
+def raw2gray(input_directory, output_location, file_type, jobs, profile=False):
     """Convert raw files to grayscale tiff files.
 
     Parameters
@@ -1259,6 +1563,8 @@ def raw2gray(input_directory, output_location, file_type, jobs):
         The extension for the raw files (e.g. ".RW2").
     jobs : int
         Number of jobs to run in parallel.
+    profile : bool
+        True to also profile each stage with cProfile and tracemalloc (see stage_timing).
 
     Returns
     -------
@@ -1272,28 +1578,45 @@ def raw2gray(input_directory, output_location, file_type, jobs):
     list.sort(file_list)  # sort the files
     # print(file_list)  # printed the sorted files
     
-    # print("There are {} files to convert".format(len(file_list)))
-    # print("\n\n")
-    
-    # print("Converting raw files into grayscale tiff files...\n")
+    logger.info("Converting %d raw files into grayscale tiff files", len(file_list))
     
     tiff_directory = make_subdirectory(output_location, append_name="tiff")
+    profile_dir = pathlib.Path(output_location).joinpath("profile") if profile else None
     
     with tqdm_joblib(tqdm(desc="raw2gray", total=len(file_list), unit="files", miniters=1)) as progress_bar:
         progress_bar.monitor_interval = 2
-        Parallel(n_jobs=jobs, verbose=0)(delayed(raw_to_gray)(f, tiff_directory) for f in file_list)
+        converted = Parallel(n_jobs=jobs, verbose=0)(
+            delayed(logged)(log_level(), recorded, pathlib.Path(f).stem, profile_dir, raw_to_gray, f, tiff_directory)
+            for f in file_list)
+    
+    # wall time, CPU time and peak memory of each stage, next to the tiff folder
+    timings = TimingReport()
+    for output_name, rows in converted:
+        timings.add(rows)
+    timings.save(output_location, profile_dir=profile_dir)
     
     # End the timer and then print out the how long it took
     total_end = timer()
     total_time = (total_end - total_start)
     
-    # This will print out the minutes to the console, with 2 decimal places.
-    tqdm.write("\n\nEntire analysis took: {}\n\n".format(convert(total_time)))
+    # This will log the time it took (shown unless --quiet).
+    logger.info("Entire analysis took: %s", convert(total_time))
     
     return True
 
 
-def curvature(input_directory, main_output_path, jobs, resolution, window_size, window_unit, save_img, within_element):
+def resume_directory(resume):
+    """Checks that the output directory of a run to be resumed exists and returns it as a pathlib object."""
+    output_path = pathlib.Path(resume)
+    if not output_path.is_dir():
+        raise FileNotFoundError("The run directory to resume doesn't exist: {}".format(output_path))
+    return output_path
+
+
+def curvature(input_directory, main_output_path, jobs, resolution, window_size, window_unit, save_img, within_element,
+              ridge_filter="frangi", roi_factor=None, parquet=False, ndjson=False, resume=None, cache_dir=None,
+              cache_size=CACHE_SIZE, pin=None, memory_limit=None, queue_dir=None, lease_timeout=LEASE_TIMEOUT,
+              profile=False):
     """Takes directory of grayscale tiff images and analyzes curvature for each curve/line in the image.
 
     Parameters
@@ -1303,7 +1626,7 @@ def curvature(input_directory, main_output_path, jobs, resolution, window_size,
     main_output_path : str or pathlib object
         Main output path as str or pathlib object.
     jobs : int
-        Number of jobs to run in parallel.
+        Number of cores to use, split between images analyzed in parallel and threads within each image.
     resolution : float
         Number of pixels per mm in original image.
     window_size : float or int
@@ -1314,6 +1637,39 @@ def curvature(input_directory, main_output_path, jobs, resolution, window_size,
         True or false for saving images for image processing steps.
     within_element
         True or False for whether to save spreadsheets with within element curvature values
+    ridge_filter : str
+        Ridge filter used to find the hairs, "frangi" or "frangi32".
+    roi_factor : int or None
+        Downsampling factor of a coarse pass that locates the hairs, so the full-resolution stages only process those
+        regions. None (default) processes whole images.
+    parquet : bool
+        True to also write the summary as a Parquet file (one row group per image, needs pyarrow).
+    ndjson : bool
+        True to also print each image's rows to stdout as newline-delimited JSON as soon as the image is done.
+    resume : str, pathlib object or None
+        Output directory of an earlier run to continue in (main_output_path is then not used). Images recorded in its
+        manifest with the same contents and parameters are not analyzed again, and their results are included in the
+        new summary. None (default) starts a new run directory.
+    cache_dir : str, pathlib object or None
+        Directory of a cache of the binarized images and pruned skeletons (see stage_cache), so that re-analyzing the
+        same images with other windows skips the image processing. None (default) uses no cache.
+    cache_size : int
+        Size limit of the cache in bytes.
+    pin : str or None
+        "core" or "numa" to pin each worker process to its own cores or NUMA node (see core_budget). None (default)
+        doesn't pin.
+    memory_limit : int or None
+        Memory in bytes that the images analyzed at once may use together, going by their estimated peaks (see
+        admission). None (default) runs as many images at once as the core budget allows.
+    queue_dir : str, pathlib object or None
+        Shared directory of a work queue (see work_queue), used as the run directory (main_output_path is then not
+        used). Every process started with the same queue directory claims images from it until all are done, and the
+        last one writes the summary. None (default) analyzes every image in this process.
+    lease_timeout : float
+        Seconds after which the images claimed by a process that stopped (e.g. crashed) go back to the queue.
+    profile : bool
+        True to also profile each stage with cProfile and tracemalloc (see stage_timing). Wall time, CPU time and peak
+        RSS of every stage are always recorded, in stage_timings.csv and the run report.
 
     Returns
     -------
@@ -1324,52 +1680,119 @@ def curvature(input_directory, main_output_path, jobs, resolution, window_size,
     
     total_start = timer()
     
-    # create an output directory for the analyses
+    cache = None if cache_dir is None else StageCache(cache_dir, cache_size)
+    
+    if resume is not None and queue_dir is not None:
+        raise ValueError("A queue run can't be resumed, as the queue itself keeps track of the images done")
+    
+    # create an output directory for the analyses, or continue in the one of an earlier run
     jetzt = datetime.now()
-    timestamp = jetzt.strftime("%b%d_%H%M_")
-    dir_name = str(timestamp + "fibermorph_curvature")
-    output_path = make_subdirectory(main_output_path, append_name=dir_name)
+    if queue_dir is not None:
+        output_path = make_subdirectory(queue_dir)
+    elif resume is None:
+        timestamp = jetzt.strftime("%b%d_%H%M_")
+        dir_name = str(timestamp + "fibermorph_curvature")
+        output_path = make_subdirectory(main_output_path, append_name=dir_name)
+    else:
+        output_path = resume_directory(resume)
+    # the subdirectories the stages write to are created once, here
+    layout = curvature_layout(output_path, save_img, within_element)
     
     file_list = list_images(input_directory)
+    params = dict(module="curvature", resolution=resolution, window_size=window_size, window_unit=window_unit,
+                  within_element=within_element, ridge_filter=ridge_filter, roi_factor=roi_factor)
+    
+    if queue_dir is None:
+        # images analyzed before with the same contents and parameters are taken from the run manifest
+        manifest = RunManifest(output_path, input_directory, params)
+        digests = manifest.hashes(file_list, jobs)
+        done = {input_file: manifest.lookup(input_file, digests[input_file]) for input_file in file_list}
+        todo = [input_file for input_file in file_list if done[input_file] is None]
+    else:
+        # the queue records which images are done; inputs are hashed by the stage cache if it needs them
+        queue = WorkQueue(output_path, input_directory, params, lease_timeout)
+        digests = {}
+        done = {}
+        todo = file_list
+    
+    # images are admitted as their estimated peak memory fits in the limit, largest first
+    memory = MemoryBudget(todo, memory_limit, "curvature", ridge_filter)
+    todo = memory.order(todo)
+    if queue_dir is None:
+        rounds = [todo]
+    else:
+        # images are claimed from the queue, and this process waits for the others before the summary is merged
+        todo = queue.populate(todo)
+        rounds = queue.rounds()
+    
+    # cores left idle by having fewer images than jobs go to tiles and native threads within each image
+    budget = CoreBudget(len(todo), jobs, pin, memory.max_workers)
+    tile_workers = budget.threads
+    update_report(output_path, core_budget=budget.report(), memory_budget=memory.report())
+    logger.info("Core budget: %s", budget.describe())
+    if memory_limit is not None:
+        logger.info("Memory budget: %s", memory.describe())
     
     # List expression for curv df per image
     # im_df = [curvature_seq(input_file, filtered_dir, binary_dir, pruned_dir, clean_dir, skeleton_dir, analysis_dir,
     # resolution, window_size_mm, save_img) for input_file in file_list]
     
-    # This is the old parallel jobs function
-    with tqdm_joblib(tqdm(desc="curvature", total=len(file_list), unit="files", miniters=1)) as progress_bar:
+    timestamp = jetzt.strftime("_%b%d_%H%M")
+    summary_name = "curvature_summary_data{}".format(timestamp)
+    summary_paths = [pathlib.Path(output_path).joinpath(summary_name + ext) for ext in [".csv", ".parquet"]]
+    if queue_dir is not None:
+        # in a queue run, each process writes its own images' rows to nodes/ and the summary is merged at the end
+        merged_paths = [pathlib.Path(output_path).joinpath("curvature_summary_data" + ext)
+                        for ext in [".csv", ".parquet"]]
+        summary_paths = [queue.node_path(path.name) for path in summary_paths]
+    
+    # wall time, CPU time and peak memory of each stage of each image (see stage_timing)
+    timings = TimingReport()
+    profile_dir = pathlib.Path(output_path).joinpath("profile") if profile else None
+    
+    # results are written as each image finishes, so the summary holds every finished image even if the run stops
+    with ResultWriter(summary_paths[0], parquet_path=summary_paths[1] if parquet else None,
+                      ndjson_stream=sys.stdout if ndjson else None) as writer, budget, memory, \
+            (queue if queue_dir is not None else contextlib.nullcontext()), \
+            tqdm_joblib(tqdm(desc="curvature", total=len(todo), unit="files", miniters=1)) as progress_bar:
         progress_bar.monitor_interval = 2
-        im_df = (Parallel(n_jobs=jobs, verbose=0)(
-            delayed(curvature_seq)(input_file, output_path,
-                                   resolution, window_size, window_unit, save_img, test=False, within_element=within_element) for
-            input_file in file_list))
-    
-    summary_df = pd.concat(im_df)
-    
-    # print("This is the summary dataframe for the current sample")
-    # print(summary_df)
-    
-    # print("You've got data...")
-    # print(summary_df)
+        for input_file in file_list:
+            writer.write(done.get(input_file))
+        for todo_round in rounds:
+            im_df = Parallel(n_jobs=budget.workers, verbose=0, return_as="generator_unordered")(
+                budget.task(logged, log_level(), admitted, memory.gate, memory.need(input_file), keyed, input_file,
+                            recorded, input_file.stem, profile_dir, curvature_seq, input_file, layout, resolution,
+                            window_size, window_unit, save_img, test=False, within_element=within_element,
+                            ridge_filter=ridge_filter, tile_workers=tile_workers, roi_factor=roi_factor, cache=cache,
+                            digest=digests.get(input_file)) for
+                input_file in todo_round)
+            for input_file, (df, rows) in im_df:
+                timings.add(rows)
+                if queue_dir is None:
+                    manifest.record(input_file, digests[input_file], df)
+                else:
+                    queue.complete(input_file, df)
+                writer.write(df)
     
-    jetzt = datetime.now()
-    timestamp = jetzt.strftime("_%b%d_%H%M")
+    if queue_dir is not None and queue.merge(merged_paths[0], merged_paths[1] if parquet else None):
+        logger.info("Merged the results of all images into the summary")
     
-    with pathlib.Path(output_path).joinpath("curvature_summary_data{}.csv".format(timestamp)) as output_path:
-        summary_df.to_csv(output_path)
-        # print(output_path)
+    timings.save(output_path, queue.node_path(TIMINGS_NAME) if queue_dir is not None else None, profile_dir)
+    logger.info("Stage times: %s", timings.describe())
     
     # End the timer and then print out the how long it took
     total_end = timer()
     total_time = (total_end - total_start)
     
-    # This will print out the minutes to the console, with 2 decimal places.
-    tqdm.write("\n\nComplete analysis took: {}\n\n".format(convert(total_time)))
+    # This will log the time it took (shown unless --quiet).
+    logger.info("Complete analysis took: %s", convert(total_time))
     
     return True
 
 
-def section(input_directory, main_output_path, jobs, resolution, minsize, maxsize, save_img):
+def section(input_directory, main_output_path, jobs, resolution, minsize, maxsize, save_img, parquet=False,
+            ndjson=False, resume=None, pin=None, memory_limit=None, queue_dir=None, lease_timeout=LEASE_TIMEOUT,
+            profile=False, segmenter="chan_vese", all_sections=False):
     """Takes directory of grayscale images (and locates central section where necessary) and analyzes cross-sectional
     properties for each image.
 
@@ -1380,13 +1803,44 @@ def section(input_directory, main_output_path, jobs, resolution, minsize, maxsiz
     main_output_path : str or pathlib object
         Main output path as str or pathlib object.
     jobs : int
-        Number of jobs to run in parallel.
+        Number of cores to use, split between images analyzed in parallel and threads within each image.
     resolution : float
         Number of pixels per micrometer in the image.
     minsize : int
         Minimum diameter for sections.
     maxsize : int
         Maximum diameter for sections.
+    save_img : bool
+        True or false for saving images for image processing steps.
+    parquet : bool
+        True to also write the summary as a Parquet file (one row group per image, needs pyarrow).
+    ndjson : bool
+        True to also print each image's rows to stdout as newline-delimited JSON as soon as the image is done.
+    resume : str, pathlib object or None
+        Output directory of an earlier run to continue in (main_output_path is then not used). Images recorded in its
+        manifest with the same contents and parameters are not analyzed again, and their results are included in the
+        new summary. None (default) starts a new run directory.
+    pin : str or None
+        "core" or "numa" to pin each worker process to its own cores or NUMA node (see core_budget). None (default)
+        doesn't pin.
+    memory_limit : int or None
+        Memory in bytes that the images analyzed at once may use together, going by their estimated peaks (see
+        admission). None (default) runs as many images at once as the core budget allows.
+    queue_dir : str, pathlib object or None
+        Shared directory of a work queue (see work_queue), used as the run directory (main_output_path is then not
+        used). Every process started with the same queue directory claims images from it until all are done, and the
+        last one writes the summary. None (default) analyzes every image in this process.
+    lease_timeout : float
+        Seconds after which the images claimed by a process that stopped (e.g. crashed) go back to the queue.
+    profile : bool
+        True to also profile each stage with cProfile and tracemalloc (see stage_timing). Wall time, CPU time and peak
+        RSS of every stage are always recorded, in stage_timings.csv and the run report.
+    segmenter : str
+        Segmentation of grayscale sections, "chan_vese" (default) or the faster "threshold" (see
+        section_segmentation).
+    all_sections : bool
+        True to measure every section in each image, one row per section with its number and centroid (see
+        segment_sections). False (default) measures the section nearest the center of each image.
 
     Returns
     -------
@@ -1397,6 +1851,9 @@ def section(input_directory, main_output_path, jobs, resolution, minsize, maxsiz
     
     total_start = timer()
     
+    if segmenter not in SEGMENT_FUNCTIONS:
+        raise ValueError("segmenter must be one of {}, not {!r}".format(list(SEGMENT_FUNCTIONS), segmenter))
+    
     # Change to the folder for reading images
     file_list = list_images(input_directory)
     
@@ -1406,28 +1863,98 @@ def section(input_directory, main_output_path, jobs, resolution, minsize, maxsiz
     
     # Creating subdirectories for cropped images
     
-    jetzt = datetime.now()
-    timestamp = jetzt.strftime("%b%d_%H%M_")
-    dir_name = str(timestamp + "fibermorph_section")
-    output_path = make_subdirectory(main_output_path, append_name=dir_name)
+    if resume is not None and queue_dir is not None:
+        raise ValueError("A queue run can't be resumed, as the queue itself keeps track of the images done")
+    
+    if queue_dir is not None:
+        output_path = make_subdirectory(queue_dir)
+    elif resume is None:
+        jetzt = datetime.now()
+        timestamp = jetzt.strftime("%b%d_%H%M_")
+        dir_name = str(timestamp + "fibermorph_section")
+        output_path = make_subdirectory(main_output_path, append_name=dir_name)
+    else:
+        output_path = resume_directory(resume)
+    # the subdirectories the stages write to are created once, here
+    layout = section_layout(output_path, save_img)
+    
+    params = dict(module="section", resolution=resolution, minsize=minsize, maxsize=maxsize, segmenter=segmenter,
+                  all_sections=all_sections)
+    if queue_dir is None:
+        # images analyzed before with the same contents and parameters are taken from the run manifest
+        manifest = RunManifest(output_path, input_directory, params)
+        digests = manifest.hashes(file_list, jobs)
+        done = {f: manifest.lookup(f, digests[f]) for f in file_list}
+        todo = [f for f in file_list if done[f] is None]
+    else:
+        # the queue records which images are done
+        queue = WorkQueue(output_path, input_directory, params, lease_timeout)
+        done = {}
+        todo = file_list
+    
+    # images are admitted as their estimated peak memory fits in the limit, largest first
+    memory = MemoryBudget(todo, memory_limit, "section")
+    todo = memory.order(todo)
+    if queue_dir is None:
+        rounds = [todo]
+    else:
+        # images are claimed from the queue, and this process waits for the others before the summary is merged
+        todo = queue.populate(todo)
+        rounds = queue.rounds()
+    
+    # cores left idle by having fewer images than jobs go to native threads within each image
+    budget = CoreBudget(len(todo), jobs, pin, memory.max_workers)
+    update_report(output_path, core_budget=budget.report(), memory_budget=memory.report())
+    logger.info("Core budget: %s", budget.describe())
+    if memory_limit is not None:
+        logger.info("Memory budget: %s", memory.describe())
     
     # section_df = [analyze_section(f, output_im_path, minsize, maxsize, resolution) for f in file_list]
     
-    with tqdm_joblib(tqdm(desc="section", total=len(file_list), unit="files", miniters=1)) as progress_bar:
+    summary_paths = [pathlib.Path(output_path).joinpath("summary_section_data" + ext) for ext in [".csv", ".parquet"]]
+    if queue_dir is not None:
+        # in a queue run, each process writes its own images' rows to nodes/ and the summary is merged at the end
+        merged_paths = summary_paths
+        summary_paths = [queue.node_path(path.name) for path in summary_paths]
+    
+    # wall time, CPU time and peak memory of each stage of each image (see stage_timing)
+    timings = TimingReport()
+    profile_dir = pathlib.Path(output_path).joinpath("profile") if profile else None
+    
+    # results are written as each image finishes, so the summary holds every finished image even if the run stops
+    with ResultWriter(summary_paths[0], parquet_path=summary_paths[1] if parquet else None,
+                      ndjson_stream=sys.stdout if ndjson else None) as writer, budget, memory, \
+            (queue if queue_dir is not None else contextlib.nullcontext()), \
+            tqdm_joblib(tqdm(desc="section", total=len(todo), unit="files", miniters=1)) as progress_bar:
         progress_bar.monitor_interval = 2
-        section_df = (Parallel(n_jobs=jobs, verbose=0)(
-            delayed(section_seq)(f, output_path, resolution, minsize, maxsize, save_img) for f in file_list))
+        for f in file_list:
+            writer.write(done.get(f))
+        for todo_round in rounds:
+            section_df = Parallel(n_jobs=budget.workers, verbose=0, return_as="generator_unordered")(
+                budget.task(logged, log_level(), admitted, memory.gate, memory.need(f), keyed, f, recorded, f.stem,
+                            profile_dir, section_seq, f, layout, resolution, minsize, maxsize, save_img, segmenter,
+                            all_sections)
+                for f in todo_round)
+            for f, (df, rows) in section_df:
+                timings.add(rows)
+                if df is not None and not df.empty:
+                    df = df.dropna().set_index('ID')
+                if queue_dir is None:
+                    manifest.record(f, digests[f], df)
+                else:
+                    queue.complete(f, df)
+                writer.write(df)
     
-    section_df = pd.concat(section_df).dropna()
-    section_df.set_index('ID', inplace=True)
+    if queue_dir is not None and queue.merge(merged_paths[0], merged_paths[1] if parquet else None):
+        logger.info("Merged the results of all images into the summary")
     
-    with pathlib.Path(output_path).joinpath("summary_section_data.csv") as df_output_path:
-        section_df.to_csv(df_output_path)
+    timings.save(output_path, queue.node_path(TIMINGS_NAME) if queue_dir is not None else None, profile_dir)
+    logger.info("Stage times: %s", timings.describe())
     
     # End the timer and then print out the how long it took
     total_end = timer()
     total_time = int(total_end - total_start)
     
-    tqdm.write("\n\nComplete analysis took: {}\n\n".format(convert(total_time)))
+    logger.info("Complete analysis took: %s", convert(total_time))
     
     return True
\ No newline at end of file
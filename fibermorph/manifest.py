@@ -0,0 +1,158 @@
+"""
+Run manifest for resuming interrupted batch runs.
+
+Every image that curvature() or section() finishes is recorded as one line of manifest.jsonl in the run's output
+directory: the image's path (relative to the input directory), the SHA-256 of its contents, the analysis parameters
+(including the fibermorph version) and the result rows it produced. A run started with --resume on that directory
+reads the manifest back, reuses the rows of every image whose contents and parameters are unchanged, and only
+analyzes new or changed images. Lines are appended and flushed one image at a time, so a killed run loses at most the
+images that were still in progress.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from _version import __version__
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 hex digest of a file's contents, read in chunks.
+
+    Parameters
+    ----------
+    path : str or pathlib object
+        Path of the file.
+    chunk_size : int
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    str
+        The hex digest.
+
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def keyed(key, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) and returns (key, result), so results that arrive out of order can be matched."""
+    return key, func(*args, **kwargs)
+
+
+def _native(value):
+    # numpy scalars in indexes and object columns are not JSON serializable
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def frame_to_rows(df):
+    """A result DataFrame (or None) as a JSON-serializable dict, read back by rows_to_frame."""
+    if df is None:
+        df = pd.DataFrame()
+    rows = df.to_dict(orient="split")
+    rows["index_name"] = df.index.name
+    return rows
+
+
+def rows_to_frame(rows):
+    """The DataFrame of a dict made by frame_to_rows."""
+    index = pd.Index(rows["index"], name=rows["index_name"])
+    return pd.DataFrame(rows["data"], index=index, columns=rows["columns"])
+
+
+class RunManifest(object):
+    """Record of the images analyzed in a run output directory, with their results.
+
+    Parameters
+    ----------
+    output_path : str or pathlib object
+        Run output directory holding (or receiving) manifest.jsonl.
+    input_directory : str or pathlib object
+        Directory the images are listed from (entries are keyed by the path relative to it).
+    params : dict
+        Analysis parameters that the results depend on. The fibermorph version is added to them. Entries recorded
+        with other parameters are ignored.
+
+    """
+
+    def __init__(self, output_path, input_directory, params):
+        self.path = pathlib.Path(output_path).joinpath(MANIFEST_NAME)
+        self.input_directory = pathlib.Path(input_directory)
+        # round trip through JSON so that the parameters compare equal to the ones read back from the file
+        self.params = json.loads(json.dumps(dict(params, version=__version__), default=_native))
+        self.entries = {}
+
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short when a run was killed
+                        continue
+                    if entry.get("params") == self.params:
+                        self.entries[(entry["file"], entry["sha256"])] = entry
+
+    def name(self, input_file):
+        """Key of an input file: its path relative to the input directory."""
+        return pathlib.Path(input_file).relative_to(self.input_directory).as_posix()
+
+    def hashes(self, file_list, jobs=1):
+        """Content hashes of the input files, computed on `jobs` threads (hashlib releases the GIL)."""
+        digests = Parallel(n_jobs=jobs, backend="threading")(delayed(file_hash)(f) for f in file_list)
+        return dict(zip(file_list, digests))
+
+    def lookup(self, input_file, digest):
+        """Result rows recorded for an input file with these contents and parameters.
+
+        Parameters
+        ----------
+        input_file : str or pathlib object
+            Path of the image.
+        digest : str
+            SHA-256 of the image (see file_hash).
+
+        Returns
+        -------
+        pd.DataFrame or None
+            The recorded results (possibly empty), or None if the image has not been analyzed yet.
+
+        """
+        entry = self.entries.get((self.name(input_file), digest))
+        if entry is None:
+            return None
+        return rows_to_frame(entry["rows"])
+
+    def record(self, input_file, digest, df):
+        """Appends the results of one image to the manifest.
+
+        Parameters
+        ----------
+        input_file : str or pathlib object
+            Path of the image.
+        digest : str
+            SHA-256 of the image (see file_hash).
+        df : pd.DataFrame or None
+            Results of the image.
+
+        """
+        entry = {"file": self.name(input_file), "sha256": digest, "params": self.params, "rows": frame_to_rows(df)}
+        # NaN is written as the NaN token (not strict JSON, but read back exactly by json.loads)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, default=_native) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[(entry["file"], digest)] = entry
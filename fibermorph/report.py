@@ -0,0 +1,44 @@
+"""
+Run report: how a curvature or section run was set up, as JSON in run_report.json in the run directory.
+
+Each part of the set-up adds its own section (e.g. "core_budget"). Sections are merged into the existing report, so a
+resumed run keeps what earlier runs recorded unless it records the same section again.
+"""
+
+import json
+import os
+import pathlib
+import tempfile
+
+REPORT_NAME = "run_report.json"
+
+
+def read_report(output_path):
+    """The run report of a run directory as a dict (empty if there is none)."""
+    path = pathlib.Path(output_path).joinpath(REPORT_NAME)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_report(output_path, **sections):
+    """Adds or replaces sections of the run report of a run directory.
+
+    Parameters
+    ----------
+    output_path : str or pathlib object
+        Run output directory.
+    **sections
+        Report sections, each a JSON-serializable value.
+
+    """
+    path = pathlib.Path(output_path).joinpath(REPORT_NAME)
+    report = read_report(output_path)
+    report.update(sections)
+    # written to a temporary file first so that the report is never left half-written (the name is unique, as
+    # processes on several nodes may share the run directory, see work_queue)
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name, suffix=".tmp", dir=path.parent)
+    with os.fdopen(fd, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
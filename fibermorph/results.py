@@ -0,0 +1,106 @@
+"""
+Streaming output of the per-image results.
+
+curvature() and section() hand every image's DataFrame to a ResultWriter as soon as its job finishes, instead of
+concatenating all of them at the end. Each DataFrame is appended to the summary CSV (the header is written once) and
+flushed, so the file always holds every finished image and a crash late in a batch keeps the earlier results. The same
+rows can also go to a Parquet file, one row group per image, and to a stream (e.g. stdout) as newline-delimited JSON
+for tools that consume results while the batch is running. Parquet needs the optional pyarrow package.
+"""
+
+import pathlib
+
+
+class ResultWriter(object):
+    """Appends per-image result DataFrames to a CSV file and, optionally, a Parquet file and an NDJSON stream.
+
+    Can be used as a context manager, which closes the files on exit.
+
+    Parameters
+    ----------
+    csv_path : str or pathlib object
+        Path of the CSV file (created, or overwritten if it exists).
+    parquet_path : str, pathlib object or None
+        Path of the Parquet file. None (default) writes no Parquet file.
+    ndjson_stream : file-like object or None
+        Text stream that receives one JSON object per row (the index is included under its name). None (default)
+        writes no NDJSON.
+
+    """
+
+    def __init__(self, csv_path, parquet_path=None, ndjson_stream=None):
+        self.csv_path = pathlib.Path(csv_path)
+        self.parquet_path = None if parquet_path is None else pathlib.Path(parquet_path)
+        self.ndjson_stream = ndjson_stream
+        self.columns = None
+        self.rows = 0
+
+        if self.parquet_path is not None:
+            try:
+                import pyarrow  # noqa: F401
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise ImportError("Writing Parquet output requires the pyarrow package (pip install pyarrow)")
+
+        self._csv = open(self.csv_path, "w", newline="")
+        self._parquet = None
+        self._schema = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df):
+        """Appends the rows of one result DataFrame.
+
+        Parameters
+        ----------
+        df : pd.DataFrame or None
+            Results of one image. None and empty DataFrames are skipped. Columns are put in the order of the first
+            DataFrame written.
+
+        """
+        if df is None or df.empty:
+            return
+
+        if self.columns is None:
+            self.columns = list(df.columns)
+        else:
+            df = df.reindex(columns=self.columns)
+
+        df.to_csv(self._csv, header=(self.rows == 0))
+        self._csv.flush()
+
+        if self.parquet_path is not None:
+            self._write_parquet(df)
+
+        if self.ndjson_stream is not None:
+            records = df.reset_index() if df.index.name is not None else df
+            # to_json writes NaN as null, so every line stays valid JSON
+            self.ndjson_stream.write(records.to_json(orient="records", lines=True).rstrip("\n") + "\n")
+            self.ndjson_stream.flush()
+
+        self.rows += len(df)
+
+    def _write_parquet(self, df):
+        import pyarrow
+        import pyarrow.parquet
+
+        preserve_index = df.index.name is not None
+        if self._parquet is None:
+            table = pyarrow.Table.from_pandas(df, preserve_index=preserve_index)
+            self._schema = table.schema
+            self._parquet = pyarrow.parquet.ParquetWriter(str(self.parquet_path), self._schema)
+        else:
+            # later images may infer other dtypes (e.g. all-NaN columns), so they are cast to the first schema
+            table = pyarrow.Table.from_pandas(df, schema=self._schema, preserve_index=preserve_index)
+        self._parquet.write_table(table)
+
+    def close(self):
+        """Closes the CSV and Parquet files (the NDJSON stream is left open)."""
+        self._csv.close()
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
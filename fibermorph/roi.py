@@ -0,0 +1,119 @@
+"""
+Coarse localisation of fibers, so that the full-resolution curvature stages only process the regions with hairs.
+
+A copy of the image downsampled by block averages is ridge filtered and thresholded like binarize_curv. The image is
+divided into a grid of ROI_CELL x ROI_CELL cells, and the cells holding detected pixels (grown by a margin) are joined
+into boxes, along each grid row and then across rows where the runs line up. Following the cells rather than each fiber's bounding box keeps long curved fibers from
+claiming the empty space they enclose. filter_curv then filters only these boxes (each with the halo the filter needs,
+see tiling.tiled_frangi). Because the threshold, border clearing and particle removal still run on the whole image,
+pixels outside the boxes just count as background.
+"""
+
+import numpy as np
+import scipy.ndimage
+import skimage.exposure
+import skimage.filters
+import skimage.morphology
+import skimage.transform
+
+
+# full-resolution margin around detected fibers, covering the dilation in binarize_curv and the coarse pixel size
+ROI_MARGIN = 32
+
+# side of the grid cells that make up the regions, in full-resolution pixels
+ROI_CELL = 512
+
+# scales of the ridge filter on the downsampled image
+COARSE_SIGMAS = [1, 2]
+
+
+def fiber_rois(gray_img, factor, margin=ROI_MARGIN, cell_size=ROI_CELL):
+    """Finds the regions of an image that contain fibers from a downsampled copy.
+
+    Parameters
+    ----------
+    gray_img : np.ndarray
+        Grayscale image (dark fibers on a light background).
+    factor : int
+        Downsampling factor (4-8 works well for hair images).
+    margin : int
+        Full-resolution margin added around the detected fibers.
+    cell_size : int
+        Side of the grid cells in full-resolution pixels (rounded down to a multiple of `factor`).
+
+    Returns
+    -------
+    list
+        List of disjoint (row slice, col slice) tuples in full-resolution coordinates, one per run of neighbouring
+        grid cells along a row of the grid (runs spanning the same columns in consecutive rows are joined).
+
+    """
+    coarse = skimage.transform.downscale_local_mean(np.asarray(gray_img, dtype=float), (factor, factor))
+    ridges = skimage.exposure.adjust_log(skimage.filters.frangi(coarse, sigmas=COARSE_SIGMAS))
+    try:
+        detected = ridges > skimage.filters.threshold_otsu(ridges)
+    except ValueError:
+        # flat image, nothing to find
+        return []
+
+    grow = int(np.ceil(margin / factor))
+    detected = scipy.ndimage.binary_dilation(detected, structure=np.ones((3, 3)), iterations=grow)
+
+    # grid cells holding any detected pixel
+    cell = max(cell_size // factor, 1)
+    grid_rows, grid_cols = -(-detected.shape[0] // cell), -(-detected.shape[1] // cell)
+    padded = np.zeros((grid_rows * cell, grid_cols * cell), dtype=bool)
+    padded[:detected.shape[0], :detected.shape[1]] = detected
+    active = padded.reshape(grid_rows, cell, grid_cols, cell).any(axis=(1, 3))
+
+    # runs of active cells along each grid row, stacked with the run above when they span the same columns
+    boxes = []
+    open_runs = {}
+    for i, row in enumerate(active):
+        runs = np.flatnonzero(np.diff(np.r_[0, row.astype(int), 0])).reshape(-1, 2)
+        current = {}
+        for start, stop in runs.tolist():
+            if (start, stop) in open_runs:
+                current[(start, stop)] = open_runs.pop((start, stop))
+            else:
+                current[(start, stop)] = [i, i + 1, start, stop]
+                boxes.append(current[(start, stop)])
+            current[(start, stop)][1] = i + 1
+        open_runs = current
+
+    height, width = np.shape(gray_img)
+    step = cell * factor
+    return [(slice(r0 * step, min(r1 * step, height)), slice(c0 * step, min(c1 * step, width)))
+            for r0, r1, c0, c1 in boxes]
+
+
+def thin_objects(img):
+    """skimage.morphology.thin applied object by object, on the bounding box of each 8-connected object.
+
+    Thinning decides each pixel from its 3 x 3 neighbourhood, which never holds pixels of another 8-connected object,
+    so this gives exactly thin(img) while skipping the empty parts of a sparse image.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        Binary image.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean array with the thinned image.
+
+    """
+    img = np.asarray(img, dtype=bool)
+    labels, num_labels = scipy.ndimage.label(img, structure=np.ones((3, 3)))
+    objects = scipy.ndimage.find_objects(labels)
+
+    # on dense images the boxes overlap so much that one pass over the whole image is cheaper
+    if sum(np.prod([s.stop - s.start for s in box]) for box in objects) >= img.size:
+        return skimage.morphology.thin(img)
+
+    skeleton = np.zeros_like(img)
+    for label, box in enumerate(objects, start=1):
+        obj = labels[box] == label
+        skeleton[box] |= skimage.morphology.thin(obj)
+    return skeleton
@@ -0,0 +1,91 @@
+"""
+Subdirectories of a run's output directory, created once when the run starts.
+
+The stages write into fixed subdirectories of the run directory: the saved images of each curvature stage (filtered,
+binarized, clean, pruned, skeletonized) and of the section module (crop, binary), the per-window summaries of each
+image (analysis) and the per-fiber curvatures (WithinElement). A RunLayout creates the ones a run will use up front,
+so the stages join paths instead of checking for (and creating) directories for every image, window and fiber.
+
+A RunLayout is a path-like object for the run directory, so it is passed down as the output path and pathlib and
+os accept it as is. Functions that are also called on their own (curvature_seq, section_seq, analyze_all_curv) take a
+plain directory too, and then create the layout themselves (see curvature_layout and section_layout).
+"""
+
+import os
+import pathlib
+
+# subdirectories of the saved images of each stage
+CURVATURE_IMAGES = ["filtered", "binarized", "clean", "skeletonized", "pruned"]
+SECTION_IMAGES = ["crop", "binary"]
+
+
+class RunLayout(os.PathLike):
+    """Run directory and the subdirectories its stages write to.
+
+    Parameters
+    ----------
+    path : str or pathlib object
+        Run directory (created if it doesn't exist).
+    subdirectories : list
+        Names of the subdirectories to create.
+
+    """
+
+    def __init__(self, path, subdirectories=()):
+        self.path = pathlib.Path(path)
+        self.subdirectories = list(subdirectories)
+        for name in [""] + self.subdirectories:
+            self.path.joinpath(name).mkdir(parents=True, exist_ok=True)
+
+    def __fspath__(self):
+        return os.fspath(self.path)
+
+    def __repr__(self):
+        return "RunLayout({!r}, {!r})".format(str(self.path), self.subdirectories)
+
+    def joinpath(self, *parts):
+        """Path within the run directory, e.g. layout.joinpath("analysis", name)."""
+        return self.path.joinpath(*parts)
+
+
+def curvature_layout(output_path, save_img=False, within_element=False):
+    """Layout of a curvature run in output_path, or output_path itself if it already is one.
+
+    Parameters
+    ----------
+    output_path : str, pathlib object or RunLayout
+        Run directory.
+    save_img : bool
+        True if the images of the stages are saved.
+    within_element : bool
+        True if the curvatures within each fiber are saved.
+
+    Returns
+    -------
+    RunLayout
+
+    """
+    if isinstance(output_path, RunLayout):
+        return output_path
+    return RunLayout(output_path, ["analysis"] + (["WithinElement"] if within_element else []) +
+                     (CURVATURE_IMAGES if save_img else []))
+
+
+def section_layout(output_path, save_img=False):
+    """Layout of a section run in output_path, or output_path itself if it already is one.
+
+    Parameters
+    ----------
+    output_path : str, pathlib object or RunLayout
+        Run directory.
+    save_img : bool
+        True if the crops and binary images are saved.
+
+    Returns
+    -------
+    RunLayout
+
+    """
+    if isinstance(output_path, RunLayout):
+        return output_path
+    return RunLayout(output_path, SECTION_IMAGES if save_img else [])
@@ -0,0 +1,139 @@
+"""
+Segmentation engines for the cropped cross-sections of section_seq.
+
+"chan_vese" (the default) refines the threshold_minimum mask with 40 iterations of
+skimage.segmentation.morphological_chan_vese over the whole crop. Each iteration smooths and re-evaluates every pixel
+of the crop, which takes seconds per section and most of the time of a section run.
+
+"threshold" keeps the threshold_minimum mask, fills its holes, and measures the selected section to sub-pixel
+precision instead of refining the mask. In micrographs the boundary of a section is blurred over a few pixels, and the
+gray value of a boundary pixel is proportional to the part of it the section covers. Within BAND pixels of the mask
+boundary, each pixel therefore counts by its gray value between the median of the section interior and the median of
+the background around it (clipped to [0, 1]); deeper pixels count fully and farther ones not at all. The area, axis
+lengths and eccentricity come from the moments of these weights. This takes a few tens of milliseconds per section.
+
+On blurred and noisy sim_ellipse sections (see benchmarks/section_segmentation.py), both engines measure the area and
+diameters within 0.1% of the true values, about 80 times faster with "threshold", while measuring the threshold mask
+itself would underestimate the area by about 1%. The band must be wider than the blur of the boundary, which the
+default of 8 pixels is for sections in focus at the resolution of the test data.
+"""
+
+import numpy as np
+import pandas as pd
+import skimage.filters
+import skimage.segmentation
+from scipy import ndimage
+
+SEGMENTERS = ["chan_vese", "threshold"]
+
+# half-width in pixels of the boundary band measured at sub-pixel precision by the threshold engine
+BAND = 8
+
+
+def chan_vese(crop_im, init_mask=None):
+    """Mask of the dark objects of a crop, by morphological Chan-Vese from the threshold_minimum mask (or from
+    init_mask, the threshold mask of the whole image cut out at the crop)."""
+    bin_ls_set = init_mask if init_mask is not None else crop_im < skimage.filters.threshold_minimum(crop_im)
+    seg_im = skimage.segmentation.morphological_chan_vese(np.asarray(crop_im), 40, init_level_set=bin_ls_set,
+                                                          smoothing=4)
+    return np.asarray(seg_im != 0)
+
+
+def threshold_fill(crop_im, init_mask=None):
+    """Mask of the dark objects of a crop: threshold_minimum (or init_mask, as in chan_vese) with the holes of the
+    objects filled."""
+    if init_mask is None:
+        init_mask = np.asarray(crop_im) < skimage.filters.threshold_minimum(crop_im)
+    return ndimage.binary_fill_holes(init_mask)
+
+
+SEGMENT_FUNCTIONS = {"chan_vese": chan_vese, "threshold": threshold_fill}
+
+
+def coverage(gray, mask, band=BAND):
+    """Fraction of each pixel covered by a dark object, from its mask and the gray values around its boundary.
+
+    Parameters
+    ----------
+    gray : np.ndarray
+        Gray values of a window around the object, with at least `band` pixels of background on every side.
+    mask : np.ndarray
+        Binary mask of the object in the same window.
+    band : int
+        Half-width in pixels of the band around the mask boundary where the coverage is estimated from the gray values.
+
+    Returns
+    -------
+    np.ndarray
+        Coverage in [0, 1] (float64), shaped like the window.
+
+    """
+    gray = np.asarray(gray, dtype=float)
+    inner = ndimage.distance_transform_edt(mask) > band
+    outer = ndimage.distance_transform_edt(~mask) > band
+    # a section thinner than the band has no interior: its darkest pixels stand in for it
+    foreground = np.median(gray[inner]) if inner.any() else np.percentile(gray[mask], 10)
+    background = np.median(gray[outer])
+    if background <= foreground:
+        return mask.astype(float)
+    weights = np.clip((background - gray) / (background - foreground), 0, 1)
+    weights[inner] = 1
+    weights[outer] = 0
+    return weights
+
+
+def moment_measures(weights):
+    """Area (in pixels), minor and major axis lengths and eccentricity of a weighted region (or of a binary mask).
+
+    The axis lengths follow skimage.measure.regionprops: four times the square roots of the eigenvalues of the
+    (weighted) inertia tensor.
+    """
+    area = weights.sum()
+    rr, cc = np.indices(weights.shape)
+    r0 = (weights * rr).sum() / area
+    c0 = (weights * cc).sum() / area
+    mu20 = (weights * (rr - r0) ** 2).sum() / area
+    mu02 = (weights * (cc - c0) ** 2).sum() / area
+    mu11 = (weights * (rr - r0) * (cc - c0)).sum() / area
+    minor_var, major_var = np.linalg.eigvalsh([[mu20, mu11], [mu11, mu02]])
+    eccentricity = np.sqrt(1 - minor_var / major_var) if major_var > 0 else 0.0
+    return area, 4 * np.sqrt(max(minor_var, 0)), 4 * np.sqrt(major_var), eccentricity
+
+
+def subpixel_section_data(crop_im, bin_im, bbox, im_name, resolution, band=BAND):
+    """Measures a section at sub-pixel precision from the gray values around the boundary of its mask.
+
+    Parameters
+    ----------
+    crop_im : np.ndarray
+        Cropped grayscale image.
+    bin_im : np.ndarray
+        Filled mask of the section within its bounding box (as returned by section_props).
+    bbox : tuple
+        Bounding box of the section in the crop (min_row, min_col, max_row, max_col).
+    im_name : str
+        Image name.
+    resolution : float
+        Number of pixels per micron.
+    band : int
+        Half-width of the boundary band (see coverage).
+
+    Returns
+    -------
+    pd.DataFrame
+        One row with the ID, area, eccentricity, min and max diameters, like section_props.
+
+    """
+    crop_im = np.asarray(crop_im)
+    pad = 2 * band
+    minr, minc = max(bbox[0] - pad, 0), max(bbox[1] - pad, 0)
+    maxr, maxc = min(bbox[2] + pad, crop_im.shape[0]), min(bbox[3] + pad, crop_im.shape[1])
+    mask = np.zeros((maxr - minr, maxc - minc), dtype=bool)
+    mask[bbox[0] - minr:bbox[2] - minr, bbox[1] - minc:bbox[3] - minc] = bin_im
+
+    weights = coverage(crop_im[minr:maxr, minc:maxc], mask, band)
+    area, minor, major, eccentricity = moment_measures(weights)
+
+    return pd.DataFrame(
+        {'ID': [im_name], 'area': [area / np.square(resolution)], 'eccentricity': [eccentricity],
+         'min': [minor / resolution], 'max': [major / resolution]})
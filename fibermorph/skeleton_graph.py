@@ -0,0 +1,247 @@
+"""
+Skeleton-to-graph conversion for pruned skeletons.
+
+Every skeleton pixel becomes a node of a sparse (CSR) adjacency matrix built in one pass over the image. Diagonal
+neighbours that are also joined through a shared horizontal/vertical neighbour are left out (m-adjacency), so an
+L-shaped corner in a 1 px wide skeleton does not look like a junction. Each connected component is then emitted as a
+Fiber: its pixels ordered along the fiber, split into segments at junctions, with its endpoints and junctions.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from curvfit import MomentTable
+
+# neighbour offsets (row, col) looked up for each pixel; the other four directions follow by symmetry
+FORWARD_OFFSETS = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+class Fiber(object):
+    """A connected element of a skeleton, ordered along its length.
+
+    Exposes the `label`, `area`, `coords`, `bbox` and `image` attributes that the curvature functions used to take
+    from skimage.measure.regionprops, with `coords` in path order rather than raster order.
+
+    Parameters
+    ----------
+    label : int
+        Label of the element, numbered in raster order like skimage.measure.label.
+    segments : list
+        List of (n, 2) arrays of (row, col) coordinates, each running between endpoints and/or junctions.
+    endpoints : np.ndarray
+        (row, col) coordinates of the pixels with a single neighbour.
+    junctions : np.ndarray
+        (row, col) coordinates of the pixels with three or more neighbours.
+    closed : bool
+        True if the element is a loop without endpoints or junctions.
+    corrected_length : float or None
+        Pixel length corrected for diagonal steps, when it has been computed for the whole image.
+
+    """
+
+    def __init__(self, label, segments, endpoints, junctions, closed=False, corrected_length=None):
+        self.label = label
+        self.segments = segments
+        self.endpoints = endpoints
+        self.junctions = junctions
+        self.closed = closed
+        self.corrected_length = corrected_length
+        self._tables = {}
+
+        if len(segments) == 1:
+            self.coords = segments[0]
+        else:
+            # junction pixels end several segments, keep the first occurrence of each pixel
+            coords = np.concatenate(segments)
+            key = coords[:, 0] * (coords[:, 1].max() + 1) + coords[:, 1]
+            _, first = np.unique(key, return_index=True)
+            self.coords = coords[np.sort(first)]
+
+    @property
+    def area(self):
+        return len(self.coords)
+
+    @property
+    def bbox(self):
+        return tuple(self.coords.min(axis=0)) + tuple(self.coords.max(axis=0) + 1)
+
+    @property
+    def image(self):
+        min_row, min_col, max_row, max_col = self.bbox
+        img = np.zeros((max_row - min_row, max_col - min_col), dtype=bool)
+        img[self.coords[:, 0] - min_row, self.coords[:, 1] - min_col] = True
+        return img
+
+    def moment_tables(self, whole=False):
+        """curvfit.MomentTable of each segment (or of the whole fiber with `whole`), built on first use.
+
+        The tables hold everything the curvature fit needs for any window size, so keeping them on the fiber lets a
+        sweep over several windows read every window off the same running sums.
+        """
+        key = "whole" if whole else "segments"
+        if key not in self._tables:
+            self._tables[key] = [MomentTable(part) for part in ([self.coords] if whole else self.segments)]
+        return self._tables[key]
+
+
+def skeleton_graph(skeleton):
+    """Builds the adjacency matrix of all skeleton pixels in one pass over the image.
+
+    Parameters
+    ----------
+    skeleton : np.ndarray
+        Binary array of the (pruned) skeleton.
+
+    Returns
+    -------
+    coords : np.ndarray
+        (n, 2) array with the (row, col) coordinates of the skeleton pixels, in raster order.
+    graph : scipy.sparse.csr_matrix
+        Symmetric n x n adjacency matrix between skeleton pixels (m-adjacency).
+
+    """
+    skeleton = np.asarray(skeleton, dtype=bool)
+    height, width = skeleton.shape
+    flat = np.flatnonzero(skeleton)
+    rows, cols = np.divmod(flat, width)
+
+    def lookup(dr, dc):
+        # node index of the (dr, dc) neighbour of every pixel, -1 where there is none
+        r, c = rows + dr, cols + dc
+        inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+        target = r * width + c
+        pos = np.minimum(np.searchsorted(flat, target), len(flat) - 1)
+        return np.where(inside & (flat[pos] == target), pos, -1) if len(flat) else np.zeros(0, dtype=int)
+
+    right, down, left = lookup(0, 1), lookup(1, 0), lookup(0, -1)
+    neighbour = {(0, 1): right, (1, 0): down, (1, -1): lookup(1, -1), (1, 1): lookup(1, 1)}
+
+    # skip diagonals that are already connected through a shared 4-neighbour
+    neighbour[(1, 1)] = np.where((right >= 0) | (down >= 0), -1, neighbour[(1, 1)])
+    neighbour[(1, -1)] = np.where((left >= 0) | (down >= 0), -1, neighbour[(1, -1)])
+
+    src = np.concatenate([np.flatnonzero(neighbour[offset] >= 0) for offset in FORWARD_OFFSETS])
+    dst = np.concatenate([neighbour[offset][neighbour[offset] >= 0] for offset in FORWARD_OFFSETS])
+
+    n = len(flat)
+    graph = sparse.csr_matrix(
+        (np.ones(2 * len(src), dtype=np.uint8), (np.concatenate([src, dst]), np.concatenate([dst, src]))), shape=(n, n))
+
+    return np.column_stack([rows, cols]), graph
+
+
+def _walk_segments(nodes, indptr, indices):
+    """Splits a branched component into segments running between endpoints and junctions.
+
+    Parameters
+    ----------
+    nodes : np.ndarray
+        Node indices of the component, ascending.
+    indptr, indices : np.ndarray
+        CSR structure of the skeleton graph.
+
+    Returns
+    -------
+    list
+        List of node index lists, one per segment.
+
+    """
+    adjacency = {u: indices[indptr[u]:indptr[u + 1]].tolist() for u in nodes.tolist()}
+    used = set()
+    segments = []
+
+    def walk(start, first, stop):
+        path = [start]
+        prev, cur = start, first
+        used.update([(prev, cur), (cur, prev)])
+        while len(adjacency[cur]) == 2 and cur != stop:
+            path.append(cur)
+            nxt = [v for v in adjacency[cur] if (cur, v) not in used]
+            if not nxt:
+                break
+            prev, cur = cur, nxt[0]
+            used.update([(prev, cur), (cur, prev)])
+        path.append(cur)
+        return path
+
+    for start in adjacency:
+        if len(adjacency[start]) != 2:
+            segments.extend(walk(start, first, None) for first in adjacency[start] if (start, first) not in used)
+
+    # loops hanging off a single junction are only reachable through degree-2 pixels
+    for start in adjacency:
+        segments.extend(walk(start, first, start) for first in adjacency[start] if (start, first) not in used)
+
+    return segments
+
+
+def trace_fibers(skeleton):
+    """Converts a skeleton into path-ordered fibers with endpoint and junction metadata.
+
+    Unbranched elements (the usual case after pruning) are ordered together by a single depth-first traversal of the
+    whole graph, started from one endpoint of each element; only elements that still contain junctions are walked
+    segment by segment.
+
+    Parameters
+    ----------
+    skeleton : np.ndarray
+        Binary array of the (pruned) skeleton.
+
+    Returns
+    -------
+    list
+        List of Fiber objects, sorted by label.
+
+    """
+    coords, graph = skeleton_graph(skeleton)
+    n = len(coords)
+    if n == 0:
+        return []
+
+    num_labels, labels = csgraph.connected_components(graph, directed=False)
+    indptr, indices = graph.indptr, graph.indices
+    degree = np.diff(indptr)
+
+    # per-label counts of endpoints and junctions decide how each element is traced
+    endpoint_count = np.bincount(labels, weights=degree == 1, minlength=num_labels)
+    junction_count = np.bincount(labels, weights=degree >= 3, minlength=num_labels)
+    simple = junction_count == 0
+
+    # start each unbranched element at its first endpoint in raster order (or its first pixel for loops)
+    order = np.lexsort((np.arange(n), degree != 1, labels))
+    first_of_label = order[np.searchsorted(labels[order], np.arange(num_labels))]
+    starts = first_of_label[simple]
+
+    # one traversal from a virtual root joined to every start node orders all unbranched elements at once
+    root = n
+    edges = graph.tocoo()
+    rooted = sparse.csr_matrix(
+        (np.ones(len(edges.row) + 2 * len(starts), dtype=np.uint8),
+         (np.concatenate([edges.row, np.full(len(starts), root), starts]),
+          np.concatenate([edges.col, starts, np.full(len(starts), root)]))),
+        shape=(n + 1, n + 1))
+    path_order = csgraph.depth_first_order(rooted, root, directed=False, return_predecessors=False)[1:]
+
+    # the traversal finishes one element before moving to the next
+    path_labels = labels[path_order]
+    bounds = np.flatnonzero(np.diff(path_labels)) + 1
+    simple_paths = dict(zip(path_labels[np.r_[0, bounds]], np.split(path_order, bounds))) if len(starts) else {}
+
+    nodes_by_label = np.split(np.argsort(labels, kind="stable"), np.cumsum(np.bincount(labels))[:-1])
+
+    fibers = []
+    for label in range(num_labels):
+        nodes = nodes_by_label[label]
+        if simple[label]:
+            segments = [coords[simple_paths[label]]]
+        else:
+            segments = [coords[path] for path in _walk_segments(nodes, indptr, indices)]
+        fibers.append(Fiber(
+            label=label + 1,
+            segments=segments,
+            endpoints=coords[nodes[degree[nodes] == 1]],
+            junctions=coords[nodes[degree[nodes] >= 3]],
+            closed=bool(simple[label] and endpoint_count[label] == 0 and len(nodes) > 1)))
+
+    return fibers
@@ -0,0 +1,145 @@
+"""
+On-disk cache of intermediate curvature stages.
+
+The binarized image and the pruned skeleton are stored under a key made of the input image's SHA-256 and only the
+parameters that stage depends on: the binary image depends on the ridge filter (and the ROI pass), the pruned skeleton
+also on the resolution (through the particle size removed before skeletonizing). Neither depends on the window, so
+re-analyzing a set of images with other windows or within-element settings starts from the cached pruned skeleton,
+and a new resolution still skips the ridge filter. Tiling is left out of the keys because it doesn't change the
+results.
+
+Binary images are bit-packed (np.packbits) and compressed in an .npz file, about 1/8 byte per pixel before
+compression. Files are written to a temporary name and renamed into place, so parallel workers never read a partial
+entry; a failed write removes its temporary file, and those left by killed processes are removed once they are an
+hour old. When the cache grows beyond its size limit, the least recently used entries (by modification time, which is
+refreshed on every hit) are removed.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+from _version import __version__
+
+# default size limit of the cache in bytes
+CACHE_SIZE = 10 * 2 ** 30
+
+# age in seconds after which a temporary file is left over from a killed write rather than being written
+STALE_TMP_AGE = 3600
+
+
+class StageCache(object):
+    """Directory of bit-packed binary stage images keyed by input hash and stage parameters.
+
+    Parameters
+    ----------
+    directory : str or pathlib object
+        Cache directory (created if it doesn't exist). It can be shared by several runs.
+    max_bytes : int
+        Size limit of the cache; least recently used entries are removed beyond it.
+
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_SIZE):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, stage, digest, params):
+        """Path of the entry of a stage for an input hash and the parameters the stage depends on."""
+        key = json.dumps(dict(params, stage=stage, sha256=digest, version=__version__), sort_keys=True)
+        return self.directory.joinpath("{}_{}.npz".format(stage, hashlib.sha256(key.encode()).hexdigest()[:32]))
+
+    def get(self, stage, digest, params):
+        """Binary image stored for a stage, or None if it isn't cached.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage (e.g. "binary", "pruned").
+        digest : str
+            SHA-256 of the input image.
+        params : dict
+            Parameters the stage depends on.
+
+        Returns
+        -------
+        np.ndarray or None
+            Boolean image.
+
+        """
+        path = self.path(stage, digest, params)
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry["shape"])
+                img = np.unpackbits(entry["bits"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+            # mark as recently used
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            # missing, evicted by another worker or unreadable
+            return None
+        return img
+
+    def put(self, stage, digest, params, img):
+        """Stores the binary image of a stage and evicts least recently used entries beyond the size limit.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        digest : str
+            SHA-256 of the input image.
+        params : dict
+            Parameters the stage depends on.
+        img : np.ndarray
+            Binary image.
+
+        """
+        path = self.path(stage, digest, params)
+        img = np.asarray(img, dtype=bool)
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz.tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, bits=np.packbits(img), shape=np.array(img.shape))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in its size limit, and the temporary files of
+        writes that didn't finish (older than STALE_TMP_AGE)."""
+        stale = time.time() - STALE_TMP_AGE
+        for path in self.directory.glob("*.npz.tmp"):
+            try:
+                if path.stat().st_mtime < stale:
+                    path.unlink()
+            except OSError:
+                pass
+        
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,253 @@
+"""
+Per-stage timing, memory and (optionally) profiling of the image sequences.
+
+The stages of curvature_seq, section_seq and raw_to_gray are marked with stage(), as a decorator on the stage
+functions or as a context manager around inline steps. While an image runs under recorded() (which the parallel
+drivers wrap around every task), each stage adds a row with its wall time, its CPU time (of the whole process, so
+tile and native threads count), and the peak RSS of the process during the stage (the high-water mark is reset at the
+start of each stage through /proc/self/clear_refs; where that isn't possible, the peak since the process started).
+Stages nested in another one (e.g. imread inside filter_curv) are part of the outer stage and aren't recorded.
+
+The rows travel back to the main process with the image's results, where a TimingReport collects them into
+stage_timings.csv (one row per image and stage) and percentiles per stage in run_report.json.
+
+With --profile, each stage also records the peak of the memory traced by tracemalloc and runs under cProfile. The
+profiles of each stage are accumulated per process and dumped to profile/<stage>.<host>-<pid>.prof, and merged at the
+end of the run into profile/<stage>.prof (for pstats or snakeviz) and a text summary, profile/<stage>.txt. cProfile
+only sees the thread it runs in, so the work of tile threads shows up as the time waiting for them.
+"""
+
+import contextlib
+import cProfile
+import os
+import pathlib
+import pstats
+import resource
+import socket
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from report import update_report
+
+# percentiles reported per stage
+PERCENTILES = [50, 90, 99]
+
+TIMINGS_NAME = "stage_timings.csv"
+
+# recorder of the image being analyzed in this process (None outside recorded())
+_current = None
+
+# cProfile profiles of each stage in this process, accumulated over its images
+_profiles = {}
+_profiles_pid = None
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """High-water mark of the resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _profile(name):
+    global _profiles, _profiles_pid
+    if _profiles_pid != os.getpid():
+        _profiles = {}
+        _profiles_pid = os.getpid()
+    if name not in _profiles:
+        _profiles[name] = cProfile.Profile()
+    return _profiles[name]
+
+
+class StageRecorder(object):
+    """Rows of the stages of one image.
+
+    Parameters
+    ----------
+    image : str
+        Name of the image.
+    profile_dir : str, pathlib object or None
+        Directory for the cProfile dumps of this process; None (default) doesn't profile.
+
+    """
+
+    def __init__(self, image, profile_dir=None):
+        self.image = image
+        self.profile_dir = None if profile_dir is None else pathlib.Path(profile_dir)
+        self.rows = []
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        self.depth += 1
+        if self.depth > 1:
+            # part of the enclosing stage
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+
+        profile = _profile(name) if self.profile_dir is not None else None
+        if profile is not None:
+            tracemalloc.reset_peak()
+        reset = _reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.depth -= 1
+            self.rows.append({
+                "image": self.image, "stage": name, "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu, "peak_rss": _peak_rss(), "rss_reset": reset,
+                "peak_traced": tracemalloc.get_traced_memory()[1] if profile is not None else None,
+                "pid": os.getpid()})
+
+    def dump_profiles(self):
+        """Writes this process's accumulated profiles of each stage to the profile directory."""
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        node = "{}-{}".format(socket.gethostname(), os.getpid())
+        for name, profile in _profiles.items():
+            profile.dump_stats(self.profile_dir.joinpath("{}.{}.prof".format(name, node)))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Marks a stage: records it for the image run under recorded() in this process, and does nothing otherwise.
+
+    Works as a context manager and as a function decorator.
+    """
+    if _current is None:
+        yield
+    else:
+        with _current.measure(name):
+            yield
+
+
+def recorded(image, profile_dir, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) with its stages recorded and returns (result, stage rows).
+
+    Parameters
+    ----------
+    image : str
+        Name of the image, for the rows.
+    profile_dir : str, pathlib object or None
+        Directory for cProfile dumps (see the module docstring); None doesn't profile.
+    func : callable
+        The task, e.g. curvature_seq.
+
+    """
+    global _current
+    recorder = StageRecorder(image, profile_dir)
+    tracing = profile_dir is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    _current = recorder
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        _current = None
+        if tracing:
+            tracemalloc.stop()
+        if profile_dir is not None:
+            recorder.dump_profiles()
+    return result, recorder.rows
+
+
+def merge_profiles(profile_dir, top=40):
+    """Merges the per-process dumps of each stage into <stage>.prof and a text summary <stage>.txt.
+
+    Parameters
+    ----------
+    profile_dir : str or pathlib object
+        Directory of the dumps.
+    top : int
+        Number of functions listed in the text summaries (by cumulative time).
+
+    """
+    profile_dir = pathlib.Path(profile_dir)
+    dumps = {}
+    for path in sorted(profile_dir.glob("*.*.prof")):
+        dumps.setdefault(path.name.split(".", 1)[0], []).append(str(path))
+    for name, paths in dumps.items():
+        stats = pstats.Stats(*paths)
+        stats.dump_stats(profile_dir.joinpath(name + ".prof"))
+        with open(profile_dir.joinpath(name + ".txt"), "w") as f:
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(top)
+
+
+class TimingReport(object):
+    """Stage rows of all the images of a run, gathered in the main process."""
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, rows):
+        """Adds the rows of one image (as returned by recorded)."""
+        self.rows.extend(rows)
+
+    def frame(self):
+        """The rows as a DataFrame, one row per image and stage."""
+        return pd.DataFrame(self.rows, columns=["image", "stage", "wall_s", "cpu_s", "peak_rss", "rss_reset",
+                                                "peak_traced", "pid"])
+
+    def summary(self):
+        """Per-stage totals and percentiles (wall and CPU seconds, peak memory in bytes) for the run report."""
+        df = self.frame()
+        summary = {}
+        for name, group in df.groupby("stage", sort=False):
+            entry = {"calls": len(group), "wall_s_total": float(group["wall_s"].sum()),
+                     "cpu_s_total": float(group["cpu_s"].sum()), "peak_rss_max": int(group["peak_rss"].max())}
+            for q in PERCENTILES:
+                entry["wall_s_p{}".format(q)] = float(np.percentile(group["wall_s"], q))
+                entry["cpu_s_p{}".format(q)] = float(np.percentile(group["cpu_s"], q))
+                entry["peak_rss_p{}".format(q)] = float(np.percentile(group["peak_rss"], q))
+            if group["peak_traced"].notna().any():
+                entry["peak_traced_max"] = int(group["peak_traced"].max())
+            summary[name] = entry
+        return summary
+
+    def write(self, csv_path):
+        """Writes the rows to a CSV file."""
+        self.frame().to_csv(csv_path, index=False)
+
+    def save(self, output_path, csv_path=None, profile_dir=None):
+        """Writes the rows to stage_timings.csv in the run directory (or to csv_path), the per-stage summary to its
+        run report, and merges the profiles in profile_dir (None if the run wasn't profiled)."""
+        self.write(csv_path if csv_path is not None else pathlib.Path(output_path).joinpath(TIMINGS_NAME))
+        update_report(output_path, stage_timings=self.summary())
+        if profile_dir is not None:
+            merge_profiles(profile_dir)
+
+    def describe(self):
+        """Wall time per stage, largest first, for the console."""
+        df = self.frame()
+        if df.empty:
+            return "no stages recorded"
+        totals = df.groupby("stage")["wall_s"].sum().sort_values(ascending=False)
+        return ", ".join("{} {:.1f}s".format(name, seconds) for name, seconds in totals.items())
@@ -10,16 +10,20 @@ import argparse
 import datetime
 import os
 import pathlib
+import multiprocessing
 import shutil
 import sys
+import threading
 import timeit
 import warnings
 from datetime import datetime
 from functools import wraps
+from time import sleep
 from timeit import default_timer as timer
 
 import cv2
 import pandas as pd
+import pytest
 import rawpy
 import scipy
 import skimage
@@ -28,6 +32,7 @@ import joblib
 import skimage.exposure
 import skimage.measure
 import skimage.morphology
+import skimage.draw
 from PIL import Image
 from joblib import Parallel, delayed
 from matplotlib import pyplot as plt
@@ -43,6 +48,22 @@ from tqdm import tqdm
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from fibermorph import fibermorph
 from fibermorph import demo
+from fibermorph import image
+from fibermorph import curvfit
+from fibermorph import skeleton_graph
+from fibermorph import topology
+from fibermorph import ridge_filter
+from fibermorph import tiling
+from fibermorph import roi
+from fibermorph import morphology
+from fibermorph import results
+from fibermorph import manifest
+from fibermorph import stage_cache
+from fibermorph import writer_pool
+from fibermorph import core_budget
+from fibermorph import admission
+from fibermorph import work_queue
+from fibermorph import stage_timing
 
 # Get current directory
 dir = os.path.dirname(os.path.abspath(__file__))
@@ -227,6 +248,576 @@ def test_segment_section():
     
 
 
+def test_taubin_curv_windows():
+    # digital arcs of several radii plus a straight line, ordered along the curve
+    for radius in [20, 150, 1000, None]:
+        t = np.linspace(0, 400 / (radius or 400), 400)
+        if radius is None:
+            coords = np.column_stack([np.arange(400), np.full(400, 7)])
+        else:
+            coords = np.round(np.column_stack([radius * np.cos(t), radius * np.sin(t)]) + 2000).astype(int)
+        
+        for window_size_px in [5, 10, 66]:
+            ref = [image.taubin_curv(c, 132) for c in image.subset_gen(len(coords), window_size_px, coords)]
+            batch = curvfit.taubin_curv_windows(coords, window_size_px, 132)
+            assert len(batch) == len(ref)
+            np.testing.assert_allclose(batch, ref, rtol=curvfit.CURV_RTOL, atol=1e-12)
+
+
+def test_trace_fibers():
+    skel = np.zeros((40, 40), dtype=bool)
+    skel[5, 2:20] = 1  # cross with a junction at (5, 10)
+    skel[1:12, 10] = 1
+    skel[20, 20:26] = skel[25, 20:26] = skel[20:26, 20] = skel[20:26, 25] = 1  # closed loop
+    skel[35, 2:8] = 1  # L-shaped corner, not a junction
+    skel[36:39, 8] = 1
+    
+    fibers = skeleton_graph.trace_fibers(skel)
+    label_image = skimage.measure.label(skel, connectivity=2)
+    for fiber, region in zip(fibers, skimage.measure.regionprops(label_image)):
+        assert fiber.label == region.label
+        assert fiber.area == region.area
+        assert np.array_equal(fiber.image, region.image)
+        for segment in fiber.segments:
+            assert np.abs(np.diff(segment, axis=0)).max() == 1  # ordered along the fiber
+    
+    cross, loop, corner = fibers
+    assert len(cross.segments) == 4 and cross.junctions.tolist() == [[5, 10]]
+    assert loop.closed and len(loop.endpoints) == 0
+    assert len(corner.segments) == 1 and corner.endpoints.tolist() == [[35, 2], [38, 8]]
+
+
+def test_hit_points():
+    img = np.random.default_rng(0).random((60, 80)) < 0.3
+    hit_list = topology.branch_structures()
+    
+    # reference: one full-image convolution per structuring element on a 0/1 image
+    ref = np.zeros(img.shape, dtype=bool)
+    for hit in hit_list:
+        ref |= ndimage.convolve(img.astype(int), hit, mode="constant") == hit.sum()
+    
+    assert np.array_equal(topology.hit_points(img, topology.lookup_table(hit_list)), ref)
+
+
+def test_corrected_pixel_lengths():
+    # random walks, thinned to 1 px wide elements
+    rng = np.random.default_rng(1)
+    img = np.zeros((300, 300), dtype=bool)
+    for i in range(30):
+        r, c = rng.integers(20, 280, 2)
+        for step in range(rng.integers(20, 150)):
+            img[r, c] = True
+            r, c = np.clip([r, c] + rng.integers(-1, 2, 2), 0, 299)
+    skel = skimage.morphology.thin(img)
+    
+    lengths = image.corrected_pixel_lengths(skel)
+    
+    # reference: convolve each element's own image with every structure and count the labelled hits
+    label_image = skimage.measure.label(skel, connectivity=2)
+    for region in skimage.measure.regionprops(label_image):
+        counts = []
+        for structure in ["diag", "mid"]:
+            hits = np.zeros(region.image.shape, dtype=bool)
+            for hit in image.define_structure(structure):
+                hits |= ndimage.convolve(region.image.astype(int), hit, mode="constant") == hit.sum()
+            counts.append(ndimage.label(hits)[1])
+        expected = region.area - sum(counts) + counts[0] * np.sqrt(2) + counts[1] * np.sqrt(1.25)
+        assert lengths[region.label - 1] == expected
+
+
+def test_frangi32():
+    # dark arc and line on a noisy background
+    rng = np.random.default_rng(2)
+    img = np.full((200, 250), 200.)
+    img[skimage.draw.circle_perimeter(100, 120, 70, shape=img.shape)] = 40
+    img[skimage.draw.line(10, 5, 190, 240)] = 40
+    img = skimage.filters.gaussian(img, 1.5, preserve_range=True) + rng.normal(0, 5, img.shape)
+    img = img.clip(0, 255).astype(np.uint8)
+
+    filtered = ridge_filter.frangi32(img)
+    assert filtered.dtype == np.float32
+    assert np.allclose(filtered, skimage.filters.frangi(img), atol=1e-5)
+
+    kwargs = dict(sigmas=[1, 2], gamma=15, black_ridges=False)
+    assert np.allclose(ridge_filter.frangi32(img, **kwargs), skimage.filters.frangi(img, **kwargs), atol=1e-5)
+
+
+def test_tiled_stages():
+    img = np.full((150, 200), 200.)
+    img[skimage.draw.circle_perimeter(75, 100, 50, shape=img.shape)] = 40
+    img[skimage.draw.line(10, 5, 140, 190)] = 40
+    img = skimage.filters.gaussian(img, 1.5, preserve_range=True).astype(np.uint8)
+
+    # tiles much smaller than the halos, so every core depends on its neighbours
+    filtered = skimage.filters.frangi(img)
+    assert np.allclose(tiling.tiled_frangi(img, skimage.filters.frangi, 2, tile_size=48), filtered, rtol=1e-12)
+    assert np.allclose(tiling.tiled_frangi(img, ridge_filter.frangi32, 2, tile_size=48), ridge_filter.frangi32(img),
+                       atol=1e-6)
+
+    binary = filtered > filters.threshold_otsu(filtered)
+    selem = skimage.morphology.disk(5)
+    dilated = scipy.ndimage.binary_dilation(binary, structure=selem, iterations=2)
+    assert np.array_equal(tiling.tiled_dilation(binary, selem, 2, 2, tile_size=32), dilated)
+    assert np.array_equal(tiling.tiled_thin(dilated, 2, tile_size=32), skimage.morphology.thin(dilated))
+
+    assert tiling.choose_tile_workers(num_files=3, jobs=32) == 10
+    assert tiling.choose_tile_workers(num_files=40, jobs=4) == 1
+
+
+def test_binarize_curv(tmp_path):
+    img = np.full((300, 400), 200.)
+    img[skimage.draw.circle_perimeter(150, 200, 100)] = 40
+    img[skimage.draw.line(10, 5, 290, 390)] = 40
+    img = skimage.filters.gaussian(img, 1.5, preserve_range=True).astype(np.uint8)
+
+    for filtered in [skimage.filters.frangi(img), ridge_filter.frangi32(img)]:
+        # reference: adjust_log, Otsu, clear_border and brute-force dilation
+        log_img = skimage.exposure.adjust_log(filtered)
+        cleared = clear_border(log_img > filters.threshold_otsu(log_img), buffer_size=10)
+        expected = scipy.ndimage.binary_dilation(cleared, structure=skimage.morphology.disk(5), iterations=2)
+        assert np.array_equal(image.binarize_curv(filtered, "test", tmp_path, False), expected)
+
+    # the span decomposition also matches repeated dilation next to the image border
+    rng = np.random.default_rng(3)
+    binary = rng.random((120, 150)) > 0.99
+    for iterations in [1, 2, 3]:
+        assert np.array_equal(morphology.span_dilation(binary, skimage.morphology.disk(5), iterations),
+                              scipy.ndimage.binary_dilation(binary, skimage.morphology.disk(5), iterations=iterations))
+
+    blobs = rng.random((120, 150)) > 0.6
+    for buffer_size in [0, 3, 10]:
+        assert np.array_equal(morphology.clear_binary_border(blobs, buffer_size), clear_border(blobs, buffer_size))
+
+
+def test_fiber_rois():
+    # one dark arc in the corner of an otherwise empty image
+    img = np.full((600, 800), 220, dtype=np.uint8)
+    rr, cc = skimage.draw.circle_perimeter(150, 180, 100)
+    img[rr, cc] = 30
+    img = scipy.ndimage.grey_erosion(img, size=(5, 5))
+
+    boxes = roi.fiber_rois(img, 4, cell_size=128)
+    covered = np.zeros(img.shape, dtype=bool)
+    for box in boxes:
+        assert not covered[box].any()
+        covered[box] = True
+    assert covered[img < 128].all()
+    assert covered.mean() < 0.4
+
+    # per-object thinning matches thinning the whole image
+    filtered = skimage.filters.frangi(img)
+    binary = filtered > filters.threshold_otsu(filtered)
+    binary[400:450, 500:700] = True
+    assert np.array_equal(roi.thin_objects(binary), skimage.morphology.thin(binary))
+
+
+def test_result_writer(tmp_path):
+    import io as text_io
+    import json
+    stream = text_io.StringIO()
+    frames = [pd.DataFrame({"ID": ["a"], "area": [1.5]}).set_index("ID"), None,
+              pd.DataFrame({"area": [np.nan], "ID": ["b"]}).set_index("ID")]
+    with results.ResultWriter(tmp_path / "summary.csv", ndjson_stream=stream) as writer:
+        for df in frames:
+            writer.write(df)
+            # rows are on disk as soon as they are written
+            if df is not None:
+                assert len(pd.read_csv(tmp_path / "summary.csv")) == writer.rows
+    assert pd.read_csv(tmp_path / "summary.csv", index_col="ID").index.tolist() == ["a", "b"]
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == [
+        {"ID": "a", "area": 1.5}, {"ID": "b", "area": None}]
+
+
+def test_section_resume(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    img = np.full((400, 400), 220, dtype=np.uint8)
+    rr, cc = skimage.draw.ellipse(200, 200, 80, 60)
+    img[rr, cc] = 40
+    io.imsave(input_dir / "s1.tiff", img, check_contrast=False)
+    image.section(input_dir, tmp_path, 1, 4.25, 20, 150, False)
+    run_dir = next(tmp_path.glob("*fibermorph_section"))
+
+    # the finished image comes from the manifest, only the new one is analyzed
+    io.imsave(input_dir / "s2.tiff", img, check_contrast=False)
+    image.section(input_dir, None, 1, 4.25, 20, 150, False, resume=run_dir)
+    lines = (run_dir / manifest.MANIFEST_NAME).read_text().splitlines()
+    assert len(lines) == 2
+    summary = pd.read_csv(run_dir / "summary_section_data.csv", index_col="ID")
+    assert sorted(summary.index) == ["s1", "s2"]
+    assert summary.loc["s1"].equals(summary.loc["s2"])
+
+
+def test_curvature_resume_params(tmp_path):
+    import json
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    img = np.full((300, 300), 230, dtype=np.uint8)
+    for radius in [60, 90, 120]:
+        rr, cc = skimage.draw.circle_perimeter(150, 150, radius)
+        img[rr[cc > 150], cc[cc > 150]] = 30
+    io.imsave(input_dir / "arcs.tiff", img, check_contrast=False)
+    image.curvature(input_dir, tmp_path, 1, 132, 20, "px", False, False)
+    run_dir = next(tmp_path.glob("*fibermorph_curvature"))
+
+    # the same parameters reuse the recorded rows, another roi_factor analyzes the image again
+    image.curvature(input_dir, None, 1, 132, 20, "px", False, False, resume=run_dir)
+    assert len((run_dir / manifest.MANIFEST_NAME).read_text().splitlines()) == 1
+    image.curvature(input_dir, None, 1, 132, 20, "px", False, False, roi_factor=4, resume=run_dir)
+    entries = [json.loads(line) for line in (run_dir / manifest.MANIFEST_NAME).read_text().splitlines()]
+    assert [entry["params"]["roi_factor"] for entry in entries] == [None, 4]
+
+
+def test_cli_run_directory(tmp_path, monkeypatch):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    img = np.full((400, 400), 220, dtype=np.uint8)
+    rr, cc = skimage.draw.ellipse(200, 200, 80, 60)
+    img[rr, cc] = 40
+    io.imsave(input_dir / "s1.tiff", img, check_contrast=False)
+    args = ["fibermorph", "--section", "--segmenter", "threshold", "--input_directory", str(input_dir), "-q"]
+    monkeypatch.setattr(sys, "argv", args + ["--output_directory", str(tmp_path / "output")])
+    with pytest.raises(SystemExit) as exit_info:
+        fibermorph.main()
+    assert exit_info.value.code == 0
+    run_dir = next((tmp_path / "output").glob("*fibermorph_section"))
+
+    # --resume doesn't need --output_directory
+    io.imsave(input_dir / "s2.tiff", img, check_contrast=False)
+    monkeypatch.setattr(sys, "argv", args + ["--resume", str(run_dir)])
+    with pytest.raises(SystemExit) as exit_info:
+        fibermorph.main()
+    assert exit_info.value.code == 0
+    assert len((run_dir / manifest.MANIFEST_NAME).read_text().splitlines()) == 2
+
+    # neither does --queue_dir, which is the run directory
+    monkeypatch.setattr(sys, "argv", args + ["--queue_dir", str(tmp_path / "queue")])
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exit_info:
+        fibermorph.main()
+    assert exit_info.value.code == 0
+    summary = pd.read_csv(tmp_path / "queue" / "summary_section_data.csv", index_col="ID")
+    assert sorted(summary.index) == ["s1", "s2"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["input", "output", "queue"]
+
+
+def test_stage_cache(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    img = rng.random((101, 67)) > 0.5
+    cache = stage_cache.StageCache(tmp_path)
+    cache.put("pruned", "abc", {"resolution": 132}, img)
+    assert np.array_equal(cache.get("pruned", "abc", {"resolution": 132}), img)
+    assert cache.get("pruned", "abc", {"resolution": 100}) is None
+
+    # beyond the size limit the least recently used entry goes first
+    size = next(tmp_path.glob("*.npz")).stat().st_size
+    cache.max_bytes = int(2.5 * size)
+    cache.put("binary", "abc", {}, img)
+    os.utime(next(tmp_path.glob("binary_*.npz")), (0, 0))
+    cache.put("binary", "def", {}, img)
+    assert cache.get("binary", "abc", {}) is None
+    assert cache.get("pruned", "abc", {"resolution": 132}) is not None
+
+    # a failed write leaves no temporary file, and those of killed writes go once they are stale
+    def disk_full(*args, **kwargs):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(np, "savez_compressed", disk_full)
+    with pytest.raises(OSError):
+        cache.put("binary", "ghi", {}, img)
+    monkeypatch.undo()
+    assert not list(tmp_path.glob("*.npz.tmp"))
+    stale = tmp_path / "killed.npz.tmp"
+    stale.write_bytes(b"partial")
+    fresh = tmp_path / "writing.npz.tmp"
+    fresh.write_bytes(b"partial")
+    os.utime(stale, (0, 0))
+    cache.evict()
+    assert not stale.exists() and fresh.exists()
+
+
+def test_window_sweep(tmp_path):
+    skel = np.zeros((300, 300), dtype=bool)
+    for radius in [60, 90, 120]:
+        rr, cc = skimage.draw.circle_perimeter(150, 150, radius)
+        skel[rr, cc] = cc > 150  # half circles
+    skel = skimage.morphology.thin(skel)
+    
+    windows = [10, 20, 40]
+    sweep = image.analyze_all_curv(skel, "arcs", tmp_path, 132, windows, "px", False, False)
+    assert sweep["window_size"].tolist() == windows
+    for window, (_, row) in zip(windows, sweep.iterrows()):
+        single = image.analyze_all_curv(skel, "arcs", tmp_path, 132, window, "px", False, False).iloc[0]
+        assert row[single.index].equals(single)
+
+
+def test_writer_pool(tmp_path):
+    import threading
+    pool = writer_pool.WriterPool(threads=1, max_pending=2)
+    release = threading.Event()
+    pool.submit(release.wait)
+    pool.submit(release.wait)
+    # both slots are taken, so a third write would wait
+    assert not pool.slots.acquire(blocking=False)
+    release.set()
+    pool.wait()
+    
+    pool.submit(lambda: 1 / 0)
+    try:
+        pool.wait()
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("write error was not raised")
+    
+    img = np.eye(8, dtype=np.uint8) * 255
+    writer_pool.save_in_background(writer_pool.save_array, tmp_path / "binarized" / "eye.tiff", img)
+    writer_pool.wait_for_writes()
+    assert np.array_equal(np.asarray(Image.open(tmp_path / "binarized" / "eye.tiff")), img)
+    
+    # the writes of an image that fails are drained, and their errors aren't raised for the next image
+    @writer_pool.drains_writes
+    def failing_seq():
+        writer_pool.save_in_background(writer_pool.save_array, tmp_path / "missing" / "bad.tiff", None)
+        raise ValueError("stage failed")
+    with pytest.raises(ValueError):
+        failing_seq()
+    writer_pool.wait_for_writes()
+    assert not writer_pool.writer_pool().futures
+
+
+def test_core_budget():
+    assert core_budget.parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    
+    budget = core_budget.CoreBudget(num_tasks=3, jobs=8)
+    assert (budget.workers, budget.threads) == (3, 2)
+    assert budget.workers * budget.threads <= budget.cores
+    assert core_budget.CoreBudget(num_tasks=100, jobs=8).report()["threads_per_worker"] == 1
+    
+    pinned = core_budget.CoreBudget(num_tasks=2, jobs=4, pin="core")
+    if pinned.pin:
+        assert len(pinned.core_sets) == 2
+        with pinned:
+            assert sorted(pinned.slots.get() for i in range(2)) == sorted(pinned.core_sets)
+
+
+def test_memory_admission(tmp_path):
+    sizes = {"big": (400, 300), "small": (40, 30), "tiny": (20, 10)}
+    for name, size in sizes.items():
+        Image.new("L", size).save(tmp_path / (name + ".tiff"))
+    files = [tmp_path / (name + ".tiff") for name in sizes]
+    assert admission.image_pixels(files[0]) == 400 * 300
+    
+    limit = 3 * admission.WORKER_BYTES
+    budget = admission.MemoryBudget(files, limit, "curvature", "frangi")
+    assert budget.order(files)[0] == files[0]
+    assert budget.max_workers == 2
+    assert core_budget.CoreBudget(3, 4, max_workers=budget.max_workers).report()["threads_per_worker"] == 2
+    
+    # threads asking for 2/5 of the limit each are admitted at most two at a time
+    gate = admission.MemoryGate(limit)
+    running, peak = [], []
+    lock = threading.Lock()
+    
+    def task():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        sleep(0.05)
+        with lock:
+            running.pop()
+    
+    threads = [threading.Thread(target=admission.admitted, args=(gate, 2 * limit // 5, task)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2 and gate.reserved == 0
+
+
+def _queue_worker(queue_dir, input_dir, files):
+    queue = work_queue.WorkQueue(queue_dir, input_dir, {"module": "test"}, lease_timeout=1)
+    queue.populate(files)
+    with queue:
+        for todo_round in queue.rounds():
+            for f in todo_round:
+                queue.complete(f, pd.DataFrame({"ID": [f.name], "pid": [os.getpid()]}).set_index("ID"))
+    queue.merge(queue.path / "summary.csv")
+
+
+def test_work_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "POLL_INTERVAL", 0.1)
+    files = [tmp_path / "images" / "im{}.tiff".format(i) for i in range(12)]
+    queue_dir = tmp_path / "queue"
+    
+    # a claimer that "crashes" while holding an image
+    crashed = work_queue.WorkQueue(queue_dir, tmp_path / "images", {"module": "test"}, lease_timeout=1)
+    crashed.populate(files)
+    lost = crashed.claim()
+    
+    with pytest.raises(ValueError):
+        work_queue.WorkQueue(queue_dir, tmp_path / "images", {"module": "other"})
+    
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_queue_worker, args=(queue_dir, tmp_path / "images", files)) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    
+    summary = pd.read_csv(queue_dir / "summary.csv", index_col="ID")
+    assert sorted(summary.index) == sorted(f.name for f in files)
+    assert lost.name in summary.index
+    assert crashed.finished() and len(list((queue_dir / "done").iterdir())) == 12
+
+
+def test_stage_timing(tmp_path):
+    @stage_timing.stage("outer")
+    def outer(n):
+        with stage_timing.stage("inner"):
+            return np.ones(n).sum()
+    
+    # stages are only recorded under recorded(), and nested stages count towards the outer one
+    assert outer(10) == 10
+    result, rows = stage_timing.recorded("im", tmp_path / "profile", outer, 1000)
+    assert result == 1000 and [row["stage"] for row in rows] == ["outer"]
+    assert rows[0]["peak_rss"] > 0 and rows[0]["peak_traced"] >= 8000
+    
+    report = stage_timing.TimingReport()
+    report.add(rows)
+    report.add(stage_timing.recorded("im2", None, outer, 10)[1])
+    report.save(tmp_path, profile_dir=tmp_path / "profile")
+    assert report.summary()["outer"]["calls"] == 2
+    assert len(pd.read_csv(tmp_path / stage_timing.TIMINGS_NAME)) == 2
+    assert (tmp_path / "profile" / "outer.prof").exists()
+
+
+def test_logging_and_run_layout(tmp_path, capsys):
+    import logging
+    from fibermorph import common
+
+    # the loggers of flat and package imports are the same, under the "fibermorph" logger
+    assert common.get_logger("fibermorph.image") is common.get_logger("image")
+    assert common.setup_logging(-1) == logging.WARNING
+    assert common.setup_logging(2) == logging.DEBUG
+    logger = logging.getLogger(common.LOGGER_NAME)
+    assert [handler.get_name() for handler in logger.handlers].count(common.HANDLER_NAME) == 1
+    common.setup_logging(0)
+
+    # the subdirectories are created up front, and the layout is passed on as the run directory
+    layout = image.curvature_layout(tmp_path / "run", save_img=False, within_element=True)
+    assert sorted(p.name for p in (tmp_path / "run").iterdir()) == ["WithinElement", "analysis"]
+    assert image.curvature_layout(layout) is layout and pathlib.Path(layout) == tmp_path / "run"
+
+    skel = np.zeros((100, 100), dtype=bool)
+    skel[20, 10:90] = True
+    image.analyze_all_curv(skel, "line", layout, 132, 10, "px", False, True)
+    assert len(list((tmp_path / "run" / "WithinElement").iterdir())) == 1
+    assert (tmp_path / "run" / "analysis" / "ImageSum_line_WindowSize-10px.csv").exists()
+    # stdout is left alone
+    assert capsys.readouterr().out == ""
+
+
+def test_section_segmenters():
+    # a blurred, noisy 40 x 60 um section at 4.25 px/um
+    resolution = 4.25
+    rng = np.random.default_rng(0)
+    img = np.ones((400, 400))
+    rr, cc = skimage.draw.ellipse(200, 200, 20 * resolution, 30 * resolution, rotation=np.deg2rad(30))
+    img[rr, cc] = 0
+    img = skimage.filters.gaussian(img, sigma=3) + rng.normal(0, 0.03, img.shape)
+    crop_im = (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+    for segmenter in ["chan_vese", "threshold"]:
+        section_data, bin_im = image.segment_section(crop_im, "ellipse", resolution, 20 * resolution,
+                                                     150 * resolution, [200, 200], segmenter)
+        row = section_data.iloc[0]
+        assert row["area"] == pytest.approx(np.pi * 20 * 30, rel=0.01)
+        assert row["min"] == pytest.approx(40, rel=0.01) and row["max"] == pytest.approx(60, rel=0.01)
+
+
+def test_crop_section():
+    # a 50 um section off the center, and a smaller blob nearer the center that is too small to be a section
+    resolution = 4.25
+    rng = np.random.default_rng(0)
+    img = np.ones((1500, 2000))
+    rr, cc = skimage.draw.disk((500, 1200), 25 * resolution)
+    img[rr, cc] = 0
+    rr, cc = skimage.draw.disk((760, 1000), 5)
+    img[rr, cc] = 0
+    img = (np.clip(skimage.filters.gaussian(img, sigma=3) + rng.normal(0, 0.03, img.shape), 0, 1) * 255)
+    img = img.astype(np.uint8)
+
+    crop_im = image.crop_section(img, "disk", resolution, 20 * resolution, 150 * resolution, [750, 1000])
+    # the section's bounding box with 100 px of padding, as a view of the image
+    assert np.shares_memory(crop_im, img)
+    assert abs(crop_im.shape[0] - (2 * 25 * resolution + 200)) <= 2
+    assert crop_im[crop_im.shape[0] // 2, crop_im.shape[1] // 2] < 50
+
+    # without a section, the center of the image
+    blank = np.full((400, 400), 200, dtype=np.uint8)
+    assert image.crop_section(blank, "blank", resolution, 20 * resolution, 150 * resolution, [200, 200]).shape == \
+        (200, 200)
+
+
+def test_section_props():
+    # debris all over, a ring (filled when measured) off the center and a larger disk farther from it
+    resolution = 1
+    bin_im = np.zeros((600, 800), dtype=bool)
+    rng = np.random.default_rng(0)
+    for r, c in rng.integers(0, [600, 800], size=(500, 2)):
+        bin_im[r:r + 3, c:c + 3] = True
+    rr, cc = skimage.draw.disk((250, 350), 40)
+    bin_im[rr, cc] = True
+    rr, cc = skimage.draw.disk((250, 350), 20)
+    bin_im[rr, cc] = False
+    rr, cc = skimage.draw.disk((450, 650), 60)
+    bin_im[rr, cc] = True
+    label_im = skimage.measure.label(bin_im, connectivity=2)
+
+    section_data, section_im, bbox = image.section_props(label_im, "ring", resolution, 30, 200, [300, 400])
+    assert bbox == (211, 311, 291, 391)
+    assert section_im.shape == (80, 80) and section_im[40, 40]
+    assert abs(section_data["area"].iloc[0] - np.pi * 40 ** 2) / (np.pi * 40 ** 2) < 0.02
+    # the axes are those of the ring itself, as in regionprops
+    assert abs(section_data["min"].iloc[0] - 2 * np.hypot(40, 20)) < 2
+
+    # with the ring too small, the disk
+    section_data, section_im, bbox = image.section_props(label_im, "disk", resolution, 100, 200, [300, 400])
+    assert bbox == (391, 591, 510, 710)
+    with pytest.raises(ValueError):
+        image.section_props(label_im, "none", resolution, 200, 300, [300, 400])
+
+
+def test_all_sections(tmp_path):
+    # four sections of different sizes, one cut by the image border, and a blob too small to be a section
+    resolution = 4.25
+    rng = np.random.default_rng(0)
+    img = np.ones((1200, 1600))
+    centers = [(300, 400), (300, 1200), (900, 400), (900, 1200)]
+    radii = [20, 25, 30, 35]
+    for center, radius in zip(centers, radii):
+        rr, cc = skimage.draw.disk(center, radius * resolution)
+        img[rr, cc] = 0
+    rr, cc = skimage.draw.disk((600, 0), 100, shape=img.shape)
+    img[rr, cc] = 0
+    rr, cc = skimage.draw.disk((600, 800), 10)
+    img[rr, cc] = 0
+    img = (np.clip(skimage.filters.gaussian(img, sigma=2) + rng.normal(0, 0.03, img.shape), 0, 1) * 255)
+    skimage.io.imsave(tmp_path / "field.tiff", img.astype(np.uint8), check_contrast=False)
+
+    df = image.section_seq(tmp_path / "field.tiff", tmp_path / "out", resolution, 20, 150, True, "threshold",
+                           all_sections=True)
+    assert list(df["section"]) == [1, 2, 3, 4]
+    # numbered in label order, row by row from the top of each section
+    df = df.sort_values(["centroid_row", "centroid_col"])
+    assert np.allclose(df[["centroid_row", "centroid_col"]], centers, atol=1)
+    assert np.allclose(df["min"], np.multiply(radii, 2), rtol=0.01)
+    assert np.allclose(df["area"], np.pi * np.square(radii), rtol=0.01)
+    image.wait_for_writes()
+    assert len(list((tmp_path / "out" / "crop").glob("field_*.tiff"))) == 4
+
+
 def test_copy_if_exist():
     # fibermorph.copy_if_exist()
     pass
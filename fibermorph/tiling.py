@@ -0,0 +1,206 @@
+"""
+Overlapping tiles for running the curvature filter and morphology stages of one image on several threads.
+
+The image is cut into tiles of TILE_SIZE x TILE_SIZE pixels. Each tile is processed together with a halo of
+surrounding pixels (clipped to the image), and only its core is written back. When the halo covers everything a core
+pixel depends on, the stitched result is identical to processing the whole image at once, so there are no seams.
+Stages that depend on the whole image (the Otsu threshold, clear_border, removing small particles) stay global.
+
+The work is handed to a joblib threading pool: scipy.ndimage, numpy and skimage.morphology.thin release the GIL, so
+threads scale without copying tiles between processes.
+"""
+
+import numpy as np
+import scipy.ndimage
+import skimage.morphology
+from joblib import Parallel, delayed, effective_n_jobs
+
+import ridge_filter
+from morphology import span_dilation
+
+# side of a tile core in pixels
+TILE_SIZE = 1024
+
+
+def choose_tile_workers(num_files, jobs):
+    """Chooses the number of threads per image so that files running in parallel, times threads, fill `jobs` cores.
+
+    Parameters
+    ----------
+    num_files : int
+        Number of images to be analyzed.
+    jobs : int
+        Number of jobs requested with --jobs (joblib convention, -1 for all cores).
+
+    Returns
+    -------
+    int
+        Number of tile threads per image (1 means no tiling).
+
+    """
+    cores = effective_n_jobs(jobs)
+    files_at_once = max(1, min(cores, num_files))
+    return max(1, cores // files_at_once)
+
+
+def tile_slices(shape, halo, tile_size=TILE_SIZE):
+    """Cuts an image shape into tiles with halos.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2D image.
+    halo : int
+        Number of pixels added on each side of a tile core (clipped to the image).
+    tile_size : int
+        Side of a tile core in pixels.
+
+    Returns
+    -------
+    list
+        List of (outer, core, inner) tuples of slices: `outer` cuts the tile and its halo out of the image, `core` is
+        the tile core in the image, and `inner` is the tile core within the outer tile.
+
+    """
+    tiles = []
+    for r0 in range(0, shape[0], tile_size):
+        for c0 in range(0, shape[1], tile_size):
+            r1, c1 = min(r0 + tile_size, shape[0]), min(c0 + tile_size, shape[1])
+            rr0, cc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+            rr1, cc1 = min(r1 + halo, shape[0]), min(c1 + halo, shape[1])
+            tiles.append(((slice(rr0, rr1), slice(cc0, cc1)),
+                          (slice(r0, r1), slice(c0, c1)),
+                          (slice(r0 - rr0, r1 - rr0), slice(c0 - cc0, c1 - cc0))))
+    return tiles
+
+
+def box_slices(shape, boxes, halo):
+    """Like tile_slices, but for given tile cores (e.g. regions of interest) instead of a regular grid.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2D image.
+    boxes : list
+        List of (row slice, col slice) tuples with the tile cores.
+    halo : int
+        Number of pixels added on each side of a tile core (clipped to the image).
+
+    Returns
+    -------
+    list
+        List of (outer, core, inner) tuples of slices, as in tile_slices.
+
+    """
+    tiles = []
+    for rows, cols in boxes:
+        rr0, cc0 = max(rows.start - halo, 0), max(cols.start - halo, 0)
+        rr1, cc1 = min(rows.stop + halo, shape[0]), min(cols.stop + halo, shape[1])
+        tiles.append(((slice(rr0, rr1), slice(cc0, cc1)),
+                      (rows, cols),
+                      (slice(rows.start - rr0, rows.stop - rr0), slice(cols.start - cc0, cols.stop - cc0))))
+    return tiles
+
+
+def map_tiles(func, image, halo, workers, tile_size=TILE_SIZE, boxes=None):
+    """Applies a function to every tile of an image (with its halo) on a thread pool.
+
+    Parameters
+    ----------
+    func : callable
+        Called as func(tile, inner) with the tile plus halo and the slices of its core within it.
+    image : np.ndarray
+        2D image.
+    halo : int
+        Number of pixels around each tile core that func needs to give an exact result on the core.
+    workers : int
+        Number of threads.
+    tile_size : int
+        Side of a tile core in pixels.
+    boxes : list or None
+        Tile cores to use instead of the regular grid (see box_slices).
+
+    Returns
+    -------
+    list
+        List of (core, result) tuples, with the slices of each tile core in the image and func's return value.
+
+    """
+    if boxes is None:
+        tiles = tile_slices(image.shape, halo, tile_size)
+    else:
+        tiles = box_slices(image.shape, boxes, halo)
+    results = Parallel(n_jobs=workers, backend="threading")(
+        delayed(func)(image[outer], inner) for outer, core, inner in tiles)
+    return [(core, result) for (outer, core, inner), result in zip(tiles, results)]
+
+
+def stitch_tiles(shape, results, dtype):
+    """Writes the per-tile core results of map_tiles back into one image (zero where no tile has a core)."""
+    stitched = np.zeros(shape, dtype=dtype)
+    for core, result in results:
+        stitched[core] = result
+    return stitched
+
+
+def tiled_frangi(image, frangi_func, workers, sigmas=range(1, 10, 2), tile_size=TILE_SIZE, boxes=None):
+    """Frangi filter of a whole image computed tile by tile.
+
+    gamma depends on the whole image (half the largest Hessian norm at the first scale), so a first pass over the tiles
+    finds it and a second pass filters every tile with that gamma. With `boxes`, only those regions are filtered (and
+    gamma only comes from them); the rest of the image is 0.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D grayscale image.
+    frangi_func : callable
+        skimage.filters.frangi or ridge_filter.frangi32.
+    workers : int
+        Number of threads.
+    sigmas : iterable of floats
+        Sigmas used as scales of filter.
+    tile_size : int
+        Side of a tile core in pixels.
+    boxes : list or None
+        Regions to filter, as (row slice, col slice) tuples; None filters the whole image.
+
+    Returns
+    -------
+    np.ndarray
+        Filtered image, identical (to rounding of gamma) to frangi_func(image, sigmas=sigmas).
+
+    """
+    sigmas = list(sigmas)
+    halo = ridge_filter.frangi_halo(sigmas)
+    dtype = np.float32 if frangi_func is ridge_filter.frangi32 else np.float64
+
+    norms = map_tiles(lambda tile, inner: ridge_filter.hessian_norm(tile, sigmas[0], dtype)[inner].max(),
+                      image, halo, workers, tile_size, boxes)
+    gamma = max([norm for core, norm in norms], default=0) / 2
+    if gamma == 0:
+        gamma = 1  # If s == 0 everywhere, gamma doesn't matter.
+
+    results = map_tiles(lambda tile, inner: frangi_func(tile, sigmas=sigmas, gamma=gamma)[inner],
+                        image, halo, workers, tile_size, boxes)
+    return stitch_tiles(image.shape, results, dtype)
+
+
+def tiled_dilation(image, structure, iterations, workers, tile_size=TILE_SIZE):
+    """Binary dilation of a whole image computed tile by tile (see morphology.span_dilation)."""
+    halo = iterations * (max(np.shape(structure)) // 2)
+    results = map_tiles(lambda tile, inner: span_dilation(tile, structure, iterations)[inner],
+                        image, halo, workers, tile_size)
+    return stitch_tiles(image.shape, results, bool)
+
+
+def tiled_thin(image, workers, tile_size=TILE_SIZE):
+    """Thinning of a whole binary image computed tile by tile (see skimage.morphology.thin).
+
+    Each thinning pass peels at most one pixel layer, so a tile edge cannot influence the skeleton further than the
+    number of passes, which is bounded by the largest distance to the background. The halo is twice that, plus a margin.
+    """
+    depth = scipy.ndimage.distance_transform_edt(image).max() if image.any() else 0
+    halo = 2 * int(np.ceil(depth)) + 4
+    results = map_tiles(lambda tile, inner: skimage.morphology.thin(tile)[inner], image, halo, workers, tile_size)
+    return stitch_tiles(image.shape, results, bool)
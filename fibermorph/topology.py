@@ -0,0 +1,181 @@
+"""
+Neighbourhood codes and lookup tables for hit-or-miss tests on binary skeletons.
+
+Each "on" pixel gets an 8-neighbourhood code between 0 and 511: bit 3 * i + j is set when the pixel at offset
+(i - 1, j - 1) is on, which is the same as one correlation with NEIGHBOUR_WEIGHTS. A structuring element then becomes a
+512-entry boolean table, so any number of structuring elements costs one table lookup per pixel instead of one
+full-image convolution each.
+
+The tables reproduce the tests used throughout image.py, ndimage.convolve(img, hit) == hit.sum() on a 0/1 image: a
+pixel hits when every 1 of the (convolution-flipped) element is on; 0s in the element are "don't care". Codes are only
+computed for "on" pixels, which is exact for structuring elements with a 1 at their centre (all of the ones here).
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+# bit weights of the 3x3 neighbourhood, centre included
+NEIGHBOUR_WEIGHTS = (2 ** np.arange(9)).reshape(3, 3)
+
+# each possible code expanded back into its 3x3 neighbourhood
+_CODE_NEIGHBOURHOODS = ((np.arange(512)[:, None] >> np.arange(9)) & 1).reshape(512, 3, 3).astype(bool)
+
+
+def lookup_table(hit_list):
+    """Builds the 512-entry table of the neighbourhood codes that hit any of the structuring elements.
+
+    Parameters
+    ----------
+    hit_list : list
+        List of 3x3 binary structuring elements.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean array of length 512, True for codes that hit at least one structuring element.
+
+    """
+    table = np.zeros(512, dtype=bool)
+    for hit in hit_list:
+        # ndimage.convolve flips the structuring element
+        flipped = np.asarray(hit, dtype=bool)[::-1, ::-1]
+        table |= np.all(_CODE_NEIGHBOURHOODS | ~flipped, axis=(1, 2))
+    return table
+
+
+def pixel_codes(img):
+    """Computes the neighbourhood code of every "on" pixel of a binary image.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        Binary image.
+
+    Returns
+    -------
+    rows, cols : np.ndarray
+        Coordinates of the "on" pixels, in raster order.
+    codes : np.ndarray
+        Neighbourhood code (0-511) of each of those pixels.
+
+    """
+    padded = np.pad(np.asarray(img, dtype=bool), 1)
+    width = padded.shape[1]
+    flat = np.flatnonzero(padded)
+
+    codes = np.zeros(len(flat), dtype=np.int16)
+    for (i, j), weight in np.ndenumerate(NEIGHBOUR_WEIGHTS):
+        codes += weight * padded.flat[flat + (i - 1) * width + (j - 1)]
+
+    rows, cols = np.divmod(flat, width)
+    return rows - 1, cols - 1, codes
+
+
+def hit_points(img, table):
+    """Hit-or-miss transform of a binary image through a lookup table.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        Binary image.
+    table : np.ndarray
+        512-entry boolean table from lookup_table.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean image, True at the pixels whose neighbourhood code hits the table.
+
+    """
+    rows, cols, codes = pixel_codes(img)
+    hits = np.zeros(np.shape(img), dtype=bool)
+    hits[rows, cols] = table[codes]
+    return hits
+
+
+def hit_groups(rows, cols, hits, labels, num_labels):
+    """Counts the 4-connected groups of hit pixels within each labelled element.
+
+    Gives, for every element at once, the number that ndimage.label returns on that element's own hit image.
+
+    Parameters
+    ----------
+    rows, cols : np.ndarray
+        Coordinates of the "on" pixels, in raster order (as returned by pixel_codes).
+    hits : np.ndarray
+        Boolean array, True for the pixels that hit.
+    labels : np.ndarray
+        Element index (0 to num_labels - 1) of each pixel.
+    num_labels : int
+        Number of elements.
+
+    Returns
+    -------
+    np.ndarray
+        Number of groups of hit pixels in each element.
+
+    """
+    rows, cols, labels = rows[hits], cols[hits], labels[hits]
+    num_hits = len(rows)
+    if num_hits == 0:
+        return np.zeros(num_labels, dtype=int)
+
+    width = cols.max() + 2
+    key = rows * width + cols
+
+    src, dst = [], []
+    for step in [1, width]:  # right and down neighbours
+        pos = np.minimum(np.searchsorted(key, key + step), num_hits - 1)
+        found = key[pos] == key + step
+        src.append(np.flatnonzero(found))
+        dst.append(pos[found])
+    src, dst = np.concatenate(src), np.concatenate(dst)
+
+    graph = sparse.csr_matrix((np.ones(len(src), dtype=np.uint8), (src, dst)), shape=(num_hits, num_hits))
+    num_groups, group = csgraph.connected_components(graph, directed=False)
+
+    # 4-adjacent pixels always share an element, so each group belongs to the element of its first pixel
+    _, first = np.unique(group, return_index=True)
+    return np.bincount(labels[first], minlength=num_labels)
+
+
+def branch_structures():
+    """Structuring elements for 3-way and 4-way branch points, as used by image.prune.
+
+    Returns
+    -------
+    list
+        List of 14 3x3 structuring elements.
+
+    """
+    # identify 3-way branch-points
+    hit1 = np.array([[0, 1, 0],
+                     [0, 1, 0],
+                     [1, 0, 1]], dtype=np.uint8)
+    hit2 = np.array([[1, 0, 0],
+                     [0, 1, 0],
+                     [1, 0, 1]], dtype=np.uint8)
+    hit3 = np.array([[1, 0, 0],
+                     [0, 1, 1],
+                     [0, 1, 0]], dtype=np.uint8)
+    hit_list = [hit1, hit2, hit3]
+
+    # numpy slicing to create 3 remaining rotations
+    for ii in range(9):
+        hit_list.append(np.transpose(hit_list[-3])[::-1, ...])
+
+    # add structure elements for branch-points four 4-way branchpoints
+    hit3 = np.array([[0, 1, 0],
+                     [1, 1, 1],
+                     [0, 1, 0]], dtype=np.uint8)
+    hit4 = np.array([[1, 0, 1],
+                     [0, 1, 0],
+                     [1, 0, 1]], dtype=np.uint8)
+    hit_list.append(hit3)
+    hit_list.append(hit4)
+
+    return hit_list
+
+
+BRANCH_TABLE = lookup_table(branch_structures())
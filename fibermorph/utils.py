@@ -2,11 +2,11 @@ import os
 import sys
 import pathlib
 import shutil
-import requests
 import argparse
 import common
-from common import convert
-import tqdm
+from common import convert, get_logger
+
+logger = get_logger(__name__)
 
 def parse_args():
     """
@@ -29,13 +29,70 @@ def parse_args():
 
     parser.add_argument(
         "--jobs", type=int, metavar="", default=1,
-        help="Integer. Number of parallel jobs to run. Default is 1.")
+        help="Integer. Number of cores to use (-1 for all). Images are analyzed in parallel, and cores left over when "
+             "there are fewer images than cores go to threads within each image. Default is 1.")
+
+    parser.add_argument(
+        "--pin", type=str, metavar="", default=None, choices=["core", "numa"],
+        help="Optional. 'core' pins each parallel worker to its own cores, 'numa' to one NUMA node (Linux only). "
+             "Default is None (no pinning).")
+
+    parser.add_argument(
+        "--memory_limit", type=float, metavar="", default=None,
+        help="Float. Memory in GB that the images analyzed in parallel may use together. Each image's peak is "
+             "estimated from its dimensions, and fewer images run at once when large ones would not fit. Default is "
+             "None (no limit).")
 
     parser.add_argument(
         "-s", "--save_image", action="store_true", default=False,
         help="Default is False. Will save intermediate curvature/section processing images if --save_image flag is "
              "included.")
 
+    parser.add_argument(
+        "--parquet", action="store_true", default=False,
+        help="Default is False. Will also write the summary data as a Parquet file (requires pyarrow) if the "
+             "--parquet flag is included.")
+
+    parser.add_argument(
+        "--ndjson", action="store_true", default=False,
+        help="Default is False. Will print each image's results to stdout as newline-delimited JSON as soon as the "
+             "image is analyzed if the --ndjson flag is included.")
+
+    parser.add_argument(
+        "--resume", metavar="", default=None,
+        help="Optional. Full path to the output directory of an earlier curvature/section run (e.g. one that was "
+             "interrupted). Continues that run: images already analyzed with the same parameters are skipped, and only "
+             "new or changed images are analyzed. --output_directory is not needed.")
+
+    parser.add_argument(
+        "--queue_dir", metavar="", default=None,
+        help="Optional. Full path to a directory on a filesystem shared by several nodes, used as the run directory. "
+             "Every fibermorph process started with the same --queue_dir claims images from a queue there until all "
+             "are done, and the last one writes the summary. --output_directory is not needed. Default is None (this "
+             "process analyzes every image).")
+
+    parser.add_argument(
+        "--lease_timeout", type=float, metavar="", default=120,
+        help="Float. Seconds after which images claimed by a --queue_dir process that stopped responding (e.g. "
+             "crashed) are put back in the queue. Default is 120.")
+
+    parser.add_argument(
+        "--profile", action="store_true", default=False,
+        help="Default is False. Will also profile every processing stage with cProfile and tracemalloc, and save the "
+             "merged profiles per stage in a profile folder, if the --profile flag is included. Stage times and peak "
+             "memory are always saved in stage_timings.csv.")
+
+    verbosity = parser.add_mutually_exclusive_group()
+    
+    verbosity.add_argument(
+        "-v", "--verbose", action="store_true", default=False,
+        help="Default is False. Will also show debugging messages (e.g. the number of fibers in each image and the "
+             "directories created) if the --verbose flag is included.")
+    
+    verbosity.add_argument(
+        "-q", "--quiet", action="store_true", default=False,
+        help="Default is False. Will only show warnings, not the progress messages, if the --quiet flag is included.")
+
     gr_curv = parser.add_argument_group(
         "curvature options", "arguments used specifically for curvature module"
     )
@@ -53,11 +110,38 @@ def parse_args():
         #help="Float or integer or None. Desired size for window of measurement for curvature analysis in pixels or mm (given "
              #"the flag --window_unit). If nothing is entered, the default is None and the entire hair will be used to for the curve fitting.")
 
+    gr_curv.add_argument(
+        "--window_sweep", type=float, metavar="", default=None, nargs='+',
+        help="Optional. Several window sizes (in --window_unit) to analyze in one run, e.g. --window_sweep 10 20 40. "
+             "Each fiber is traced once for all windows, and the summary has one row per image and window. Replaces "
+             "--window_size_px.")
+
     gr_curv.add_argument(
         "--window_unit", type=str, default="px", choices=["px", "mm"],
         help="String. Unit of measurement for window of measurement for curvature analysis. Can be 'px' (pixels) or "
              "'mm'. Default is 'px'.")
 
+    gr_curv.add_argument(
+        "--ridge_filter", type=str, default="frangi", choices=["frangi", "frangi32"],
+        help="String. Ridge filter used to find hairs for curvature analysis. Can be 'frangi' (scikit-image's frangi "
+             "filter) or 'frangi32' (the same filter in float32 with a fraction of the memory). Default is 'frangi'.")
+
+    gr_curv.add_argument(
+        "--roi_factor", type=int, metavar="", default=None,
+        help="Integer. Downsampling factor (4-8 works well) for a coarse pass that locates the hairs, so the "
+             "full-resolution filter and skeletonization only run around them. Speeds up sparse images. Default is "
+             "None (whole images are processed).")
+
+    gr_curv.add_argument(
+        "--cache_dir", metavar="", default=None,
+        help="Optional. Full path to a directory for caching binarized images and pruned skeletons between runs, so "
+             "re-analyzing the same images with other windows skips the image processing. Default is None (no cache).")
+
+    gr_curv.add_argument(
+        "--cache_size", type=float, metavar="", default=10,
+        help="Float. Size limit of the --cache_dir cache in GB. Least recently used entries are removed beyond it. "
+             "Default is 10.")
+
     gr_curv.add_argument(
         "-W", "--within_element", action="store_true", default=False,
         help="Boolean. Default is False. Will create an additional directory with spreadsheets of raw curvature "
@@ -80,6 +164,18 @@ def parse_args():
         "--maxsize", type=int, metavar="", default=150,
         help="Integer. Maximum diameter in microns for sections. Default is 150.")
 
+    gr_sect.add_argument(
+        "--segmenter", type=str, default="chan_vese", choices=["chan_vese", "threshold"],
+        help="String. Segmentation of grayscale section images: 'chan_vese' (morphological Chan-Vese) or "
+             "'threshold' (thresholding with sub-pixel measurement of the boundary, much faster). Default is "
+             "'chan_vese'.")
+
+    gr_sect.add_argument(
+        "--all_sections", action="store_true", default=False,
+        help="Default is False. Will measure every section in each image (one row per section, with its number and "
+             "centroid in pixels) instead of only the section nearest the center if the --all_sections flag is "
+             "included.")
+
     gr_raw = parser.add_argument_group(
         "raw2gray options", "arguments used specifically for raw2gray module"
     )
@@ -154,11 +250,14 @@ def parse_args():
         args.demo_real_section]
     
     if any(demo_mods) is False:
-        if args.input_directory is None and args.output_directory is None:
+        # a resumed run writes into the run directory it continues, a queue run into the queue directory (raw2gray
+        # has neither)
+        need_output = args.raw2gray or (args.resume is None and args.queue_dir is None)
+        if args.input_directory is None and args.output_directory is None and need_output:
             sys.exit("ExitError: need both --input_directory and --output_directory")
         if args.input_directory is None:
             sys.exit("ExitError: need --input_directory")
-        if args.output_directory is None:
+        if args.output_directory is None and need_output:
             sys.exit("ExitError: need --output_directory")
     
     else:
@@ -209,18 +308,18 @@ def create_results_cache(path):
         return output_directory
     
     except TypeError:
-        tqdm.write("Path is missing.")
+        logger.warning("Path is missing.")
 
 
 def delete_dir(path):
     datadir = pathlib.Path(path)
 
-    print("Deleting {}".format(str(datadir.resolve())))
+    logger.info("Deleting %s", datadir.resolve())
 
     try:
         shutil.rmtree(datadir)
     except FileNotFoundError:
-        print("The file doesn't exist. Nothing has been deleted")
+        logger.info("The file doesn't exist. Nothing has been deleted")
 
     return True
 
@@ -245,6 +344,8 @@ def url_files(im_type):
 
 
 def download_im(tmpdir, demo_url):
+    # requests is only needed by the demos, so it isn't imported with the module
+    import requests
 
     for u in demo_url:
         r = requests.get(u, allow_redirects=True)
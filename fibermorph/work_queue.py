@@ -0,0 +1,291 @@
+"""
+Work queue in a shared directory, for spreading one batch of images over several nodes.
+
+Every fibermorph process started with the same --queue_dir (on a filesystem all the nodes mount) takes part in the
+same run. The queue directory is also the run directory, so saved images end up in one place. It holds one small
+JSON entry per image, which moves between subdirectories by atomic renames:
+
+    todo/     images waiting to be analyzed
+    claimed/  images being analyzed; a rename from todo/ succeeds for only one process, which makes it the claimer
+    done/     images whose results are in results/
+
+Entries are named "<rank>-<key>.json", where the key is a hash of the image's path relative to the input directory
+and the rank the position in which the first process to create the entry listed it (largest first under a memory
+limit), so images are claimed in that order. A process's results for each image go to results/<key>.json, and the
+process also appends them to its own CSV in nodes/.
+
+A claim is a lease: the claimer refreshes the modification time of its claimed entries from a heartbeat thread, and
+any process that finds a claimed entry older than the lease timeout renames it back to todo/, so the images of a
+crashed process are analyzed again elsewhere. The lease timeout must be well above the heartbeat interval and the
+clock differences between the nodes. Processes that run out of images keep polling until every image is done, so
+they can take over expired leases. Whichever finishes last merges results/ into the summary (written to a temporary
+file and renamed, so a merge that runs twice just replaces the summary with the same rows).
+
+Renames within a directory tree are atomic on local filesystems and on NFS; a process that loses a lease while still
+working finishes its image anyway, and the duplicate results are identical.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+
+from manifest import frame_to_rows, rows_to_frame
+from results import ResultWriter
+
+STATES = ["todo", "claimed", "done"]
+
+# default lease timeout in seconds
+LEASE_TIMEOUT = 120
+
+# seconds between checks for claimable images while other processes hold every remaining one
+POLL_INTERVAL = 5
+
+
+def _write_json(path, obj):
+    """Writes JSON to a temporary file next to path and renames it into place."""
+    path = pathlib.Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + path.name, suffix=".tmp", dir=path.parent)
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+class WorkQueue(object):
+    """Queue of the images of a run, shared by the processes that use the same queue directory.
+
+    Parameters
+    ----------
+    queue_dir : str or pathlib object
+        Shared directory of the queue (created if it doesn't exist), also used as the run output directory.
+    input_directory : str or pathlib object
+        Directory the images are listed from (the same path on every node).
+    params : dict
+        Analysis parameters. The first process records them; processes with other parameters are refused.
+    lease_timeout : float
+        Seconds after which the claim of a process that stopped refreshing it expires.
+
+    """
+
+    def __init__(self, queue_dir, input_directory, params, lease_timeout=LEASE_TIMEOUT):
+        self.path = pathlib.Path(queue_dir)
+        self.input_directory = pathlib.Path(input_directory)
+        self.lease_timeout = lease_timeout
+        self.node = "{}-{}".format(socket.gethostname(), os.getpid())
+        for state in STATES + ["results", "nodes"]:
+            self.path.joinpath(state).mkdir(parents=True, exist_ok=True)
+
+        # round trip through JSON so that the parameters compare equal to the recorded ones
+        params = json.loads(json.dumps(params, default=str))
+        params_path = self.path.joinpath("queue.json")
+        try:
+            with open(params_path, "x") as f:
+                json.dump(params, f)
+        except FileExistsError:
+            # written by another process, possibly just now
+            for i in range(10):
+                with open(params_path) as f:
+                    text = f.read()
+                if text:
+                    break
+                time.sleep(0.1)
+            if json.loads(text) != params:
+                raise ValueError("The queue in {} was created with other parameters: {}".format(self.path, text))
+
+        self.held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def key(self, input_file):
+        """Key of an image: a hash of its path relative to the input directory."""
+        name = pathlib.Path(input_file).relative_to(self.input_directory).as_posix()
+        return hashlib.sha1(name.encode()).hexdigest()[:20]
+
+    def _entries(self, state):
+        """Entry file names in a state directory, in claiming order."""
+        return sorted(entry.name for entry in self.path.joinpath(state).glob("*.json"))
+
+    @staticmethod
+    def _entry_key(entry):
+        return entry[:-len(".json")].split("-", 1)[1]
+
+    def populate(self, file_list):
+        """Adds the images that aren't queued yet, in the order given, and lists the ones not done.
+
+        Parameters
+        ----------
+        file_list : list
+            Paths of the images (within the input directory).
+
+        Returns
+        -------
+        list
+            The images of file_list that are not done yet.
+
+        """
+        queued = {self._entry_key(entry): state for state in STATES for entry in self._entries(state)}
+        for rank, input_file in enumerate(file_list):
+            key = self.key(input_file)
+            if key in queued:
+                continue
+            entry = {"file": pathlib.Path(input_file).relative_to(self.input_directory).as_posix()}
+            # another process may add the same image under another rank at the same time; it's then analyzed twice
+            _write_json(self.path.joinpath("todo", "{:06d}-{}.json".format(rank, key)), entry)
+        return [input_file for input_file in file_list if queued.get(self.key(input_file)) != "done"]
+
+    def _read_entry(self, state, entry):
+        with open(self.path.joinpath(state, entry)) as f:
+            return self.input_directory.joinpath(json.load(f)["file"])
+
+    def claim(self):
+        """Claims the next waiting image.
+
+        Returns
+        -------
+        pathlib object or None
+            Path of the image, or None if no image is waiting.
+
+        """
+        for entry in self._entries("todo"):
+            try:
+                # the lease starts now (the entry may have been requeued with an expired time)
+                os.utime(self.path.joinpath("todo", entry))
+                os.rename(self.path.joinpath("todo", entry), self.path.joinpath("claimed", entry))
+            except FileNotFoundError:
+                # claimed by another process first
+                continue
+            input_file = self._read_entry("claimed", entry)
+            with self._lock:
+                self.held[self.key(input_file)] = entry
+            return input_file
+        return None
+
+    def requeue_expired(self):
+        """Moves claimed entries whose lease has expired back to todo/ and returns how many were moved."""
+        moved = 0
+        deadline = time.time() - self.lease_timeout
+        for entry in self._entries("claimed"):
+            path = self.path.joinpath("claimed", entry)
+            try:
+                if path.stat().st_mtime < deadline:
+                    os.rename(path, self.path.joinpath("todo", entry))
+                    moved += 1
+            except FileNotFoundError:
+                continue
+        return moved
+
+    def complete(self, input_file, df):
+        """Stores the results of a claimed image and marks it done.
+
+        Parameters
+        ----------
+        input_file : str or pathlib object
+            Path of the image.
+        df : pd.DataFrame or None
+            Results of the image.
+
+        """
+        key = self.key(input_file)
+        name = pathlib.Path(input_file).relative_to(self.input_directory).as_posix()
+        _write_json(self.path.joinpath("results", key + ".json"), {"file": name, "rows": frame_to_rows(df)})
+        with self._lock:
+            entry = self.held.pop(key, None)
+        for state in ["claimed", "todo"]:
+            # the entry is back in todo/ if the lease expired in the meantime
+            candidates = [entry] if entry else [e for e in self._entries(state) if self._entry_key(e) == key]
+            for candidate in candidates:
+                try:
+                    os.rename(self.path.joinpath(state, candidate), self.path.joinpath("done", candidate))
+                    return
+                except FileNotFoundError:
+                    continue
+
+    def finished(self):
+        """True when no image is waiting or claimed."""
+        return not self._entries("todo") and not self._entries("claimed")
+
+    def claims(self):
+        """Claims and yields waiting images until none is left (the images other processes hold aren't waited for)."""
+        while True:
+            input_file = self.claim()
+            if input_file is None:
+                return
+            yield input_file
+
+    def rounds(self):
+        """Yields claims() generators until every image is done, waiting for (and taking over expired) leases of
+        other processes in between. Each round's images must be completed before the next round is requested."""
+        while True:
+            self.requeue_expired()
+            if self._entries("todo"):
+                yield self.claims()
+            elif self._entries("claimed"):
+                time.sleep(POLL_INTERVAL)
+            else:
+                return
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_timeout / 4):
+            with self._lock:
+                held = list(self.held.items())
+            for key, entry in held:
+                try:
+                    os.utime(self.path.joinpath("claimed", entry))
+                except FileNotFoundError:
+                    # the lease expired and the image went back to the queue; its results are still stored
+                    pass
+
+    def __enter__(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name="fibermorph-lease", daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._heartbeat.join()
+
+    def node_path(self, name):
+        """Path of a per-process file (e.g. this process's CSV of results) in nodes/, prefixed with host and pid."""
+        return self.path.joinpath("nodes", "{}_{}".format(self.node, name))
+
+    def merge(self, csv_path, parquet_path=None):
+        """Writes the results of every image, in claiming order, to the summary once all images are done.
+
+        Parameters
+        ----------
+        csv_path : str or pathlib object
+            Path of the summary CSV.
+        parquet_path : str, pathlib object or None
+            Path of a Parquet copy of the summary (None for none).
+
+        Returns
+        -------
+        bool
+            True if the summary was written, False if images are still waiting or claimed.
+
+        """
+        if not self.finished():
+            return False
+        paths = [pathlib.Path(csv_path)] + ([pathlib.Path(parquet_path)] if parquet_path is not None else [])
+        tmp_paths = [path.with_name(".{}.{}.tmp".format(path.name, self.node)) for path in paths]
+        merged = set()
+        with ResultWriter(tmp_paths[0], parquet_path=tmp_paths[1] if parquet_path is not None else None) as writer:
+            for entry in self._entries("done"):
+                key = self._entry_key(entry)
+                # an image queued twice by processes that populated at the same time is done twice
+                if key in merged:
+                    continue
+                merged.add(key)
+                with open(self.path.joinpath("results", key + ".json")) as f:
+                    writer.write(rows_to_frame(json.load(f)["rows"]))
+        for tmp_path, path in zip(tmp_paths, paths):
+            # the Parquet file only exists once rows were written
+            if tmp_path.exists():
+                os.replace(tmp_path, path)
+        return True
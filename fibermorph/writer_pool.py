@@ -0,0 +1,154 @@
+"""
+Background writing of the intermediate images saved with --save_image.
+
+Each stage of the curvature and section sequences used to encode and write its TIFF before the next stage could
+start. The stages now hand the image to a small thread pool (one per process, so one per joblib worker) and carry on;
+the pool creates the stage subdirectory and encodes and writes the file while the next stage computes. PIL and
+numpy release the GIL during encoding and file I/O, so the writes overlap with compute.
+
+The number of images waiting or being written is bounded (MAX_PENDING). When the disk falls behind, the next stage
+blocks until a write finishes rather than piling up full-size images in memory. The sequences wait for their writes
+at the end of every image, so once an image is reported done its files exist, and errors raised while writing are
+re-raised there. An image that fails before that point drains its writes instead (waits for them and drops their
+errors), so they are not left pending and blamed on the next image the process analyzes.
+"""
+
+import functools
+import os
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from PIL import Image
+
+from common import get_logger
+
+logger = get_logger(__name__)
+
+# threads writing images in each process
+WRITER_THREADS = 2
+
+# images that may be queued or being written at once in each process
+MAX_PENDING = 4
+
+
+class WriterPool(object):
+    """Thread pool for saving images, with a bound on the number of pending writes.
+
+    Parameters
+    ----------
+    threads : int
+        Number of writer threads.
+    max_pending : int
+        Number of writes that may be queued or running; submit blocks beyond it.
+
+    """
+
+    def __init__(self, threads=WRITER_THREADS, max_pending=MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="fibermorph-writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) on a writer thread, waiting first if max_pending writes are under way."""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        """Waits for every submitted write and re-raises the first error."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def drain(self):
+        """Waits for every submitted write and drops their errors (after an error of the image they belong to)."""
+        futures, self.futures = self.futures, []
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                logger.debug("Dropped the error of a write of a failed image: %r", future.exception())
+
+
+_pool = None
+_pool_pid = None
+
+
+def writer_pool():
+    """The writer pool of the current process, created on first use (and again in a forked child)."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = WriterPool()
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def _write(save_func, save_path, img, kwargs):
+    save_path = pathlib.Path(save_path)
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    save_func(save_path, img, **kwargs)
+
+
+def save_in_background(save_func, save_path, img, **kwargs):
+    """Saves an image on the writer pool, creating its directory if needed.
+
+    The image must not be modified afterwards, as it is written after this function returns.
+
+    Parameters
+    ----------
+    save_func : callable
+        Called as save_func(save_path, img, **kwargs) on a writer thread (e.g. save_colormapped or save_array).
+    save_path : str or pathlib object
+        Path of the file.
+    img : np.ndarray or PIL.Image.Image
+        Image to save.
+
+    """
+    writer_pool().submit(_write, save_func, save_path, img, kwargs)
+
+
+def save_array(save_path, img):
+    """Saves an array (or PIL image) as it is with PIL."""
+    if not isinstance(img, Image.Image):
+        img = Image.fromarray(img)
+    img.save(save_path)
+
+
+def save_colormapped(save_path, img, **kwargs):
+    """Saves an array through a colormap, like matplotlib.pyplot.imsave (kwargs such as cmap are passed on).
+
+    matplotlib is imported on first use, so processes that save nothing don't load it.
+    """
+    import matplotlib.image
+    matplotlib.image.imsave(save_path, img, **kwargs)
+
+
+def wait_for_writes():
+    """Waits for the images saved in the background by this process (see WriterPool.wait)."""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.wait()
+
+
+def drain_writes():
+    """Waits for the images saved in the background by this process without raising their errors (see
+    WriterPool.drain)."""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.drain()
+
+
+def drains_writes(func):
+    """Decorator for the sequence of one image: if it raises, its pending writes are drained (see drain_writes)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            drain_writes()
+            raise
+    return wrapper
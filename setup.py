@@ -22,9 +22,9 @@ setup(
     long_description_content_type='text/markdown',
     #python_requires='>3.8.2',
     install_requires=[
-        'numpy', 'scipy', 'matplotlib', 'joblib', 'pandas',
+        'numpy', 'scipy', 'matplotlib', 'joblib>=1.4', 'pandas',
         'scikit-learn', 'Pillow', 'rawpy', 'requests', 'sympy', 'argparse',
-        'scikit-image', 'joblib', 'matplotlib', 'tqdm', 'shapely'],
+        'scikit-image', 'joblib', 'matplotlib', 'tqdm', 'threadpoolctl'],
     entry_points={
         "console_scripts": [
             'fibermorph = fibermorph.fibermorph:main']}